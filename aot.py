@@ -0,0 +1,240 @@
+"""
+6502 ahead-of-time translator
+
+translate() turns an assembled program into the source of a standalone
+Python module: the control-flow graph is cut into basic blocks at every
+branch, JMP and JSR target (and after every block end), each block
+becomes one function, generated the same way the JIT does it, and a
+table says where each one starts and ends. build() keeps that module in
+__asmcache__/ next to the source, keyed by the code, this translator,
+jit.py and cpu.py, so a warm start is an import of an already
+byte-compiled file.
+
+AOT(cpu, module) runs it through the JIT's dispatcher. A block is only
+entered while the bytes it was translated from are still in memory and
+none of its abs operands is on a device page; any other PC, including
+code written at runtime, goes through the interpreter.
+
+Usage: python aot.py <filename.asm> [--bench] [--max-steps N] [--runs N] [-o out.py]
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import os
+import sys
+import time
+import types
+
+from assembler import CACHE_DIR, ORIGIN, Assembler
+from cpu import CPU, MODE_LEN, OPCODES, UNKNOWN
+from devices import standard
+from jit import BLOCK_END, INTERPRETED, JIT, MAX_BLOCK, Block, block_def
+
+# the module's code is jit.py's codegen as much as ours, and calls into
+# cpu.py's handlers and state
+_SELF = hashlib.sha256()
+for _mod in ('aot.py', 'jit.py', 'cpu.py'):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), _mod), 'rb') as _f:
+        _SELF.update(_f.read())
+_SELF = _SELF.digest()
+
+_JUMPS = {'JMP', 'JSR'}
+
+
+def basic_blocks(code, addr_line=None, origin=ORIGIN):
+    # {leader: [(addr, op, mnem, mode, operand, cycles)]}. instr starts
+    # come from addr_line (else a linear sweep of code); leaders are the
+    # origin, every branch/JMP/JSR target inside the code, every instr
+    # after a block end or an INTERPRETED one. those never get translated
+    cpu = CPU()
+    cpu.load(code, origin)
+    end = origin + len(code)
+    starts = sorted(addr_line) if addr_line else None
+    if starts is None:
+        starts, pc = [], origin
+        while pc < end:
+            starts.append(pc)
+            pc += cpu.decode(pc)[2]
+
+    instrs = {}
+    leaders = {origin}
+    for pc in starts:
+        _, operand, size, cycles, op = cpu.decode(pc)
+        mnem, mode, _ = OPCODES.get(op, UNKNOWN)
+        instrs[pc] = (pc, op, mnem, mode, operand, cycles)
+        if mode == 'rel': leaders.add(operand[0])
+        elif mnem in _JUMPS: leaders.add(operand)
+        if mnem in BLOCK_END or mnem in INTERPRETED: leaders.add(pc + size)
+
+    blocks = {}
+    for pc in sorted(leaders):
+        run = []
+        while pc in instrs and len(run) < MAX_BLOCK:
+            instr = instrs[pc]
+            if instr[2] in INTERPRETED: break
+            run.append(instr)
+            pc += 1 + MODE_LEN[instr[3]]
+            if instr[2] in BLOCK_END or pc in leaders: break
+        if run: blocks[run[0][0]] = run
+    return blocks
+
+
+def translate(code, addr_line=None, origin=ORIGIN, name='program'):
+    # -> python source of the module for this program
+    blocks = basic_blocks(code, addr_line, origin)
+    table, defs = [], []
+    for start, instrs in blocks.items():
+        last = instrs[-1]
+        end = last[0] + MODE_LEN[last[3]]
+        head = sum(i[5] for i in instrs[:-1])
+        inner = tuple(i[0] for i in instrs[1:])
+        pages = tuple(sorted({i[4] >> 8 for i in instrs if i[3] == 'abs' and i[2] not in _JUMPS}))
+        table.append(f"    0x{start:04X}: (0x{end:04X}, {len(instrs)}, {head}, {inner!r}, "
+                     f"0x{last[0]:04X}, {pages!r}),")
+        defs.append(block_def(instrs, f"block_{start:04X}"))
+    fns = ', '.join(f"0x{start:04X}: block_{start:04X}" for start in blocks)
+    return '\n'.join([
+        '"""',
+        f"6502 translation of {name}, generated by aot.py; do not edit",
+        '"""',
+        '',
+        f"ORIGIN = 0x{origin:04X}",
+        f"IMAGE = bytes.fromhex('{bytes(code).hex()}')",
+        '',
+        "# start -> (last byte, instrs, cycles of all but the last, inner PCs,",
+        "# PC of the last instr, abs pages read or written)",
+        "BLOCKS = {", *table, "}",
+        '',
+        '',
+        "def make(mem, code, rows):",
+        "    # -> {start: block fn} over one cpu's memory",
+        *defs,
+        f"    return {{{fns}}}",
+        '',
+    ])
+
+
+def module_path(filename, code, origin=ORIGIN):
+    # where build() keeps the translation of this code
+    key = hashlib.sha256(_SELF + origin.to_bytes(2, 'little') + bytes(code)).hexdigest()
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIR, f"aot_{key[:32]}.py")
+
+
+def load_source(src, name='aot_program'):
+    # module object from translate() output, without touching disk
+    mod = types.ModuleType(name)
+    exec(compile(src, f"<{name}>", 'exec'), mod.__dict__)
+    return mod
+
+
+def build(filename, cache=True):
+    # -> (Program, module) for filename; the module is imported from the
+    # cache when there, else translated and written there first. an
+    # unwritable cache dir just means translating every time
+    prog = Assembler.build(filename, cache)
+    path = module_path(filename, prog.code, prog.origin)
+    if not (cache and os.path.exists(path)):
+        src = translate(prog.code, prog.addr_line, prog.origin, os.path.basename(filename))
+        try:
+            if not cache: raise OSError
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f: f.write(src)
+            os.replace(tmp, path)
+        except OSError:
+            return prog, load_source(src)
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return prog, mod
+
+
+class AOT(JIT):
+    # JIT.run over a translated module: compile() hands out the module's
+    # block for a PC instead of translating, None (interpret) when there
+    # is none or it no longer matches memory
+
+    def __init__(self, cpu, module):
+        super().__init__(cpu)
+        self.module = module
+        self.fns = module.make(cpu.memory, cpu._code, cpu.dirty_rows)
+
+    def compile(self, pc):
+        info = self.module.BLOCKS.get(pc)
+        if info is None: return None
+        end, count, head, inner, last, pages = info
+        cpu = self.cpu
+        lo = pc - self.module.ORIGIN
+        if cpu.memory[pc:end + 1] != self.module.IMAGE[lo:lo + end + 1 - pc]: return None
+        devices = cpu.devices
+        for page in pages:
+            if devices[page] is not None: return None
+        loop = getattr(cpu.decode(last)[0], 'loop', None)
+        if loop is not None and loop[0] != pc: loop = None
+        blk = Block(self.fns[pc], pc, end, count, head, frozenset(inner), loop)
+        cpu._code[pc:end + 1] = b'\x01' * (end + 1 - pc)
+        self.blocks[pc] = blk
+        return blk
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="translate a 6502 program to a python module")
+    ap.add_argument('filename')
+    ap.add_argument('-o', '--out', help="also write the module here")
+    ap.add_argument('--bench', action='store_true', help="compare against CPU.step, CPU.run and the JIT")
+    ap.add_argument('--max-steps', type=int, default=200_000)
+    ap.add_argument('--repeats', type=int, default=5)
+    ap.add_argument('--runs', type=int, default=200, help="fresh runs per engine for --bench")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    prog = Assembler.build(args.filename)
+    src = translate(prog.code, prog.addr_line, prog.origin, os.path.basename(args.filename))
+    cold = time.perf_counter() - t0
+    build(args.filename)                            # make sure it's cached
+    t0 = time.perf_counter()
+    prog, mod = build(args.filename)
+    warm = time.perf_counter() - t0
+    print(f"{args.filename}: {len(mod.BLOCKS)} blocks, translated in {cold * 1e3:.2f} ms, "
+          f"cached load {warm * 1e3:.2f} ms")
+    if args.out:
+        with open(args.out, 'w') as f: f.write(src)
+    if not args.bench: return 0
+
+    # steady state: instrs/sec restarting on BRK (bench.measure), and
+    # whole runs/sec each on a fresh cpu and engine, which is where the
+    # JIT pays for translating again every time
+    from bench import measure
+    rates = {}
+    for engine in ('step', 'run', 'jit', 'aot'):
+        ips = measure(prog.code, {}, engine, args.max_steps, args.repeats)[0]
+        rates[engine] = (ips, _fresh_runs(prog, mod, engine, args.runs, args.max_steps))
+    base_ips, base_runs = rates['step']
+    for engine, (ips, runs) in rates.items():
+        print(f"{engine:5s} {ips / 1e3:9.1f} kIPS  x{ips / base_ips:5.2f}   "
+              f"{runs:9.1f} fresh runs/s  x{runs / base_runs:5.2f}  vs step")
+    return 0
+
+
+def _fresh_runs(prog, mod, engine, runs, max_steps):
+    # runs/sec of new cpu + engine, load, run to BRK or max_steps
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        cpu = CPU()
+        cpu.load(prog.code, prog.origin)
+        standard(cpu)
+        if engine == 'step':
+            step, n = cpu.step, 0
+            while n < max_steps and step(): n += 1
+            continue
+        if engine == 'jit':   run = JIT(cpu).run
+        elif engine == 'aot': run = AOT(cpu, mod).run
+        else:                 run = cpu.run
+        run(max_steps=max_steps)
+    return runs / (time.perf_counter() - t0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,161 +1,282 @@
 """
 6502 Assembler
+
+Assembler.parse() assembles a source file. Assembler.build() returns the
+same result as a Program, going through an on-disk cache first: objects
+live in __asmcache__/ next to the source, named by a hash of the source
+text, this module and cpu.py (its opcode table), so an edited source,
+assembler or opcode table just misses.
+
+Assembling is two passes. The first tokenizes each line once, straight
+off the file, into a compact instr table (addr, opcode, operand value
+or forward label); the second resolves labels over that table and
+emits the code. Bad source raises AsmError.
+
+Object format (dumps/loads), little endian:
+
+    header  magic 'A6O1', version u16, origin u16, sha256 of the source,
+            code length u32, addr_line entries u32, labels u32
+    code    bytes
+    addrs   u16 per addr_line entry, then the line indexes as u32
+    labels  u16 addr per label, then the names joined by '\n' (utf-8)
+
+Usage: python assembler.py <filename.asm> [-o out.obj] [--times]
 """
 
+import argparse
+import hashlib
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+from cpu import MODE_LEN, OPCODES
+
+# an assembled source: load addr, code bytes, {addr: source line index},
+# {LABEL: addr} and the sha256 digest of the source it came from
+Program = namedtuple('Program', 'origin code addr_line labels source_hash')
+
+MAGIC = b'A6O1'
+VERSION = 1
+HEADER = struct.Struct('<4sHH32sIII')
+CACHE_DIR = '__asmcache__'
+
+# cache keys cover the assembler too, and cpu.py, whose opcode table it
+# encodes from: a change to either misses every object
+_SELF = hashlib.sha256()
+for _mod in ('assembler.py', 'cpu.py'):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), _mod), 'rb') as _f:
+        _SELF.update(_f.read())
+_SELF = _SELF.digest()
+
+
+def dumps(prog):
+    # Program -> object bytes
+    addrs = array('H', prog.addr_line.keys())
+    lines = array('I', prog.addr_line.values())
+    label_addrs = array('H', prog.labels.values())
+    names = '\n'.join(prog.labels).encode()
+    head = HEADER.pack(MAGIC, VERSION, prog.origin, prog.source_hash,
+                       len(prog.code), len(addrs), len(label_addrs))
+    return b''.join((head, bytes(prog.code), addrs.tobytes(), lines.tobytes(),
+                     label_addrs.tobytes(), names))
+
+
+def loads(data):
+    # object bytes -> Program, ValueError if they aren't one
+    if len(data) < HEADER.size: raise ValueError("truncated object")
+    magic, version, origin, digest, n_code, n_lines, n_labels = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION: raise ValueError("not a version %d object" % VERSION)
+    pos = HEADER.size
+    code = bytes(data[pos:pos + n_code]); pos += n_code
+    addrs = array('H', data[pos:pos + 2 * n_lines]); pos += 2 * n_lines
+    lines = array('I', data[pos:pos + 4 * n_lines]); pos += 4 * n_lines
+    label_addrs = array('H', data[pos:pos + 2 * n_labels]); pos += 2 * n_labels
+    names = bytes(data[pos:]).decode().split('\n') if n_labels else []
+    if len(code) != n_code or len(lines) != n_lines or len(names) != n_labels:
+        raise ValueError("truncated object")
+    return Program(origin, code, dict(zip(addrs, lines)), dict(zip(names, label_addrs)), digest)
+
+
+def source_hash(filename):
+    # -> (cache key, sha256 digest) of the source, hashed a chunk at a
+    # time so a big file is never in memory whole
+    key, digest = hashlib.sha256(_SELF), hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            key.update(chunk)
+            digest.update(chunk)
+    return key.hexdigest(), digest.digest()
+
+
+def cache_path(filename, key):
+    # where build() keeps the object for this cache key
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIR, key + '.obj')
+
+
+class AsmError(ValueError):
+    # bad source; the message starts with the 1-based line number
+    pass
 
-class Assembler:
 
-    SIMPLE_OPS = {
-        'BRK': 0x00, 'NOP': 0xEA, 'CLC': 0x18, 'SEC': 0x38,
-        'INX': 0xE8, 'INY': 0xC8, 'DEX': 0xCA, 'DEY': 0x88,
-        'TAX': 0xAA, 'TAY': 0xA8, 'TXA': 0x8A, 'TYA': 0x98,
-        'RTS': 0x60
-    }
+ORIGIN = 0x0200
 
-    BRANCH_OPS = {
-        'BCC': 0x90, 'BCS': 0xB0, 'BEQ': 0xF0,
-        'BNE': 0xD0, 'BMI': 0x30, 'BPL': 0x10
-    }
+# one match per source line: [label:] [mnemonic [operand]] [; comment]
+_LINE = re.compile(r'\s*(?:([^\s:;][^:;]*?)\s*:)?\s*(?:([A-Za-z]+)(?:\s+([^;]*?))?)?\s*(?:;.*)?', re.S)
+# #imm, $hex, decimal or label, optionally ,X
+_OPERAND = re.compile(r'(#)?\s*(?:\$([0-9A-Fa-f]+)|([0-9]+)|([A-Za-z_.][\w.]*))(?:\s*,\s*([Xx]))?')
+
+# mnemonic -> {mode: opcode}, straight from the cpu's decode table
+_MODES = {}
+for _op, (_mnem, _mode, _) in OPCODES.items():
+    _MODES.setdefault(_mnem, {})[_mode] = _op
+_OP_MODE = bytes(MODE_LEN[OPCODES[op][1]] if op in OPCODES else 0 for op in range(256))
+_REL = frozenset(op for op, (_, mode, _) in OPCODES.items() if mode == 'rel')
+_ZPG = frozenset(op for op, (_, mode, _) in OPCODES.items() if mode in ('zpg', 'zpx'))
+
+
+class Assembler:
 
     @staticmethod
-    def parse(filename):
+    def parse(filename, labels=None):
+        # -> (bytecode, {addr: source line index}); pass a dict as labels
+        # to get the label table (upper-cased name -> addr) filled in
         with open(filename) as f:
-            lines = f.readlines()
+            return Assembler.assemble(f, labels)
+
+    @staticmethod
+    def build(filename, cache=True):
+        # -> Program for filename, from the object cache when the source
+        # (and assembler) match, else assembled and stored there. an
+        # unwritable cache dir just means no caching. the source is read
+        # twice, hashed in chunks then assembled line by line
+        key, digest = source_hash(filename)
+        path = cache_path(filename, key)
+        if cache:
+            try:
+                with open(path, 'rb') as f: prog = loads(f.read())
+                if prog.source_hash == digest: return prog
+            except (OSError, ValueError):
+                pass
 
         labels = {}
-        instr = []
-        addr = 0x0200
+        with open(filename, encoding='utf-8') as f:
+            code, addr_line = Assembler.assemble(f, labels)
+        prog = Program(ORIGIN, code, addr_line, labels, digest)
+        if cache:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, 'wb') as f: f.write(dumps(prog))
+                os.replace(tmp, path)
+            except OSError:
+                pass
+        return prog
+
+    @staticmethod
+    def assemble(lines, labels=None):
+        # parse() on any iterable of source lines (an open file streams).
+        # pass 1 tokenizes each line once into the instr table: source
+        # line, addr, opcode and operand value, or ~index into `refs` for
+        # a label not defined yet. a forward label can't pick zero page,
+        # so it gets the abs form where there is one. pass 2 walks the
+        # table, fills in those labels and emits the bytes
+        labels = {} if labels is None else labels
+        t_line, t_addr, t_op, t_val = array('I'), array('I'), bytearray(), array('i')
+        refs = []
+        addr = ORIGIN
+        seen = {}
+        match = _LINE.fullmatch
 
-        # labels && bake addrs
         for ln, line in enumerate(lines):
-            _line = line.rstrip()
-            code = line.split(';')[0].strip()
-            if not code: continue
-
-            if ':' in code:
-                label, rest = code.split(':', 1)
-                labels[label.strip().upper()] = addr
-                code = rest.strip()
-                if not code: continue
-
-            instr.append((ln, _line, addr, code))
-
-            parts = code.upper().split(None, 1)
-            if not parts: continue
-            mnem = parts[0]
-
-            if mnem in Assembler.SIMPLE_OPS:   addr += 1
-            elif mnem in ('JMP', 'JSR'):       addr += 3
-            elif mnem in Assembler.BRANCH_OPS: addr += 2
-            elif len(parts) > 1:
-                rawop = parts[1].strip()
-                _op = rawop.upper().replace(' ', '')
-                has_idx_x = _op.endswith(',X')
-                _immediate = rawop.startswith('#')
-                operand = rawop.split(',')[0].strip()
-                # best-effort value parse (for deciding zpg vs abs)
-                if   operand.startswith('$'):
-                    try: val = int(operand[1:], 16)
-                    except ValueError: val = 0
-                elif operand and operand[0].isdigit():
-                    try: val = int(operand)
-                    except ValueError: val = 0
-                else:  val = 0
-
-                if mnem == 'LDA':
-                    if _immediate:          addr += 2
-                    elif has_idx_x:         addr += 2     # zpg,X
-                    elif val < 256:           addr += 2     # zpg
-                    else:                     addr += 3     # abs
-                elif mnem == 'STA':
-                    if has_idx_x:           addr += 2     # zpg,X
-                    elif val < 256:           addr += 2     # zpg
-                    else:                     addr += 3     # abs
-                elif mnem == 'CMP':
-                    if _immediate:          addr += 2     # imm
-                    elif has_idx_x:         addr += 2     # zpg,X
-                    elif val < 256:           addr += 2     # zpg
-                    else:                     addr += 3     # abs (not emitted currently)
-                else:
-                    if _immediate:  addr += 2
-                    elif operand.startswith('$') and len(operand) <= 3: addr += 2
-                    else:  addr += 3
+            line = line.lstrip()
+            if not line or line[0] == ';': continue     # blank or comment
+            m = match(line)
+            if m is None: raise AsmError(f"line {ln + 1}: can't parse {line.strip()!r}")
+            label, mnem, operand = m.groups()
+            if label is not None:
+                label = label.upper()
+                if label in labels: raise AsmError(f"line {ln + 1}: {label} defined twice")
+                labels[label] = addr
+            if mnem is None: continue
+
+            # generated sources repeat the same instr text a lot; anything
+            # not naming a label decodes the same every time
+            known = seen.get((mnem, operand))
+            if known is None:
+                known = Assembler._decode(mnem, operand, labels, refs, ln)
+                if known[3]: seen[(mnem, operand)] = known
+            op, val, size, _ = known
+
+            t_line.append(ln)
+            t_addr.append(addr)
+            t_op.append(op)
+            t_val.append(val)
+            addr += size
+            if addr > 0x10000: raise AsmError(f"line {ln + 1}: code runs past $FFFF")
+
+        code = bytearray()
+        for i, op in enumerate(t_op):
+            val = t_val[i]
+            if val < 0:
+                val = labels.get(refs[~val])
+                if val is None: raise AsmError(f"line {t_line[i] + 1}: undefined label {refs[~t_val[i]]}")
+            size = _OP_MODE[op]
+            if op in _REL:
+                val -= t_addr[i] + 2                # rel offset => target - (next instr addr)
+                if not -128 <= val < 128: raise AsmError(f"line {t_line[i] + 1}: branch out of range")
+                code += bytes((op, val & 0xFF))
+            elif size == 2:
+                code += bytes((op, val & 0xFF, val >> 8))
+            elif size == 1:
+                if val > 0xFF and op in _ZPG:
+                    raise AsmError(f"line {t_line[i] + 1}: ${val:04X} is not zero page")
+                code += bytes((op, val & 0xFF))
+            else:
+                code.append(op)
+
+        return bytes(code), dict(zip(t_addr, t_line))
+
+    @staticmethod
+    def _decode(mnem, operand, labels, refs, ln):
+        # one instr's text -> (opcode, operand value or ~ref, size, cacheable)
+        modes = _MODES.get(mnem.upper())
+        if modes is None: raise AsmError(f"line {ln + 1}: unknown instruction {mnem}")
+        literal = True
+        if not operand:
+            mode, val = 'imp', 0
+        else:
+            o = _OPERAND.fullmatch(operand)
+            if o is None: raise AsmError(f"line {ln + 1}: bad operand {operand!r}")
+            imm, hexval, dec, name, idx = o.groups()
+            if hexval is not None: val = int(hexval, 16)
+            elif dec is not None:  val = int(dec)
             else:
-                addr += 1
-
-        # generate bytecode
-        bytecode = []
-        for ln, _line, line_addr, code in instr:
-            parts = code.upper().split(None, 1)
-            if not parts: continue
-            rawop = parts[1].strip() if len(parts) > 1 else ''
-            _op = rawop.upper().replace(' ', '')
-            has_idx_x = _op.endswith(',X')
-            operand = rawop.split(',')[0].strip()
-            mnem = parts[0]
-
-            _immediate = operand.startswith('#')
-            if _immediate: operand = operand[1:]
-
-            if operand.startswith('$'):            val = int(operand[1:], 16)
-            elif operand and operand[0].isdigit(): val = int(operand)
-            elif operand.upper() in labels:        val = labels[operand.upper()]
-            else: val = 0
-
-            if mnem in Assembler.SIMPLE_OPS:
-                bytecode.append(Assembler.SIMPLE_OPS[mnem])
-
-            elif mnem == 'LDA':
-                if _immediate:         bytecode.extend([0xA9, val & 0xFF])
-                elif has_idx_x:        bytecode.extend([0xB5, val & 0xFF])       # zpg,X
-                elif val < 256:        bytecode.extend([0xA5, val & 0xFF])       # zpg
-                else:                  bytecode.extend([0xAD, val & 0xFF, val >> 8])  # abs
-
-            elif mnem == 'LDX':
-                if _immediate:         bytecode.extend([0xA2, val & 0xFF])
-                else:                  bytecode.extend([0xA6, val])
-
-            elif mnem == 'LDY':
-                if _immediate:         bytecode.extend([0xA0, val & 0xFF])
-                else:                  bytecode.extend([0xA4, val])
-
-            elif mnem == 'STA':
-                if has_idx_x:          bytecode.extend([0x95, val & 0xFF])       # zpg,X
-                elif val < 256:        bytecode.extend([0x85, val & 0xFF])       # zpg
-                else:                  bytecode.extend([0x8D, val & 0xFF, val >> 8])  # abs
-
-            elif mnem == 'STX':        bytecode.extend([0x86, val])
-
-            elif mnem == 'STY':        bytecode.extend([0x84, val])
-
-            elif mnem == 'ADC':
-                if _immediate:         bytecode.extend([0x69, val & 0xFF])
-                else:                  bytecode.extend([0x65, val])
-
-            elif mnem == 'SBC':        bytecode.extend([0xE9, val & 0xFF])
-            elif mnem == 'AND':        bytecode.extend([0x29, val & 0xFF])
-            elif mnem == 'ORA':        bytecode.extend([0x09, val & 0xFF])
-            elif mnem == 'EOR':        bytecode.extend([0x49, val & 0xFF])
-            elif mnem == 'CMP':
-                if _immediate:         bytecode.extend([0xC9, val & 0xFF])       # imm
-                elif has_idx_x:        bytecode.extend([0xD5, val & 0xFF])       # zpg,X
-                else:                  bytecode.extend([0xC5, val & 0xFF])       # zpg
-
-            elif mnem == 'CPX':
-                if _immediate:         bytecode.extend([0xE0, val & 0xFF])
-                else:                  bytecode.extend([0xE4, val])  # zero-page
-
-            elif mnem == 'CPY':
-                if _immediate:         bytecode.extend([0xC0, val & 0xFF])
-                else:                  bytecode.extend([0xC4, val])  # zero-page
-            elif mnem == 'JMP':        bytecode.extend([0x4C, val & 0xFF, val >> 8])
-            elif mnem == 'JSR':        bytecode.extend([0x20, val & 0xFF, val >> 8])
-
-            elif mnem in Assembler.BRANCH_OPS:
-                # rel offset => target - (next instr addr)
-                offset = (val - (line_addr + 2)) & 0xFF
-                bytecode.extend([Assembler.BRANCH_OPS[mnem], offset])
-
-        addr_line = {addr: _ln for _ln, _, addr, _ in instr}
-        return bytecode, addr_line
+                literal = False
+                val = labels.get(name.upper())
+                if val is None:
+                    val = ~len(refs)
+                    refs.append(name.upper())
+            if val > 0xFFFF: raise AsmError(f"line {ln + 1}: {operand} is past $FFFF")
+
+            if 'rel' in modes:  mode = 'rel'
+            elif imm:           mode = 'imm'
+            elif idx:           mode = 'zpx'
+            elif 'abs' not in modes or 0 <= val < 256 and 'zpg' in modes:
+                mode = 'zpg'
+            else:               mode = 'abs'
+        op = modes.get(mode)
+        if op is None: raise AsmError(f"line {ln + 1}: {mnem.upper()} has no {mode} mode")
+        return op, val, 1 + MODE_LEN[mode], literal
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="assemble a 6502 source to an object file")
+    ap.add_argument('filename')
+    ap.add_argument('-o', '--out', help="write the object here (default: only the cache)")
+    ap.add_argument('--times', action='store_true', help="time a cold (assembling) vs warm (cached) build")
+    args = ap.parse_args(argv)
+
+    if args.times:
+        t0 = time.perf_counter()
+        prog = Assembler.build(args.filename, cache=False)
+        cold = time.perf_counter() - t0
+        Assembler.build(args.filename)         # make sure it's cached
+        t0 = time.perf_counter()
+        Assembler.build(args.filename)
+        warm = time.perf_counter() - t0
+        print(f"cold {cold * 1e3:.2f} ms  warm {warm * 1e3:.2f} ms  ({cold / warm:.1f}x)")
+    else:
+        prog = Assembler.build(args.filename)
+    print(f"{args.filename}: {len(prog.code)} bytes at ${prog.origin:04X}, "
+          f"{len(prog.addr_line)} instrs, {len(prog.labels)} labels")
+    if args.out:
+        with open(args.out, 'wb') as f: f.write(dumps(prog))
+    return 0
+
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+"""
+6502 lockstep batch engine
+
+Batch(n) holds n machines running the same program as numpy arrays: one
+(n,) array per register and flag and an (n, size) memory. step() executes
+one instr on every running lane. Lanes are grouped by the opcode at their
+PC and each group runs that opcode once as masked vector operations over
+its lanes, so the python cost is per distinct opcode, not per machine.
+Lanes that branch differently simply end up at different PCs; BRK clears
+a lane's running flag and it stays frozen from then on.
+
+Memory below `size` (a power of two, default the full 64 KiB) is per
+lane and mirrored above it, so a narrow window only behaves like CPU for
+programs that stay inside it. There are no devices, events or interrupts:
+abs operands are plain RAM, like a CPU with nothing mapped. lane(i) turns
+one lane back into a CPU; --check compares every lane against CPU run
+for the same number of steps.
+
+Needs numpy, nothing else in the emulator does.
+
+Usage: python batch.py <filename.asm> [-n N] [--max-steps N] [--max-cycles N]
+                       [--vary $10..$17] [--seed N] [--size N] [--check]
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from assembler import Assembler
+from breakpoints import parse_range
+from cpu import CPU, MODE_LEN, OPCODES, UNKNOWN
+
+# _nz value for [N][Z], see CPU.flag_n
+_NZ = np.array([[0x01, 0x00], [0x80, 0x100]], dtype=np.int32)
+
+# mnemonic -> fn(batch, lanes, mnem, mode, operand), filled by @vec. operand is
+# as CPU.decode() gives it but one entry per lane: the byte for imm, the
+# address for zpg/zpx/abs (zpx already indexed) and (target, taken
+# cycles) for rel
+_VEC = {}
+
+
+def vec(*mnems):
+    def deco(fn):
+        for mnem in mnems: _VEC[mnem] = fn
+        return fn
+    return deco
+
+
+class Batch:
+
+    # (n,) state arrays, named like the CPU attributes they mirror
+    REGS = ('a', 'x', 'y', 'sp', 'pc', 'nz', 'v', 'c', 'i')
+
+    def __init__(self, n, size=0x10000):
+        if size & (size - 1) or not 0x200 <= size <= 0x10000:
+            raise ValueError(f"memory size {size:#x}: a power of two from $200 to $10000")
+        self.n = n
+        self.mask = size - 1
+        for reg in self.REGS:
+            setattr(self, reg, np.zeros(n, dtype=np.int32))
+        self.sp[:] = 0xFF
+        self.nz[:] = 1
+        self.i[:] = 1
+        self.cycles  = np.zeros(n, dtype=np.int64)
+        self.steps   = np.zeros(n, dtype=np.int64)
+        self.running = np.ones(n, dtype=bool)
+        self.memory  = np.zeros((n, size), dtype=np.uint8)
+
+    def load(self, code, addr=0x0200):
+        # the same program into every lane, PC/SP pointed at it
+        code = np.frombuffer(bytes(code), dtype=np.uint8)
+        self.memory[:, addr:addr + len(code)] = code
+        self.pc[:] = addr
+        self.sp[:] = 0xFF
+
+    def poke(self, addr, values):
+        # per-lane input: values is a scalar or one byte per lane
+        self.memory[:, addr & self.mask] = values
+
+    @property
+    def flag_n(self): return (self.nz & 0x180 != 0).astype(np.int32)
+
+    @property
+    def flag_z(self): return (self.nz & 0xFF == 0).astype(np.int32)
+
+    # ---------------------------------------------
+    # execution
+    # ---------------------------------------------
+    def step(self, cycle_limit=None):
+        # one instr on every running lane (and below cycle_limit, which
+        # like CPU.run stops a lane at the first instr boundary at or past
+        # it) -> number of lanes that executed
+        active = self.running
+        if cycle_limit is not None: active = active & (self.cycles < cycle_limit)
+        lanes = np.flatnonzero(active)
+        if not len(lanes): return 0
+
+        pc = self.pc[lanes]
+        ops = self.memory[lanes, pc & self.mask]
+        if (ops == ops[0]).all():
+            self._exec(int(ops[0]), lanes, pc)
+        else:
+            order = np.argsort(ops, kind='stable')
+            ops = ops[order]
+            cuts = np.flatnonzero(np.diff(ops)) + 1
+            for lo, hi in zip(np.r_[0, cuts], np.r_[cuts, len(ops)]):
+                pick = order[lo:hi]
+                self._exec(int(ops[lo]), lanes[pick], pc[pick])
+        return len(lanes)
+
+    def run(self, max_steps=None, max_cycles=None):
+        # step() until every lane hit BRK or a limit: max_steps instrs
+        # (all lanes move together, so that is also each lane's count) or
+        # max_cycles per lane. -> lockstep iterations done
+        cycle_limit = None if max_cycles is None else self.cycles + max_cycles
+        done = 0
+        while done != max_steps and self.step(cycle_limit):
+            done += 1
+        return done
+
+    def _exec(self, op, lanes, pc):
+        # one opcode over `lanes`, each at its own pc
+        mnem, mode, cycles = OPCODES.get(op, UNKNOWN)
+        size = 1 + MODE_LEN[mode]
+        mem, mask = self.memory, self.mask
+        lo = mem[lanes, (pc + 1) & mask].astype(np.int32) if size > 1 else None
+
+        if   mode == 'abs': operand = (lo | (mem[lanes, (pc + 2) & mask].astype(np.int32) << 8)) & mask
+        elif mode == 'zpx': operand = (lo + self.x[lanes]) & 0xFF
+        elif mode == 'rel':
+            after = (pc + 2) & 0xFFFF
+            target = (after + lo - ((lo >= 128) << 8)) & 0xFFFF
+            operand = (target, 1 + ((after ^ target) > 0xFF))
+        else:               operand = lo
+
+        self.pc[lanes] = (pc + size) & 0xFFFF
+        self.cycles[lanes] += cycles
+        self.steps[lanes] += 1
+        _VEC.get(mnem, _nop)(self, lanes, mnem, mode, operand)
+
+    def _read(self, lanes, mode, operand):
+        return operand if mode == 'imm' else self.memory[lanes, operand].astype(np.int32)
+
+    def _push(self, lanes, vals):
+        sp = self.sp[lanes]
+        self.memory[lanes, 0x100 + sp] = vals
+        self.sp[lanes] = (sp - 1) & 0xFF
+
+    def _pop(self, lanes):
+        sp = (self.sp[lanes] + 1) & 0xFF
+        self.sp[lanes] = sp
+        return self.memory[lanes, 0x100 + sp].astype(np.int32)
+
+    # ---------------------------------------------
+    # back to scalar
+    # ---------------------------------------------
+    def lane(self, i):
+        # lane i as a CPU (memory mirrored out to 64 KiB)
+        cpu = CPU()
+        mem = self.memory[i]
+        cpu.memory[:] = np.tile(mem, 0x10000 // len(mem)).tobytes()
+        cpu.a, cpu.x, cpu.y = int(self.a[i]), int(self.x[i]), int(self.y[i])
+        cpu.sp, cpu.pc, cpu._nz = int(self.sp[i]), int(self.pc[i]), int(self.nz[i])
+        cpu.flag_v, cpu.flag_c, cpu.flag_i = int(self.v[i]), int(self.c[i]), int(self.i[i])
+        cpu.cycles, cpu.steps = int(self.cycles[i]), int(self.steps[i])
+        cpu.running = bool(self.running[i])
+        cpu.flush()
+        return cpu
+
+
+# ---------------------------------------------
+# vector handlers, one per mnemonic group
+# ---------------------------------------------
+@vec('LDA', 'LDX', 'LDY', 'TAX', 'TAY', 'TXA', 'TYA')
+def _move(b, lanes, mnem, mode, operand):
+    # LDr from the operand, Txy from register x
+    dst = getattr(b, mnem[2].lower())
+    val = b._read(lanes, mode, operand) if mnem[0] == 'L' else getattr(b, mnem[1].lower())[lanes]
+    dst[lanes] = val
+    b.nz[lanes] = val
+
+
+@vec('STA', 'STX', 'STY')
+def _store(b, lanes, mnem, mode, operand):
+    b.memory[lanes, operand] = getattr(b, mnem[2].lower())[lanes]
+
+
+@vec('ADC')
+def _adc(b, lanes, mnem, mode, operand):
+    a, val, c = b.a[lanes], b._read(lanes, mode, operand), b.c[lanes]
+    result = a + val + c
+    b.v[lanes] = ((a ^ result) & (val ^ result) & 0x80) != 0
+    b.c[lanes] = result > 0xFF
+    b.a[lanes] = b.nz[lanes] = result & 0xFF
+
+
+@vec('SBC')
+def _sbc(b, lanes, mnem, mode, operand):
+    a, val, c = b.a[lanes], b._read(lanes, mode, operand), b.c[lanes]
+    result = a - val - (1 - c)
+    b.v[lanes] = ((a ^ val) & (a ^ result) & 0x80) != 0
+    b.c[lanes] = result >= 0
+    b.a[lanes] = b.nz[lanes] = result & 0xFF
+
+
+@vec('AND', 'ORA', 'EOR')
+def _logic(b, lanes, mnem, mode, operand):
+    a, val = b.a[lanes], b._read(lanes, mode, operand)
+    if   mnem == 'AND': a &= val
+    elif mnem == 'ORA': a |= val
+    else:               a ^= val
+    b.a[lanes] = b.nz[lanes] = a
+
+
+@vec('CMP', 'CPX', 'CPY')
+def _compare(b, lanes, mnem, mode, operand):
+    reg = getattr(b, 'a' if mnem == 'CMP' else mnem[2].lower())[lanes]
+    val = b._read(lanes, mode, operand)
+    b.c[lanes] = reg >= val
+    b.nz[lanes] = (reg - val) & 0xFF
+
+
+@vec('INX', 'INY', 'DEX', 'DEY')
+def _incdec(b, lanes, mnem, mode, operand):
+    reg = getattr(b, mnem[2].lower())
+    val = (reg[lanes] + (1 if mnem[0] == 'I' else -1)) & 0xFF
+    reg[lanes] = b.nz[lanes] = val
+
+
+# flag ops: mnemonic -> (flag, value); no IRQ sources here, CLI has
+# nothing to poll
+_FLAGS = {'CLC': ('c', 0), 'SEC': ('c', 1), 'CLI': ('i', 0), 'SEI': ('i', 1)}
+
+
+@vec(*_FLAGS)
+def _flag(b, lanes, mnem, mode, operand):
+    flag, val = _FLAGS[mnem]
+    getattr(b, flag)[lanes] = val
+
+
+@vec('JMP')
+def _jmp(b, lanes, mnem, mode, operand):
+    b.pc[lanes] = operand
+
+
+@vec('JSR')
+def _jsr(b, lanes, mnem, mode, operand):
+    ret = (b.pc[lanes] - 1) & 0xFFFF
+    b._push(lanes, ret >> 8)
+    b._push(lanes, ret & 0xFF)
+    b.pc[lanes] = operand
+
+
+@vec('RTS')
+def _rts(b, lanes, mnem, mode, operand):
+    lo = b._pop(lanes)
+    hi = b._pop(lanes)
+    b.pc[lanes] = (((hi << 8) | lo) + 1) & 0xFFFF
+
+
+def _set_status(b, lanes, status):
+    # CPU._set_status per lane
+    b.nz[lanes] = _NZ[(status >> 7) & 1, (status >> 1) & 1]
+    b.v[lanes] = (status >> 6) & 1
+    b.i[lanes] = (status >> 2) & 1
+    b.c[lanes] = status & 1
+
+
+@vec('PHP')
+def _php(b, lanes, mnem, mode, operand):
+    nz = b.nz[lanes]
+    b._push(lanes, ((nz & 0x180 != 0) << 7) | (b.v[lanes] << 6) | 0x30 | (b.i[lanes] << 2)
+            | ((nz & 0xFF == 0) << 1) | b.c[lanes])
+
+
+@vec('PLP')
+def _plp(b, lanes, mnem, mode, operand):
+    _set_status(b, lanes, b._pop(lanes))
+
+
+@vec('RTI')
+def _rti(b, lanes, mnem, mode, operand):
+    _set_status(b, lanes, b._pop(lanes))
+    lo = b._pop(lanes)
+    hi = b._pop(lanes)
+    b.pc[lanes] = (hi << 8) | lo
+
+
+# branch taken, per lane
+_COND = {
+    'BCC': lambda b, l: b.c[l] == 0,         'BCS': lambda b, l: b.c[l] != 0,
+    'BEQ': lambda b, l: b.nz[l] & 0xFF == 0, 'BNE': lambda b, l: b.nz[l] & 0xFF != 0,
+    'BMI': lambda b, l: b.nz[l] & 0x180 != 0, 'BPL': lambda b, l: b.nz[l] & 0x180 == 0,
+}
+
+
+@vec(*_COND)
+def _branch(b, lanes, mnem, mode, operand):
+    taken = _COND[mnem](b, lanes)
+    target, extra = operand
+    t = lanes[taken]
+    b.pc[t] = target[taken]
+    b.cycles[t] += extra[taken]
+
+
+@vec('BRK')
+def _brk(b, lanes, mnem, mode, operand):
+    b.running[lanes] = False
+
+
+def _nop(b, lanes, mnem, mode, operand):
+    # NOP and unknown opcodes
+    pass
+
+
+# ---------------------------------------------
+# CLI: sweep a program over random inputs
+# ---------------------------------------------
+def _state(cpu, size):
+    # registers, counters and the memory window a lane has
+    return (cpu.a, cpu.x, cpu.y, cpu.sp, cpu.pc, cpu.flag_n, cpu.flag_v, cpu.flag_z,
+            cpu.flag_c, cpu.flag_i, cpu.cycles, cpu.steps, cpu.running, bytes(cpu.memory[:size]))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="run one 6502 program on many inputs in lockstep")
+    ap.add_argument('filename')
+    ap.add_argument('-n', type=int, default=1000, help="lanes")
+    ap.add_argument('--max-steps', type=int, default=100_000)
+    ap.add_argument('--max-cycles', type=int, default=None)
+    ap.add_argument('--vary', help="random bytes per lane here, '$10' or '$10..$17' (lane 0 keeps the program's)")
+    ap.add_argument('--seed', type=int, default=None)
+    ap.add_argument('--size', type=lambda v: int(v, 0), default=0x10000, help="memory per lane")
+    ap.add_argument('--check', action='store_true', help="compare every lane against CPU")
+    args = ap.parse_args(argv)
+
+    code = Assembler.build(args.filename).code
+    batch = Batch(args.n, args.size)
+    batch.load(code)
+    if args.vary:
+        lo, hi = parse_range(args.vary)
+        rng = np.random.default_rng(args.seed)
+        for addr in range(lo, hi + 1):
+            vals = rng.integers(0, 256, args.n, dtype=np.uint8)
+            vals[0] = batch.memory[0, addr & batch.mask]
+            batch.poke(addr, vals)
+    inputs = batch.memory.copy() if args.check else None
+
+    t0 = time.perf_counter()
+    iters = batch.run(args.max_steps, args.max_cycles)
+    wall = time.perf_counter() - t0
+    instrs = int(batch.steps.sum())
+    print(f"{args.filename}: {args.n} lanes, {iters} lockstep steps, "
+          f"{int((~batch.running).sum())} hit BRK")
+    print(f"{instrs} instructions in {wall:.2f} s, {instrs / wall / 1e6 if wall else 0:.2f} MIPS")
+
+    if args.check:
+        bad = 0
+        wall = 0.0
+        for i in range(args.n):
+            cpu = CPU()
+            cpu.idle = None                     # every instr, like the lanes
+            cpu.memory[:] = np.tile(inputs[i], 0x10000 // args.size).tobytes()
+            cpu.flush()
+            cpu.pc = 0x0200
+            t0 = time.perf_counter()
+            cpu.run(max_steps=args.max_steps, max_cycles=args.max_cycles)
+            wall += time.perf_counter() - t0
+            if _state(cpu, args.size) != _state(batch.lane(i), args.size):
+                bad += 1
+                if bad <= 5: print(f"lane {i}: differs from CPU")
+        print(f"check: {args.n - bad}/{args.n} lanes match CPU (scalar {instrs / wall / 1e6 if wall else 0:.2f} MIPS)")
+        if bad: return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
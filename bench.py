@@ -0,0 +1,335 @@
+"""
+6502 emulator throughput benchmarks
+
+Two suites, both run for a fixed instruction count:
+  kernels   synthetic code per opcode group, each as a straight-line
+            (body unrolled, then JMP back) and a looping (body, JMP back)
+            variant, plus taken/not-taken/page-crossing branches and JSR/RTS
+  programs  the .asm programs in tests/, restarted from their loaded
+            state whenever they hit BRK
+
+Every benchmark reports instructions/sec, emulated cycles/sec and the
+speed relative to a real 1 MHz 6502. Results can be written as JSON and
+compared against a stored baseline.
+
+--devices maps the reference devices (devices.standard) and adds an 'io'
+kernel that loads/stores them; comparing a --devices run against a plain
+baseline shows what the page table costs RAM-only code.
+
+--irq runs a program taking a timer IRQ every IRQ_PERIOD cycles with 0..N
+idle devices registered (each holding a far-off event in the scheduler),
+and checks every IRQ fired exactly on its deadline.
+
+--asm N generates an N-line source the way a compiler would (annotated
+code, labels, blank lines) plus a dense all-code one, builds both cold
+(Assembler.build: hash, assemble, write the cached object) from disk
+and checks them against the budget: up to a million lines in
+ASM_BUDGET_S seconds and ASM_BUDGET_MB of Python heap, linear past
+that. Code has to fit below $FFFF, so past ASM_INSTRS instrs the extra
+lines are annotations.
+
+Usage: python bench.py [--engine run|step|jit|aot] [--devices] [--irq] [--asm [N]]
+                       [--json out.json] [--baseline base.json] [--threshold 0.10]
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from assembler import CACHE_DIR, Assembler
+from cpu import CPU
+from devices import CHAR_OUT, TIMER, Timer, standard
+
+ORG = 0x0200
+UNROLL = 32
+
+# straight-line bodies per opcode group (raw bytes, run from ORG)
+GROUPS = {
+    'loads':     [0xA9, 0x11, 0xA5, 0x10, 0xAD, 0x00, 0x03, 0xB5, 0x10,
+                  0xA2, 0x01, 0xA6, 0x11, 0xA0, 0x02, 0xA4, 0x12],
+    'stores':    [0x85, 0x10, 0x8D, 0x00, 0x03, 0x95, 0x11, 0x86, 0x12, 0x84, 0x13],
+    'adc_sbc':   [0x69, 0x03, 0x65, 0x10, 0xE9, 0x05],
+    'logic':     [0x29, 0xF7, 0x09, 0x21, 0x49, 0x5A],
+    'compares':  [0xC9, 0x40, 0xC5, 0x10, 0xD5, 0x10, 0xE0, 0x01,
+                  0xE4, 0x11, 0xC0, 0x02, 0xC4, 0x12],
+    'inc_dec':   [0xE8, 0xC8, 0xCA, 0x88],
+    'transfers': [0xAA, 0xA8, 0x8A, 0x98],
+    # X=1 from the prelude, so Z=0: BNE +0 always taken, BEQ +0 never
+    'branch_taken':     [0xD0, 0x00],
+    'branch_not_taken': [0xF0, 0x00],
+}
+
+# STA $F000 (char out), LDA $F100 (timer), LDA $F200 (random)
+IO_GROUP = [0x8D, 0x00, 0xF0, 0xAD, 0x00, 0xF1, 0xAD, 0x00, 0xF2]
+
+
+def _jmp(addr):
+    return [0x4C, addr & 0xFF, addr >> 8]
+
+
+def kernels(devices=False):
+    # name -> (code at ORG, extra {addr: bytes})
+    out = {}
+    prelude = [0xA2, 0x01]                      # LDX #1 (Z=0 for branches)
+    loop = ORG + len(prelude)
+    groups = {**GROUPS, 'io': IO_GROUP} if devices else GROUPS
+    for name, body in groups.items():
+        out[f"{name}/straight"] = (prelude + body * UNROLL + _jmp(loop), {})
+        out[f"{name}/loop"] = (prelude + body + _jmp(loop), {})
+
+    # two taken branches bouncing across the $02FF/$0300 page boundary:
+    # $02FC BNE +2 -> $0300, $0300 BNE -6 -> $02FC
+    out['branch_page_cross/loop'] = (prelude + _jmp(0x02FC),
+                                     {0x02FC: [0xD0, 0x02], 0x0300: [0xD0, 0xFA]})
+
+    # JSR to a bare RTS at $0400
+    out['jsr_rts/straight'] = (prelude + [0x20, 0x00, 0x04] * UNROLL + _jmp(loop), {0x0400: [0x60]})
+    out['jsr_rts/loop'] = (prelude + [0x20, 0x00, 0x04] + _jmp(loop), {0x0400: [0x60]})
+    return out
+
+
+def programs(pattern='tests/*.asm'):
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = {}
+    for path in sorted(glob.glob(os.path.join(here, pattern))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        out[f"prog/{name}"] = (Assembler.build(path).code, {})
+    return out
+
+
+def measure(code, extra, engine, count, repeats, devices=False):
+    # best-of-repeats (instrs/sec, cycles/sec) over `count` instructions
+    cpu = CPU()
+    cpu.idle = None                             # time every pass of the loops
+    for addr, data in extra.items():
+        cpu.load(data, addr)
+    cpu.load(code, ORG)
+    if devices: out = standard(cpu)[CHAR_OUT].text
+    boot = cpu.snapshot()
+
+    if engine == 'jit':
+        from jit import JIT
+        run = JIT(cpu).run
+    elif engine == 'aot':
+        from aot import AOT, load_source, translate
+        run = AOT(cpu, load_source(translate(code, origin=ORG))).run
+    elif engine == 'step':
+        def run(max_steps):
+            # the per-call step() path, for comparison with run()
+            step, n = cpu.step, 0
+            while n < max_steps and step(): n += 1
+    else:
+        run = cpu.run
+
+    best = None
+    for _ in range(repeats):
+        cpu.restore(boot)
+        steps = cycles = 0
+        elapsed = 0.0
+        while steps < count:
+            t0 = time.perf_counter()
+            run(max_steps=count - steps)
+            elapsed += time.perf_counter() - t0
+            steps += cpu.steps
+            cycles += cpu.cycles
+            cpu.restore(boot)                   # BRK or budget: start over
+            if devices: out.clear()
+        rate = (steps / elapsed, cycles / elapsed)
+        if best is None or rate[0] > best[0]: best = rate
+    return best
+
+
+IRQ_PERIOD = 100
+ISR = 0x0400
+
+# enable a IRQ_PERIOD cycle timer IRQ, CLI, then count in $10 forever;
+# the isr just acks
+IRQ_MAIN = [0xA9, IRQ_PERIOD, 0x8D, 0x04, 0xF1, 0xA9, 0x00, 0x8D, 0x05, 0xF1,
+            0xA9, 0x01, 0x8D, 0x06, 0xF1, 0x58,
+            0xA5, 0x10, 0x69, 0x01, 0x85, 0x10, 0x4C, 0x10, 0x02]
+IRQ_ISR = [0xAD, 0x06, 0xF1, 0x40]
+
+
+def irq_bench(idle, engine, count, repeats):
+    # -> (instrs/sec, IRQs taken, all on time)
+    cpu = CPU()
+    cpu.idle = None
+    cpu.load(IRQ_ISR, ISR)
+    cpu.load([ISR & 0xFF, ISR >> 8], 0xFFFE)
+    cpu.load(IRQ_MAIN, ORG)
+    timer = standard(cpu)[TIMER]
+    for page in range(0x10, 0x10 + idle):
+        # idle: mapped, with an event that never comes due
+        cpu.map(page, Timer(cpu))
+        cpu.schedule(1 << 62, lambda cycle: None)
+    run = cpu.run
+    if engine == 'jit':
+        from jit import JIT
+        run = JIT(cpu).run
+
+    # entry latency: isr reached within one instr of each deadline
+    on_time = True
+    for _ in range(20):
+        run(until_pc=ISR)
+        on_time &= 0 <= cpu.cycles - 7 - timer.last < 8
+    phase = timer.last % IRQ_PERIOD
+
+    best = 0
+    for _ in range(repeats):
+        fired = timer.fired
+        start = cpu.cycles
+        t0 = time.perf_counter()
+        run(max_steps=count)
+        elapsed = time.perf_counter() - t0
+        best = max(best, count / elapsed)
+        # every deadline in between fired, none drifted
+        on_time &= timer.fired - fired == (timer.last - start) // IRQ_PERIOD + 1 or timer.last < start
+        on_time &= timer.last % IRQ_PERIOD == phase
+    return best, timer.fired, on_time
+
+
+ASM_INSTRS = 24_000
+ASM_BUDGET_S = 1.0
+ASM_BUDGET_MB = 32
+
+# generated instr bodies, {} is a random byte
+ASM_TEMPLATES = ['LDA #${:02X}', 'STA ${:02X}', 'LDA ${:02X},X', 'ADC #${:02X}', 'CMP #${:02X}',
+                 'INX', 'DEY', 'CLC', 'LDX ${:02X}', 'STA $3{:02X}0']
+
+
+def asm_source(lines, instrs=ASM_INSTRS, seed=1):
+    # yields `lines` source lines, `instrs` of them code spread evenly:
+    # blocks of 16 opening with a label and closing with a BNE back or a
+    # JMP forward to the next one, the rest comments, labels and blanks
+    rng = random.Random(seed)
+    instrs = min(instrs, lines)
+    block = done = 0
+    for i in range(lines):
+        if done < instrs and i * instrs // lines >= done:
+            done += 1
+            if done % 16 == 1:
+                block += 1
+                yield f"blk{block}:\n"
+            elif done % 16 == 0:
+                yield (f"    BNE blk{block}      ; loop\n" if rng.random() < 0.5
+                       else f"    JMP blk{block + 1}\n")
+            else:
+                op = rng.choice(ASM_TEMPLATES).format(rng.randrange(256))
+                yield f"    {op:16s}; instr {done}\n"
+        else:
+            r = rng.random()
+            yield ("\n" if r < 0.3 else f"l{i}:\n" if r < 0.4
+                   else f"; {i}: generated annotation for the line above\n")
+    yield f"blk{block + 1}: BRK\n"
+
+
+def asm_bench(lines, repeats):
+    # -> [(name, lines, seconds, peak heap MB)] of a cold build() from
+    # disk, the object cache emptied before each
+    out = []
+    cold = lambda: shutil.rmtree(os.path.join(tmp, CACHE_DIR), ignore_errors=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, n, instrs in (('asm/generated', lines, ASM_INSTRS), ('asm/dense', ASM_INSTRS, ASM_INSTRS)):
+            path = os.path.join(tmp, name.replace('/', '_') + '.asm')
+            with open(path, 'w') as f: f.writelines(asm_source(n, instrs))
+            best = None
+            for _ in range(repeats):
+                cold()
+                t0 = time.perf_counter()
+                Assembler.build(path)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            cold()
+            tracemalloc.start()
+            Assembler.build(path)
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+            out.append((name, n + 1, best, peak))
+    return out
+
+
+def run_suite(engine='run', count=200_000, repeats=5, only=None, out=sys.stdout, devices=False):
+    results = {}
+    benches = {**kernels(devices), **programs()}
+    for name, (code, extra) in benches.items():
+        if only and only not in name: continue
+        ips, cps = measure(code, extra, engine, count, repeats, devices)
+        results[name] = {'ips': ips, 'cps': cps, 'x1mhz': cps / 1e6}
+        print(f"{name:28s} {ips / 1e3:9.1f} kIPS  {cps / 1e6:7.3f} Mcyc/s  x{cps / 1e6:5.2f} 1MHz",
+              file=out, flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    # names whose instrs/sec fell more than threshold below baseline
+    slower = []
+    for name, base in baseline.items():
+        cur = results.get(name)
+        if cur is None: continue
+        if cur['ips'] < base['ips'] * (1 - threshold):
+            slower.append((name, base['ips'], cur['ips']))
+    return slower
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="6502 emulator throughput benchmarks")
+    ap.add_argument('--engine', choices=('run', 'step', 'jit', 'aot'), default='run')
+    ap.add_argument('--count', type=int, default=200_000, help="instructions per benchmark")
+    ap.add_argument('--repeats', type=int, default=5, help="best of N")
+    ap.add_argument('--only', help="run benchmarks whose name contains this")
+    ap.add_argument('--devices', action='store_true', help="map the reference devices, add the io kernel")
+    ap.add_argument('--irq', action='store_true', help="timer IRQ overhead vs idle device count")
+    ap.add_argument('--asm', type=int, nargs='?', const=1_000_000, metavar='N',
+                    help="assembler time/memory on a generated N-line source (default 1M)")
+    ap.add_argument('--json', help="write results here")
+    ap.add_argument('--baseline', help="compare against a previous --json file")
+    ap.add_argument('--threshold', type=float, default=0.10,
+                    help="allowed instrs/sec drop vs baseline (0.10 = 10%%)")
+    args = ap.parse_args(argv)
+
+    if args.irq:
+        for idle in (0, 16, 64, 200):
+            ips, fired, on_time = irq_bench(idle, args.engine, args.count, args.repeats)
+            print(f"irq idle={idle:<4d} {ips / 1e3:9.1f} kIPS  {fired:7d} IRQs  "
+                  f"{'on time' if on_time else 'LATE'}", flush=True)
+        return 0
+
+    if args.asm:
+        over = False
+        for name, lines, elapsed, peak in asm_bench(args.asm, min(args.repeats, 3)):
+            scale = max(1, lines / 1e6)
+            ok = elapsed <= ASM_BUDGET_S * scale and peak <= ASM_BUDGET_MB * scale
+            over |= not ok
+            print(f"{name:16s} {lines:9d} lines {elapsed:7.3f} s {lines / elapsed / 1e3:8.0f} klines/s "
+                  f"{peak:6.1f} MB  {'ok' if ok else 'OVER BUDGET'}", flush=True)
+        return 1 if over else 0
+
+    results = run_suite(args.engine, args.count, args.repeats, args.only, devices=args.devices)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'engine': args.engine, 'count': args.count, 'devices': args.devices,
+                       'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)['results']
+        slower = compare(results, baseline, args.threshold)
+        for name, was, now in slower:
+            print(f"REGRESSION {name}: {was / 1e3:.1f} -> {now / 1e3:.1f} kIPS "
+                  f"({(now / was - 1) * 100:+.1f}%)")
+        if slower: return 1
+        print(f"no regressions beyond {args.threshold:.0%} vs {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
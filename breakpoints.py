@@ -0,0 +1,150 @@
+"""
+6502 breakpoints and watchpoints
+
+PC breakpoints live in a 64 KiB bitmap the cpu checks in run() (a
+separate loop is used only while at least one is set, see CPU.breaks).
+Read/write watchpoints are two more bitmaps; while any is set the memory
+operand handlers (zpg, zpx, abs; not the stack) are wrapped to look the
+address up and raise Stop('watch') after the access, with the details in
+Breakpoints.hit. With nothing watched the plain handler table is used.
+
+The watch wrappers are the top CPU.wrap_ops layer, so the recorder and
+profiler below still count an access that stops the run.
+"""
+
+from cpu import MODE_LEN, OPCODES, UNKNOWN, Stop
+
+_STORES = ('STA', 'STX', 'STY')
+# the register holding the value moved, for loads and stores: the same
+# as memory for RAM, the only record of it on a device page
+_MOVED = {'LDA': 'a', 'LDX': 'x', 'LDY': 'y', 'STA': 'a', 'STX': 'x', 'STY': 'y'}
+_NOT_MEM = ('JMP', 'JSR')
+
+
+class Breakpoints:
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.pcs = bytearray(65536)
+        self.reads = bytearray(65536)
+        self.writes = bytearray(65536)
+        self.addrs = set()      # breakpoint addrs, for listing
+        self.watched = 0        # bits set in reads + writes
+        self.hit = None         # (pc, addr, value, 'r'|'w') of the last watch stop
+        self.active = False
+
+    # ---------------------------------------------
+    # PC breakpoints
+    # ---------------------------------------------
+    def add(self, addr):
+        addr &= 0xFFFF
+        self.pcs[addr] = 1
+        self.addrs.add(addr)
+        self.cpu.breaks = self.pcs
+
+    def remove(self, addr):
+        addr &= 0xFFFF
+        self.pcs[addr] = 0
+        self.addrs.discard(addr)
+        if not self.addrs: self.cpu.breaks = None
+
+    def toggle(self, addr):
+        # -> True if a breakpoint is now set at addr
+        if (addr & 0xFFFF) in self.addrs:
+            self.remove(addr)
+            return False
+        self.add(addr)
+        return True
+
+    # ---------------------------------------------
+    # watchpoints
+    # ---------------------------------------------
+    def watch(self, lo, hi=None, read=False, write=True):
+        # watch [lo, hi] (inclusive, default just lo)
+        hi = lo if hi is None else hi
+        for addr in range(lo, hi + 1):
+            if read: self.reads[addr] = 1
+            if write: self.writes[addr] = 1
+        self._recount()
+
+    def unwatch(self, lo, hi=None):
+        hi = lo if hi is None else hi
+        n = hi + 1 - lo
+        self.reads[lo:hi + 1] = bytes(n)
+        self.writes[lo:hi + 1] = bytes(n)
+        self._recount()
+
+    def _recount(self):
+        self.watched = self.reads.count(1) + self.writes.count(1)
+        if self.watched and not self.active: self.start()
+        elif not self.watched and self.active: self.stop()
+
+    def start(self):
+        # wrap the memory operand handlers, only if something is watched
+        if self.active or not self.watched: return
+        self.cpu.wrap_ops('watch', self._watched, 2)
+        self.active = True
+
+    def stop(self):
+        if not self.active: return
+        self.cpu.wrap_ops('watch', None)
+        self.active = False
+
+    def _watched(self, op, fn):
+        mnem, mode, _ = OPCODES.get(op, UNKNOWN)
+        if mode not in ('zpg', 'zpx', 'abs') or mnem in _NOT_MEM: return fn
+        size = 1 + MODE_LEN[mode]
+        kind = 'w' if mnem in _STORES else 'r'
+        bitmap = self.writes if kind == 'w' else self.reads
+        reg = _MOVED.get(mnem)
+        zpx = mode == 'zpx'
+        bps = self
+
+        def watched(cpu, operand):
+            addr = (operand + cpu.x) & 0xFF if zpx else operand
+            # a device access may end the slice for an event it scheduled,
+            # the watch still has to see it
+            stop = None
+            try: fn(cpu, operand)
+            except Stop as e: stop = e
+            if bitmap[addr]:
+                val = cpu.memory[addr] if reg is None else getattr(cpu, reg)
+                bps.hit = ((cpu.pc - size) & 0xFFFF, addr, val, kind)
+                raise Stop('watch')
+            if stop is not None: raise stop
+        return watched
+
+    def describe(self, result):
+        # one line for a run() that stopped on a breakpoint or watchpoint
+        if result.reason == 'break':
+            return f"BREAK at ${self.cpu.pc:04X}"
+        if result.reason == 'watch':
+            pc, addr, val, kind = self.hit
+            what = 'write' if kind == 'w' else 'read'
+            return f"WATCH {what} ${addr:04X}=${val:02X} by ${pc:04X}"
+        return ""
+
+
+def resolve(spec, addr_line, labels):
+    # address for a breakpoint spec: '$0230' / '0x230' (address), '23'
+    # (source line, the first instr at or after it) or a label name
+    spec = spec.strip()
+    if spec.startswith('$'): return int(spec[1:], 16)
+    if spec.lower().startswith('0x'): return int(spec, 16)
+    if spec.isdigit():
+        ln = int(spec) - 1
+        after = [(line, addr) for addr, line in addr_line.items() if line >= ln]
+        if not after: raise ValueError(f"no code at or after line {spec}")
+        return min(after)[1]
+    name = spec.upper().rstrip(':')
+    if name not in labels: raise ValueError(f"unknown label {spec!r}")
+    return labels[name]
+
+
+def parse_range(spec):
+    # '$10' or '$10..$17' -> (lo, hi)
+    lo, _, hi = spec.partition('..')
+    lo = int(lo.strip().lstrip('$'), 16)
+    hi = int(hi.strip().lstrip('$'), 16) if hi else lo
+    if not 0 <= lo <= hi <= 0xFFFF: raise ValueError(f"bad range {spec!r}")
+    return lo, hi
@@ -0,0 +1,244 @@
+"""
+6502 debug client
+
+Client talks to server.py: await Client.connect(...) then
+await client.call('run', until='done') returns the reply fields, or
+raises RemoteError with the server's message. Calls may overlap; replies
+are matched by id.
+
+From the command line it loads a program, sets breakpoints, runs and
+prints where it stopped plus any memory asked for. --load-test N starts
+N concurrent sessions instead (against a server started in this process
+unless --host/--port/--unix is given), each loading tests/bub.asm,
+sending a malformed request, breaking, poking its own input,
+snapshotting, running to BRK, restoring and checking the sort, plus one
+running into an idle loop, while --busy machines run an endless loop
+alongside; it reports request latencies, which stay small only if no
+machine stalls the others.
+
+Usage: python client.py [--host H] [--port N | --unix PATH] <filename.asm> [--break SPEC]... [--until SPEC] [--read $10..$17]
+       python client.py [--host H] [--port N | --unix PATH] --load-test N [--busy M]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+from breakpoints import parse_range
+from server import LINE_LIMIT, PORT, Server, serve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class RemoteError(Exception):
+    # the server answered ok: false
+    pass
+
+
+class Client:
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._task = asyncio.create_task(self._read())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=PORT, unix=None):
+        if unix: reader, writer = await asyncio.open_unix_connection(unix, limit=LINE_LIMIT)
+        else: reader, writer = await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+        return cls(reader, writer)
+
+    async def call(self, cmd, **args):
+        # -> reply fields (without id/ok)
+        rid = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = fut
+        self.writer.write(json.dumps({'id': rid, 'cmd': cmd, **args}).encode() + b'\n')
+        await self.writer.drain()
+        msg = await fut
+        if not msg.pop('ok'): raise RemoteError(msg['error'])
+        del msg['id']
+        return msg
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line: break
+                msg = json.loads(line)
+                fut = self._pending.pop(msg.get('id'), None)
+                if fut is not None and not fut.done(): fut.set_result(msg)
+        finally:
+            for fut in self._pending.values():
+                if not fut.done(): fut.set_exception(ConnectionError("server closed the connection"))
+            self._pending.clear()
+
+    async def close(self):
+        self.writer.close()
+        self._task.cancel()
+        try: await self.writer.wait_closed()
+        except ConnectionError: pass
+
+
+def _show_regs(regs):
+    line = f"  line {regs['line']}" if 'line' in regs else ""
+    return (f"PC=${regs['pc']:04X} A=${regs['a']:02X} X=${regs['x']:02X} Y=${regs['y']:02X} "
+            f"SP=${regs['sp']:02X} P=${regs['p']:02X}  {regs['steps']} steps {regs['cycles']} cycles{line}")
+
+
+async def session(args):
+    c = await Client.connect(args.host, args.port, args.unix)
+    try:
+        with open(args.filename) as f: source = f.read()
+        prog = await c.call('load', source=source)
+        print(f"{args.filename}: machine {prog['machine']}, {prog['size']} bytes at ${prog['origin']:04X}")
+        for spec in args.breaks:
+            await c.call('break', at=spec)
+        result = await c.call('run', until=args.until, max_steps=args.max_steps)
+        print(f"{result['reason']}: {result['steps']} steps {result['cycles']} cycles"
+              f"{'  ' + result['stop'] if 'stop' in result else ''}")
+        print(_show_regs(result['regs']))
+        for spec in args.read:
+            lo, hi = parse_range(spec)
+            data = bytes.fromhex((await c.call('read', addr=lo, len=hi + 1 - lo))['data'])
+            print(f"${lo:04X}..${hi:04X} = {data.hex(' ').upper()}")
+        out = (await c.call('output'))['out']
+        if out: print(f"out: {out!r}")
+    except RemoteError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        await c.close()
+    return 0
+
+
+# ---------------------------------------------
+# load test
+# ---------------------------------------------
+async def _timed(c, lat, cmd, **args):
+    t0 = time.perf_counter()
+    out = await c.call(cmd, **args)
+    lat.append(time.perf_counter() - t0)
+    return out
+
+
+async def _bub_session(addr, source, n, lat):
+    # one debugger session; raises AssertionError on a wrong answer
+    c = await Client.connect(*addr)
+    try:
+        await _timed(c, lat, 'load', source=source)
+        # a bad request gets an error back, not a hang
+        try: await _timed(c, lat, 'step', count=1e999)
+        except RemoteError: pass
+        else: raise AssertionError("step count=1e999 accepted")
+        await _timed(c, lat, 'break', at='outer_loop')
+        stop = await _timed(c, lat, 'run')
+        assert stop['reason'] == 'break', stop
+        # this session's own input over the array the program set up
+        values = random.Random(n).sample(range(256), 8)
+        await _timed(c, lat, 'write', addr='$10', data=bytes(values).hex())
+        snap = (await _timed(c, lat, 'snapshot'))['snap']
+        await _timed(c, lat, 'break', at='outer_loop', remove=True)
+        done = await _timed(c, lat, 'run')
+        assert done['reason'] == 'brk', done
+        got = bytes.fromhex((await _timed(c, lat, 'read', addr=0x10, len=8))['data'])
+        assert list(got) == sorted(values), (got, values)
+        # again from the snapshot, a few steps by hand then run to the label
+        regs = (await _timed(c, lat, 'restore', snap=snap))['regs']
+        stepped = await _timed(c, lat, 'step', count=10)
+        assert stepped['regs']['steps'] == regs['steps'] + 10, stepped
+        done = await _timed(c, lat, 'run', until='done')
+        assert done['reason'] == 'pc', done
+        got = bytes.fromhex((await _timed(c, lat, 'read', addr='$10', len=8))['data'])
+        assert list(got) == sorted(values), (got, values)
+        await _timed(c, lat, 'drop')
+    finally:
+        await c.close()
+
+
+async def _idle_session(addr, lat):
+    # an unlimited run into a busy-wait nothing can wake returns 'idle'
+    c = await Client.connect(*addr)
+    try:
+        await _timed(c, lat, 'load', source="    LDA #$05\n    STA $20\nspin:\n    LDA $20\n    BNE spin\n    BRK\n")
+        done = await _timed(c, lat, 'run')
+        assert done['reason'] == 'idle' and done['skipped'], done
+        await _timed(c, lat, 'drop')
+    finally:
+        await c.close()
+
+
+async def _busy(addr):
+    # a machine spinning forever until told to stop
+    c = await Client.connect(*addr)
+    await c.call('load', source="spin:\n    INX\n    JMP spin\n")
+    return c, asyncio.create_task(c.call('run'))
+
+
+async def load_test(args):
+    local = None
+    addr = (args.host, args.port, args.unix)
+    if not (args.unix or args.port_given):
+        local = await serve(Server(), args.host, 0)
+        addr = (args.host, local.sockets[0].getsockname()[1], None)
+    with open(os.path.join(HERE, 'tests', 'bub.asm')) as f: source = f.read()
+
+    busy = [await _busy(addr) for _ in range(args.busy)]
+    lat = []
+    t0 = time.perf_counter()
+    sessions = [_bub_session(addr, source, n, lat) for n in range(args.load_test)]
+    # the idle check runs alongside but isn't one of the N sessions
+    *results, idle = await asyncio.gather(*sessions, _idle_session(addr, lat), return_exceptions=True)
+    wall = time.perf_counter() - t0
+
+    spun = 0
+    for c, task in busy:
+        await c.call('stop')
+        spun += (await task)['steps']
+        await c.close()
+    if local is not None:
+        local.close()
+        await local.wait_closed()
+
+    failed = [r for r in results if isinstance(r, BaseException)]
+    lat.sort()
+    pct = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1e3 if lat else 0.0
+    print(f"{len(results)} sessions ({args.busy} busy machines alongside) in {wall:.2f} s: "
+          f"{len(results) - len(failed)} ok, {len(failed)} failed; idle run "
+          f"{'ok' if idle is None else 'failed'}")
+    print(f"{len(lat)} requests, {len(lat) / wall:.0f}/s, latency p50 {pct(0.5):.2f} ms  "
+          f"p99 {pct(0.99):.2f} ms  max {pct(1.0):.2f} ms; busy machines ran {spun} steps")
+    if idle is not None: failed.insert(0, idle)
+    for r in failed[:5]: print(f"  {type(r).__name__}: {r}")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="drive a 6502 debug server")
+    ap.add_argument('filename', nargs='?')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=None)
+    ap.add_argument('--unix', help="connect to this Unix socket instead of TCP")
+    ap.add_argument('--break', dest='breaks', action='append', default=[], help="breakpoint spec (repeatable)")
+    ap.add_argument('--until', help="run until this $addr, source line or label")
+    ap.add_argument('--max-steps', type=int, default=1_000_000)
+    ap.add_argument('--read', action='append', default=[], help="print memory $lo..$hi after the run")
+    ap.add_argument('--load-test', type=int, metavar='N', help="N concurrent sessions instead")
+    ap.add_argument('--busy', type=int, default=4, help="endless machines alongside the load test")
+    args = ap.parse_args(argv)
+    args.port_given = args.port is not None
+    if args.port is None: args.port = PORT
+
+    if args.load_test: return asyncio.run(load_test(args))
+    if not args.filename: ap.error("a program to load, or --load-test N")
+    return asyncio.run(session(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
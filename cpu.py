@@ -2,48 +2,571 @@
 6502 CPU emulator
 """
 
+import heapq
+import struct
+from collections import namedtuple
+from itertools import count
+
+# why run() returned ('brk', 'steps', 'cycles', 'pc', 'break', 'idle',
+# 'halted' or a Stop reason), how many steps/cycles that call executed and
+# how many of those cycles an idle loop fast-forwarded (see CPU.idle)
+RunResult = namedtuple('RunResult', 'reason steps cycles skipped', defaults=(0,))
+
+# full machine state from CPU.snapshot(); pages is a tuple of 256 bytes
+# objects (one per 256-byte page) shared between snapshots when unchanged
+Snapshot = namedtuple('Snapshot', 'a x y pc sp nz v c i cycles steps running pages')
+
+# CPU.to_bytes() header, little endian: magic, version, A X Y SP P, PC,
+# running, cycles, steps, skipped; the 64K of memory follows it
+STATE = struct.Struct('<4sHBBBBBH?QQQ')
+STATE_MAGIC = b'6502'
+STATE_VERSION = 1
+
+# operand bytes following the opcode, per addressing mode
+MODE_LEN = {'imp': 0, 'imm': 1, 'zpg': 1, 'zpx': 1, 'abs': 2, 'rel': 1}
+
+# decode info for opcodes without a handler (run as a 1-byte NOP)
+UNKNOWN = ('???', 'imp', 2)
+
+# _nz value for [N][Z]
+_NZ = ((0x01, 0x00), (0x80, 0x100))
+
+NMI_VECTOR = 0xFFFA
+IRQ_VECTOR = 0xFFFE
+INTERRUPT_CYCLES = 7
+
+# busy-wait loops: a backward branch/JMP at most IDLE_SPAN bytes back over
+# straight-line code made only of these (RAM operands) can't change
+# anything an iteration depends on, once the registers at its head repeat
+# it spins unchanged until an event
+IDLE_OPS = {'LDA', 'LDX', 'LDY', 'CMP', 'CPX', 'CPY', 'AND', 'ORA',
+            'CLC', 'SEC', 'SEI', 'TAX', 'TAY', 'TXA', 'TYA', 'NOP'}
+IDLE_SPAN = 16
+
+# opcode -> handler(cpu, operand) / (mnemonic, mode, base cycles), filled
+# by @opcode while the class body runs. decode() resolves the operand
+# before the handler is called: the byte for imm, the address for zpg and
+# abs, the zero-page base for zpx and (target, taken cycles) for rel
+_HANDLERS = {}
+OPCODES = {}
+
+# opcode -> handler for the same instr with its operand on a device page
+# (see CPU.map), filled by @io_opcode
+_IO_HANDLERS = {}
+
+
+class Stop(Exception):
+    # raised by a wrapped handler (see set_ops) to end run() once the
+    # current instruction is done, args[0] is the reason run() returns
+    pass
+
+
+def opcode(code, mnem, mode, cycles):
+    # register a handler for one opcode byte
+    def deco(fn):
+        _HANDLERS[code] = fn
+        OPCODES[code] = (mnem, mode, cycles)
+        return fn
+    return deco
+
+
+def io_opcode(code):
+    # register the device-page variant of an abs-mode opcode
+    def deco(fn):
+        _IO_HANDLERS[code] = fn
+        return fn
+    return deco
+
 
 class CPU:
-    def __init__(self):
+
+    # bit order of reg_changes()
+    REGS = ('a', 'x', 'y', 'sp', 'pc', 'flag_n', 'flag_v', 'flag_z', 'flag_c', 'flag_i')
+
+    # no per-instance __dict__: every attribute is a fixed slot, which is
+    # what the handlers' self.x loads and stores hit
+    __slots__ = ('a', 'x', 'y', 'pc', 'sp', '_nz', 'flag_v', 'flag_c', 'flag_i',
+                 'memory', 'cycles', 'steps', 'running',
+                 '_decoded', '_code', 'jit', 'dirty_rows', '_seen', '_layers', 'ops',
+                 'devices', 'events', '_seq', 'irqs', '_horizon',
+                 'idle', 'skipped', 'skipped_steps', '_wakes', '_idle', 'breaks', '_base')
+
+    def __init__(self, memory=None):
+        # memory: a 64K writable buffer to run on (an mmap'd file, see
+        # statefile.py) instead of a fresh bytearray, contents kept
+        if memory is None: memory = bytearray(65536)
+        elif len(memory) != 65536: raise ValueError("memory must be 65536 bytes")
         self.a  = 0
         self.x  = 0
         self.y  = 0
         self.pc = 0
         self.sp = 0xFF
 
-        self.flag_n = 0  # negative
+        self._nz    = 1  # last result byte, N/Z derived on read (see flag_n)
         self.flag_v = 0  # overflow
-        self.flag_z = 0  # zero
         self.flag_c = 0  # carry
+        self.flag_i = 1  # irq disable, set on reset like the real chip
 
-        self.memory  = bytearray(65536)
+        self.memory  = memory
         self.cycles  = 0
         self.steps   = 0
         self.running = True
 
+        # per-address decode cache (see decode()) and the bytes that
+        # cached/translated code depends on; a store to one of them goes
+        # through _smc() so stale entries get dropped
+        self._decoded = [None] * 65536
+        self._code    = bytearray(65536)
+        self.jit      = None
+
+        # set per 16-byte row on every store; readers (the debugger) clear
+        # the rows they have consumed. see also reg_changes()
+        self.dirty_rows = bytearray(4096)
+        self._seen = None
+
+        # wrap_ops() layers, key -> (order, wrap), and the handler table
+        # they make (CPU.OPS when there are none, see set_ops())
+        self._layers = {}
+        self.ops = CPU.OPS
+
+        # page table: None for RAM, else the device mapped there (see map())
+        self.devices = [None] * 256
+
+        # scheduled events, a heap of [cycle, seq, fn] (see schedule()),
+        # and the devices holding the IRQ line low
+        self.events = []
+        self._seq = count()
+        self.irqs = set()
+        self._horizon = float('inf')    # cycle limit of run()'s current slice
+
+        # what run() does with a busy-wait loop (see IDLE_OPS): None runs
+        # it, 'stop' returns 'idle', 'skip' fast-forwards whole passes up
+        # to the next event or limit ('idle' when there is neither).
+        # skipped counts the cycles fast-forwarded, skipped_steps the
+        # steps, _wakes anything that may have changed state from outside
+        # the loop (events, interrupts, memory reloads)
+        self.idle = 'skip'
+        self.skipped = 0
+        self.skipped_steps = 0
+        self._wakes = 0
+        self._idle = None               # loop of the last Stop('idle')
+
+        # PC breakpoint bitmap (bytearray(65536)) while any are set, run()
+        # stops before executing a marked addr. None keeps run() on the
+        # loop without the lookup
+        self.breaks = None
+
+        # pages + flat image of the last snapshot()/restore(), which the
+        # next snapshot shares unchanged pages with
+        self._base = (_ZERO_PAGES, bytes(65536))
+
     def reset(self):
         self.a      = 0
         self.x      = 0
         self.y      = 0
         self.pc     = 0
         self.sp  = 0xFF
-        self.flag_n = 0
+        self._nz    = 1
         self.flag_v = 0
-        self.flag_z = 0
         self.flag_c = 0
+        self.flag_i = 1
         self.cycles = 0
         self.steps  = 0
         self.running = True
+        self.skipped = 0
+        self.skipped_steps = 0
+        self._wakes += 1
+
+    # N and Z are not stored: handlers keep the last result byte in _nz
+    # and the flags are derived only when something reads them. 0x100
+    # stands for the one combo a byte can't encode (N=1, Z=1).
+    @property
+    def flag_n(self): return 1 if self._nz & 0x180 else 0
+
+    @flag_n.setter
+    def flag_n(self, val): self._nz = _NZ[bool(val)][self.flag_z]
+
+    @property
+    def flag_z(self): return 0 if self._nz & 0xFF else 1
+
+    @flag_z.setter
+    def flag_z(self, val): self._nz = _NZ[self.flag_n][bool(val)]
 
     def set_nz(self, val):
         # update neg && zero flags
-        val &= 0xFF
-        self.flag_z = 1 if val == 0 else 0
-        self.flag_n = 1 if val & 0x80 else 0
+        self._nz = val & 0xFF
+
+    # the status register packed like the chip's P, N V - B D I Z C: bit 5
+    # reads 1, B 0 (it only exists in the copy PHP/BRK push), D 0 (no
+    # decimal mode). writing it sets N V I Z C
+    @property
+    def p(self): return self._status()
+
+    @p.setter
+    def p(self, val): self._set_status(val)
+
+    def flush(self):
+        # drop cached decodes/translations, call after writing self.memory
+        # directly
+        self._decoded[:] = _BLANK
+        self._code[:] = bytes(65536)
+        self.dirty_rows[:] = b'\x01' * 4096
+        self._wakes += 1
+        if self.jit is not None: self.jit.flush()
+
+    def load(self, code, addr=0x0200):
+        # copy a program into memory and point PC/SP at it
+        code = bytes(code)
+        self.memory[addr:addr + len(code)] = code
+        self._forget(addr, addr + len(code))
+        self.pc = addr
+        self.sp = 0xFF
+
+    def _forget(self, lo, hi):
+        # memory in [lo, hi) was replaced wholesale, not through a store
+        self.dirty_rows[lo >> 4:(hi + 15) >> 4] = b'\x01' * (((hi + 15) >> 4) - (lo >> 4))
+        self._wakes += 1
+        start = max(lo - 2, 0)
+        if self._code.find(1, start, hi) < 0: return
+        self._decoded[start:hi] = _BLANK[start:hi]
+        self._code[lo:hi] = bytes(hi - lo)
+        self._drop_edges(lo, hi)
+        if self.jit is not None: self.jit.invalidate(lo, hi)
+
+    def snapshot(self):
+        # registers, counters and memory; only pages that differ from the
+        # last snapshot/restore are copied, the rest are shared
+        pages, image = self._base
+        changed = _diff_pages(self.memory, memoryview(image), 0, 65536, [])
+        if changed:
+            pages = list(pages)
+            view = memoryview(self.memory)
+            for page in changed:
+                pages[page] = bytes(view[page << 8:(page + 1) << 8])
+            pages = tuple(pages)
+            self._base = (pages, bytes(self.memory))
+        return Snapshot(self.a, self.x, self.y, self.pc, self.sp,
+                        self._nz, self.flag_v, self.flag_c, self.flag_i,
+                        self.cycles, self.steps, self.running, pages)
+
+    def restore(self, snap):
+        # back to a snapshot(), rewriting only the pages that differ
+        pages, image = self._base
+        if pages is not snap.pages:
+            pages = snap.pages
+            image = b''.join(pages)
+        mem = self.memory
+        for page in _diff_pages(mem, memoryview(image), 0, 65536, []):
+            lo = page << 8
+            mem[lo:lo + 256] = pages[page]
+            self._forget(lo, lo + 256)
+        self._base = (pages, image)
+
+        self.a, self.x, self.y, self.pc, self.sp = snap.a, snap.x, snap.y, snap.pc, snap.sp
+        self._nz, self.flag_v, self.flag_c, self.flag_i = snap.nz, snap.v, snap.c, snap.i
+        self.cycles, self.steps, self.running = snap.cycles, snap.steps, snap.running
+        self._wakes += 1
+
+    def device_state(self):
+        # what snapshot() leaves out: every mapped device's state() and
+        # the sources holding the IRQ line, for set_device_state()
+        devs = {id(dev): dev for dev in self.devices if dev is not None}.values()
+        return tuple((dev, dev.state()) for dev in devs), frozenset(self.irqs)
+
+    def set_device_state(self, state):
+        # back to a device_state(), after restore() has put the cycle count
+        # back. devices re-schedule their own events; anything else on the
+        # event heap is left as it is. the IRQ line is not polled here
+        devs, irqs = state
+        for dev, dev_state in devs: dev.set_state(dev_state)
+        self.irqs = set(irqs)
+        self._wakes += 1
+
+    def to_bytes(self):
+        # registers and counters in the STATE layout, memory appended:
+        # one copy of the 64K, no per-object pickling. devices, events,
+        # breakpoints and handler layers are not part of it. the copy is
+        # the point: the bytes have to stay as they are while memory goes
+        # on changing. to_buffer() writes the same into a buffer of the
+        # caller's (an mmap, a reused bytearray) with nothing in between
+        return b''.join((self._header(), self.memory))
+
+    def to_buffer(self, out, offset=0):
+        # to_bytes() written into the writable buffer out at offset, the
+        # 64K copied straight across from memory
+        view = memoryview(out)
+        lo = offset + STATE.size
+        view[offset:lo] = self._header()
+        view[lo:lo + 65536] = self.memory
+
+    def from_bytes(self, data):
+        # back to the state to_bytes() returned (any buffer, read in
+        # place), rewriting only the pages that differ -> self
+        view = memoryview(data)
+        if len(view) != STATE.size + 65536: raise ValueError("not a cpu state")
+        self._set_header(view)
+        image = view[STATE.size:]
+        mem = self.memory
+        for page in _diff_pages(mem, image, 0, 65536, []):
+            lo = page << 8
+            mem[lo:lo + 256] = image[lo:lo + 256]
+            self._forget(lo, lo + 256)
+        return self
+
+    def _header(self):
+        # registers and counters packed as STATE
+        return STATE.pack(STATE_MAGIC, STATE_VERSION, self.a, self.x, self.y, self.sp,
+                          self._status(), self.pc, self.running,
+                          self.cycles, self.steps, self.skipped)
+
+    def _set_header(self, buf, offset=0):
+        # registers and counters from a STATE header, ValueError if it
+        # isn't one
+        magic, version, a, x, y, sp, p, pc, running, cycles, steps, skipped = STATE.unpack_from(buf, offset)
+        if magic != STATE_MAGIC or version != STATE_VERSION:
+            raise ValueError(f"not a version {STATE_VERSION} cpu state")
+        self.a, self.x, self.y, self.sp, self.pc = a, x, y, sp, pc
+        self._set_status(p)
+        self.running = bool(running)
+        self.cycles, self.steps, self.skipped = cycles, steps, skipped
+        self._wakes += 1
+
+    def reg_changes(self):
+        # bitmask (bit i -> REGS[i]) of registers that changed since the
+        # last call, all set on the first one
+        now = (self.a, self.x, self.y, self.sp, self.pc,
+               self.flag_n, self.flag_v, self.flag_z, self.flag_c, self.flag_i)
+        seen, self._seen = self._seen, now
+        if seen is None: return (1 << len(now)) - 1
+        mask = 0
+        for i in range(len(now)):
+            if seen[i] != now[i]: mask |= 1 << i
+        return mask
+
+    def _smc(self, addr):
+        # self-modifying code: a store hit a byte that was decoded
+        self._code[addr] = 0
+        decoded = self._decoded
+        for back in (0, 1, 2):
+            start = (addr - back) & 0xFFFF
+            entry = decoded[start]
+            if entry is not None and back < entry[2]:
+                decoded[start] = None
+        self._drop_edges(addr, addr + 1)
+        if self.jit is not None: self.jit.invalidate(addr)
+
+    def _drop_edges(self, lo, hi):
+        # an idle loop's back edge carries the pass length and cycles of
+        # the body it was decoded over, drop any whose body meets [lo, hi)
+        decoded = self._decoded
+        for pc in range(lo, min(hi + IDLE_SPAN, 65536)):
+            entry = decoded[pc]
+            if entry is None: continue
+            loop = getattr(entry[0], 'loop', None)
+            if loop is not None and loop[0] < hi and lo < loop[1]:
+                decoded[pc] = None
+                if self.jit is not None: self.jit.invalidate(loop[0], loop[1])
+
+    def map(self, page, device):
+        # attach a device to a 256-byte page (None detaches): abs loads
+        # and stores there call device.read(addr) / device.write(addr,
+        # val) instead of touching memory. the page is picked when an
+        # instr is decoded, RAM accesses never look at the table. zero
+        # page and the stack (zpg/zpx/stack ops) are always RAM
+        if not 2 <= page <= 0xFF:
+            raise ValueError(f"page ${page:02X}: zero page and stack can't hold devices")
+        self.devices[page] = device
+        self.flush()
+
+    # ---------------------------------------------
+    # events and interrupts
+    # ---------------------------------------------
+    def schedule(self, cycle, fn):
+        # call fn(cycle) at the first instr boundary where self.cycles >=
+        # cycle. run() executes uninterrupted up to the earliest deadline,
+        # so idle devices (nothing scheduled) cost nothing. -> handle for
+        # cancel()
+        event = [cycle, next(self._seq), fn]
+        heapq.heappush(self.events, event)
+        return event
+
+    def cancel(self, event):
+        event[2] = None
+
+    def _service(self):
+        # fire every event due by now, earliest first
+        events = self.events
+        while events and events[0][0] <= self.cycles:
+            cycle, _, fn = heapq.heappop(events)
+            if fn is not None:
+                self._wakes += 1
+                fn(cycle)
+
+    def interrupt(self, vector, brk=0):
+        # push PC and status, mask IRQs, jump through the vector
+        pc = self.pc
+        self.push(pc >> 8)
+        self.push(pc & 0xFF)
+        self.push(self._status(brk))
+        self.flag_i = 1
+        mem = self.memory
+        self.pc = mem[vector] | (mem[vector + 1] << 8)
+        self.cycles += INTERRUPT_CYCLES
+        self._wakes += 1
+
+    def nmi(self):
+        # edge triggered, taken now whatever I says
+        self.interrupt(NMI_VECTOR)
+
+    def set_irq(self, source, level=True):
+        # level triggered: the line is low while any source holds it,
+        # taken once I is clear
+        if level: self.irqs.add(source)
+        else: self.irqs.discard(source)
+        self._poll_irq()
+
+    def _poll_irq(self):
+        if self.irqs and not self.flag_i: self.interrupt(IRQ_VECTOR)
+
+    def _status(self, brk=0):
+        # N V 1 B D I Z C as pushed on the stack (D is always 0 here)
+        return ((self.flag_n << 7) | (self.flag_v << 6) | 0x20 | (brk << 4)
+                | (self.flag_i << 2) | (self.flag_z << 1) | self.flag_c)
+
+    def _set_status(self, val):
+        self._nz = _NZ[(val >> 7) & 1][(val >> 1) & 1]
+        self.flag_v = (val >> 6) & 1
+        self.flag_i = (val >> 2) & 1
+        self.flag_c = val & 1
+
+    def set_ops(self, ops=None):
+        # swap in another handler table (profiling, tracing),
+        # None goes back to the plain CPU.OPS. cached decodes hold the old
+        # handlers so they are dropped
+        self.ops = CPU.OPS if ops is None or ops is CPU.OPS else tuple(ops)
+        self._decoded[:] = _BLANK
+
+    def wrap_ops(self, key, wrap=None, order=0):
+        # add (or with wrap=None remove) a handler layer: wrap(op, fn)
+        # returns the handler to use instead of fn. layers are applied
+        # over CPU.OPS lowest order first, so toggling one keeps the
+        # others and their stacking intact
+        if wrap is None: self._layers.pop(key, None)
+        else: self._layers[key] = (order, wrap)
+        ops = CPU.OPS
+        for _, k in sorted((o, k) for k, (o, _) in self._layers.items()):
+            wrap = self._layers[k][1]
+            ops = [wrap(op & 0xFF, fn) for op, fn in enumerate(ops)]
+        self.set_ops(ops)
+
+    def decode(self, pc):
+        # (handler, operand, size, cycles, opcode) for the instr at pc,
+        # decoded on first use and cached until that memory is written
+        entry = self._decoded[pc]
+        if entry is not None: return entry
+
+        mem = self.memory
+        op = mem[pc]
+        mnem, mode, cycles = OPCODES.get(op, UNKNOWN)
+        size = 1 + MODE_LEN[mode]
+        lo = mem[(pc + 1) & 0xFFFF]
+
+        if   size == 1:     operand = None
+        elif mode == 'abs': operand = lo | (mem[(pc + 2) & 0xFFFF] << 8)
+        elif mode == 'rel':
+            after = (pc + 2) & 0xFFFF
+            # offset := signd byte
+            target = (after + (lo - 256 if lo >= 128 else lo)) & 0xFFFF
+            # +1 when taken, +1 more when that crosses a page
+            operand = (target, 2 if (after ^ target) > 0xFF else 1)
+        else:               operand = lo
+
+        # device page operands use the I/O slot of the table
+        slot = op
+        if mode == 'abs' and self.devices[operand >> 8] is not None: slot |= 0x100
+
+        fn = self.ops[slot]
+        if (mode == 'rel' or op == 0x4C) and fn is _HANDLERS[op]:
+            # backward branch/JMP closing a busy-wait loop: checked per pass
+            back, taken = operand if mode == 'rel' else (operand, 0)
+            if 0 <= pc - back < IDLE_SPAN:
+                loop = self._idle_loop(back, pc, cycles + taken)
+                if loop is not None:
+                    fn = _idle_edge(fn, loop)
+                    # the edge depends on the whole body: a store anywhere
+                    # in it has to reach _smc()
+                    self._code[back:pc] = b'\x01' * (pc - back)
+
+        entry = (fn, operand, size, cycles, op)
+        self._decoded[pc] = entry
+        for i in range(size): self._code[(pc + i) & 0xFFFF] = 1
+        return entry
+
+    def _idle_loop(self, lo, edge, cycles):
+        # [lo, end, instrs, cycles, None] per pass of the loop from lo to
+        # the back edge at `edge` (taking `cycles` itself), None unless
+        # the body is straight-line IDLE_OPS on RAM. the last item holds
+        # the state at the head of the last pass (see _passed())
+        mem = self.memory
+        pc, count = lo, 1
+        while pc < edge:
+            mnem, mode, base = OPCODES.get(mem[pc], UNKNOWN)
+            if mnem not in IDLE_OPS: return None
+            if mode == 'abs' and self.devices[mem[(pc + 2) & 0xFFFF]] is not None: return None
+            pc += 1 + MODE_LEN[mode]
+            count += 1
+            cycles += base
+        if pc != edge: return None
+        end = edge + 1 + MODE_LEN[OPCODES[mem[edge]][1]]
+        return [lo, end, count, cycles, None]
+
+    def _passed(self, loop):
+        # the back edge of an idle loop was taken: True when the state at
+        # its head is the same as one pass ago, nothing from outside
+        # having happened in between
+        key = (self.a, self.x, self.y, self.sp, self._nz,
+               self.flag_v, self.flag_c, self.flag_i, self._wakes)
+        if key != loop[4]:
+            loop[4] = key
+            return False
+        self._idle = loop
+        return True
+
+    def _fast_forward(self, cycle_limit, step_room, target, stops):
+        # after _passed(): every further pass of the loop is identical, so
+        # add whole passes' steps/cycles up to the cycle limit or step
+        # room. -> steps skipped (0 when a stop inside the loop or the
+        # limit is within a pass, run it) or None to return 'idle'
+        lo, end, count, cycles, _ = self._idle
+        if lo <= target < end or stops is not None and stops.find(1, lo, end) >= 0: return 0
+        if self.idle != 'skip': return None
+        inf = float('inf')
+        if cycle_limit == inf and step_room == inf: return None
+        passes = inf if cycle_limit == inf else (cycle_limit - self.cycles) // cycles
+        if step_room != inf: passes = min(passes, step_room // count)
+        passes = max(0, int(passes))
+        self.cycles += passes * cycles
+        self.skipped += passes * cycles
+        self.skipped_steps += passes * count
+        return passes * count
+
+    def disasm(self, pc):
+        # assembler text for the instr at pc
+        fn, operand, size, cycles, op = self.decode(pc)
+        mnem, mode, _ = OPCODES.get(op, UNKNOWN)
+        if   mode == 'imm': return f"{mnem} #${operand:02X}"
+        elif mode == 'zpg': return f"{mnem} ${operand:02X}"
+        elif mode == 'zpx': return f"{mnem} ${operand:02X},X"
+        elif mode == 'abs': return f"{mnem} ${operand:04X}"
+        elif mode == 'rel': return f"{mnem} ${operand[0]:04X}"
+        return mnem
 
     def push(self, val):
         # push byte -> stack
-        self.memory[0x100 + self.sp] = val & 0xFF
+        addr = 0x100 + self.sp
+        self.memory[addr] = val & 0xFF
+        self.dirty_rows[addr >> 4] = 1
+        if self._code[addr]: self._smc(addr)
         self.sp = (self.sp - 1) & 0xFF
 
     def pop(self):
@@ -54,336 +577,488 @@ class CPU:
     def step(self):
         
         if not self.running: return False
+        if self.events and self.cycles >= self.events[0][0]: self._service()
 
-        op = self.memory[self.pc]
-        self.pc = (self.pc + 1) & 0xFFFF
+        pc = self.pc
+        fn, operand, size, cycles, _ = self._decoded[pc] or self.decode(pc)
+        self.pc = (pc + size) & 0xFFFF
+        self.cycles += cycles
         self.steps += 1
-
-        # ---------------------------------------------
-        # loads
-        # ---------------------------------------------
-        if op == 0xA9:   # LDA #imm
-            self.a = self.memory[self.pc]
-            self.pc += 1
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        elif op == 0xA5:  # LDA zpg
-            addr = self.memory[self.pc]
-            self.pc += 1
-            self.a = self.memory[addr]
-            self.set_nz(self.a)
-            self.cycles += 3
-
-        elif op == 0xAD:  # LDA abs
-            lo = self.memory[self.pc]
-            hi = self.memory[self.pc + 1]
-            self.pc += 2
-            self.a = self.memory[(hi << 8) | lo]
-            self.set_nz(self.a)
-            self.cycles += 4
-
-        elif op == 0xA2:  # LDX #imm
-            self.x = self.memory[self.pc]
-            self.pc += 1
-            self.set_nz(self.x)
-            self.cycles += 2
-
-        elif op == 0xA6:  # LDX zpg
-            addr = self.memory[self.pc]
-            self.pc += 1
-            self.x = self.memory[addr]
-            self.set_nz(self.x)
-            self.cycles += 3
-
-        elif op == 0xB5:  # LDA zpg,X
-            zp = self.memory[self.pc]
-            self.pc += 1
-            addr = (zp + self.x) & 0xFF
-            self.a = self.memory[addr]
-            self.set_nz(self.a)
-            self.cycles += 4
-
-        elif op == 0xA0:  # LDY #imm
-            self.y = self.memory[self.pc]
-            self.pc += 1
-            self.set_nz(self.y)
-            self.cycles += 2
-
-        elif op == 0xA4:  # LDY zpg
-            addr = self.memory[self.pc]
-            self.pc += 1
-            self.y = self.memory[addr]
-            self.set_nz(self.y)
-            self.cycles += 3
-
-        # ---------------------------------------------
-        # sstores
-        # ---------------------------------------------
-        elif op == 0x85:  # STA zpg
-            addr = self.memory[self.pc]
-            self.pc += 1
-            self.memory[addr] = self.a
-            self.cycles += 3
-
-        elif op == 0x8D:  # STA abs
-            lo = self.memory[self.pc]
-            hi = self.memory[self.pc + 1]
-            self.pc += 2
-            self.memory[(hi << 8) | lo] = self.a
-            self.cycles += 4
-
-        elif op == 0x86:  # STX zpg
-            addr = self.memory[self.pc]
-            self.pc += 1
-            self.memory[addr] = self.x
-            self.cycles += 3
-
-        elif op == 0x95:  # STA zpg,X
-            zp = self.memory[self.pc]
-            self.pc += 1
-            addr = (zp + self.x) & 0xFF
-            self.memory[addr] = self.a
-            self.cycles += 4
-
-        elif op == 0x84:  # STY zpg
-            addr = self.memory[self.pc]
-            self.pc += 1
-            self.memory[addr] = self.y
-            self.cycles += 3
-
-        # ---------------------------------------------
-        # maths
-        # ---------------------------------------------
-        elif op == 0x69:  # ADC #imm
-            val = self.memory[self.pc]
-            self.pc += 1
-            result = self.a + val + self.flag_c
-            self.flag_v = 1 if ((self.a ^ result) & (val ^ result) & 0x80) else 0
-            self.flag_c = 1 if result > 0xFF else 0
-            self.a = result & 0xFF
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        elif op == 0x65:  # ADC zpg
-            addr = self.memory[self.pc]
-            self.pc += 1
-            val = self.memory[addr]
-            result = self.a + val + self.flag_c
-            self.flag_v = 1 if ((self.a ^ result) & (val ^ result) & 0x80) else 0
-            self.flag_c = 1 if result > 0xFF else 0
-            self.a = result & 0xFF
-            self.set_nz(self.a)
-            self.cycles += 3
-
-        elif op == 0xE9:  # SBC #imm
-            val = self.memory[self.pc]
-            self.pc += 1
-            result = self.a - val - (1 - self.flag_c)
-            self.flag_v = 1 if ((self.a ^ val) & (self.a ^ result) & 0x80) else 0
-            self.flag_c = 0 if result < 0 else 1
-            self.a = result & 0xFF
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        # ---------------------------------------------
-        # logic
-        # ---------------------------------------------
-        elif op == 0x29:  # AND #imm
-            self.a &= self.memory[self.pc]
-            self.pc += 1
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        elif op == 0x09:  # ORA #imm
-            self.a |= self.memory[self.pc]
-            self.pc += 1
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        elif op == 0x49:  # EOR #imm
-            self.a ^= self.memory[self.pc]
-            self.pc += 1
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        # ---------------------------------------------
-        # compare
-        # ---------------------------------------------
-        elif op == 0xC9:  # CMP #imm
-            val = self.memory[self.pc]
-            self.pc += 1
-            result = self.a - val
-            self.flag_c = 1 if self.a >= val else 0
-            self.set_nz(result & 0xFF)
-            self.cycles += 2
-
-        elif op == 0xC5:  # CMP zpg  <-- ADD THIS
-            addr = self.memory[self.pc]
-            self.pc += 1
-            val = self.memory[addr]
-            result = self.a - val
-            self.flag_c = 1 if self.a >= val else 0
-            self.set_nz(result & 0xFF)
-            self.cycles += 3
-
-        elif op == 0xD5:  # CMP zpg,X
-            zp = self.memory[self.pc]
-            self.pc += 1
-            addr = (zp + self.x) & 0xFF
-            val = self.memory[addr]
-            result = self.a - val
-            self.flag_c = 1 if self.a >= val else 0
-            self.set_nz(result & 0xFF)
-            self.cycles += 4
-
-        elif op == 0xE0:  # CPX #imm
-            val = self.memory[self.pc]
-            self.pc += 1
-            result = self.x - val
-            self.flag_c = 1 if self.x >= val else 0
-            self.set_nz(result & 0xFF)
-            self.cycles += 2
-
-        elif op == 0xE4:  # CPX zpg  <-- ADD THIS
-            addr = self.memory[self.pc]
-            self.pc += 1
-            val = self.memory[addr]
-            result = self.x - val
-            self.flag_c = 1 if self.x >= val else 0
-            self.set_nz(result & 0xFF)
-            self.cycles += 3
-
-        elif op == 0xC0:  # CPY #imm
-            val = self.memory[self.pc]
-            self.pc += 1
-            result = self.y - val
-            self.flag_c = 1 if self.y >= val else 0
-            self.set_nz(result & 0xFF)
-            self.cycles += 2
-
-        elif op == 0xC4:  # CPY zpg  <-- ADD THIS
-            addr = self.memory[self.pc]
-            self.pc += 1
-            val = self.memory[addr]
-            result = self.y - val
-            self.flag_c = 1 if self.y >= val else 0
-            self.set_nz(result & 0xFF)
-            self.cycles += 3
-
-        # ---------------------------------------------
-        # inc/ dec
-        # ---------------------------------------------
-        elif op == 0xE8:  # INX
-            self.x = (self.x + 1) & 0xFF
-            self.set_nz(self.x)
-            self.cycles += 2
-
-        elif op == 0xC8:  # INY
-            self.y = (self.y + 1) & 0xFF
-            self.set_nz(self.y)
-            self.cycles += 2
-
-        elif op == 0xCA:  # DEX
-            self.x = (self.x - 1) & 0xFF
-            self.set_nz(self.x)
-            self.cycles += 2
-
-        elif op == 0x88:  # DEY
-            self.y = (self.y - 1) & 0xFF
-            self.set_nz(self.y)
-            self.cycles += 2
-
-        # ---------------------------------------------
-        # flags
-        # ---------------------------------------------
-        elif op == 0x18:  # CLC
-            self.flag_c = 0
-            self.cycles += 2
-
-        elif op == 0x38:  # SEC
-            self.flag_c = 1
-            self.cycles += 2
-
-        # ---------------------------------------------
-        # transfer
-        # ---------------------------------------------
-        elif op == 0xAA:  # TAX
-            self.x = self.a
-            self.set_nz(self.x)
-            self.cycles += 2
-
-        elif op == 0xA8:  # TAY
-            self.y = self.a
-            self.set_nz(self.y)
-            self.cycles += 2
-
-        elif op == 0x8A:  # TXA
-            self.a = self.x
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        elif op == 0x98:  # TYA
-            self.a = self.y
-            self.set_nz(self.a)
-            self.cycles += 2
-
-        # ---------------------------------------------
-        # jump/ branch
-        # ---------------------------------------------
-        elif op == 0x4C:  # JMP abs
-            lo = self.memory[self.pc]
-            hi = self.memory[self.pc + 1]
-            self.pc = (hi << 8) | lo
-            self.cycles += 3
-
-        elif op == 0x20:  # JSR
-            lo = self.memory[self.pc]
-            hi = self.memory[self.pc + 1]
-            ret_addr = (self.pc + 1) & 0xFFFF
-            self.push(ret_addr >> 8)
-            self.push(ret_addr & 0xFF)
-            self.pc = (hi << 8) | lo
-            self.cycles += 6
-
-        elif op == 0x60:  # RTS
-            lo = self.pop()
-            hi = self.pop()
-            self.pc = (((hi << 8) | lo) + 1) & 0xFFFF
-            self.cycles += 6
-
-        # ---------------------------------------------
-        # branches
-        # ---------------------------------------------
-        elif op in (0x90, 0xB0, 0xF0, 0xD0, 0x30, 0x10):
-            offset = self.memory[self.pc]
-            self.pc += 1
-            self.cycles += 2
-
-            branch_ = False
-            if   op == 0x90: branch_ = (self.flag_c == 0)   # BCC
-            elif op == 0xB0: branch_ = (self.flag_c == 1)   # BCS
-            elif op == 0xF0: branch_ = (self.flag_z == 1)   # BEQ
-            elif op == 0xD0: branch_ = (self.flag_z == 0)   # BNE
-            elif op == 0x30: branch_ = (self.flag_n == 1)   # BMI
-            elif op == 0x10: branch_ = (self.flag_n == 0)   # BPL
-
-            if branch_:
-                self.cycles += 1
-                old_pc = self.pc
-                # offset := signd byte
-                if offset >= 128:
-                    offset = offset - 256
-                new_pc = (self.pc + offset) & 0xFFFF
-                self.pc = new_pc
-                if (old_pc & 0xFF00) != (new_pc & 0xFF00):
-                    self.cycles += 1
-
-        # ---------------------------------------------
-        
-        elif op == 0x00: self.running = False     # BRK
-        elif op == 0xEA: self.cycles += 2         # NOP
-        else: self.cycles += 2  # Unknown opcode -> NOP
+        try: fn(self, operand)
+        except Stop: pass
 
         return True
 
+    def run(self, max_steps=None, max_cycles=None, until_pc=None):
+        # headless batch loop: stops on BRK, after max_steps instructions,
+        # once max_cycles cycles have elapsed, after an instruction leaves
+        # PC at until_pc or on a breaks[] address, or when a handler raises
+        # Stop. with no limits it runs until BRK. scheduled events fire in
+        # between, the loop itself only ever sees one cycle limit. a
+        # busy-wait loop is handled as self.idle says
+        if not self.running: return RunResult('halted', 0, 0)
+
+        start = self.cycles
+        step_limit  = -1 if max_steps  is None else max_steps
+        cycle_limit = float('inf') if max_cycles is None else start + max_cycles
+        target = -1 if until_pc is None else until_pc & 0xFFFF
+
+        stops = self.breaks
+        added = False
+        if stops is not None:
+            # until_pc goes in the bitmap for the duration, so the loop
+            # has one lookup per instr for both
+            added = target >= 0 and not stops[target]
+            if added: stops[target] = 1
+
+        events = self.events
+        steps = skipped = 0
+        try:
+            while True:
+                limit = cycle_limit
+                if events and events[0][0] < limit: limit = events[0][0]
+                self._horizon = limit
+                left = -1 if step_limit < 0 else step_limit - steps
+                if stops is None: n, reason = self._run(left, limit, target)
+                else: n, reason = self._run_stops(left, limit, target, stops)
+                steps += n
+                # a deadline (or a new event) rather than the caller's
+                # limit: fire what is due and go on
+                if reason == 'event': continue
+                if reason != 'cycles' or self.cycles >= cycle_limit:
+                    if reason != 'idle': break
+                    # the Stop came from the back edge, check where it
+                    # went like after any other instr
+                    if self.pc == target:
+                        reason = 'pc'
+                        break
+                    if stops is not None and stops[self.pc]:
+                        reason = 'break'
+                        break
+                    room = float('inf') if left < 0 else left - n
+                    before = self.cycles
+                    n = self._fast_forward(limit, room, target, stops)
+                    if n is None: break
+                    steps += n
+                    skipped += self.cycles - before
+                    continue
+                self._service()
+                if not self.running:
+                    reason = 'brk'
+                    break
+                # an interrupt can land on until_pc or a breakpoint too
+                if self.pc == target:
+                    reason = 'pc'
+                    break
+                if stops is not None and stops[self.pc]:
+                    reason = 'break'
+                    break
+        finally:
+            self._horizon = float('inf')
+            if added: stops[target] = 0
+
+        self.steps += steps
+        return RunResult(reason, steps, self.cycles - start, skipped)
+
+    def _run(self, step_limit, cycle_limit, target):
+        # run()'s loop between two events, -> (steps, reason)
+        decoded = self._decoded
+        decode = self.decode
+        brk = self.ops[0x00]
+
+        steps = 0
+        reason = 'steps'
+        try:
+            while steps != step_limit:
+                if self.cycles >= cycle_limit:
+                    reason = 'cycles'
+                    break
+                pc = self.pc
+                fn, operand, size, cycles, _ = decoded[pc] or decode(pc)
+                self.pc = (pc + size) & 0xFFFF
+                self.cycles += cycles
+                fn(self, operand)
+                steps += 1
+                if fn is brk:
+                    reason = 'brk'
+                    break
+                if self.pc == target:
+                    reason = 'pc'
+                    break
+        except Stop as e:
+            steps += 1
+            reason = e.args[0]
+        return steps, reason
+
+    def _run_stops(self, step_limit, cycle_limit, target, stops):
+        # _run() checking the breakpoint bitmap after every instr
+        decoded = self._decoded
+        decode = self.decode
+        brk = self.ops[0x00]
+
+        steps = 0
+        reason = 'steps'
+        try:
+            while steps != step_limit:
+                if self.cycles >= cycle_limit:
+                    reason = 'cycles'
+                    break
+                pc = self.pc
+                fn, operand, size, cycles, _ = decoded[pc] or decode(pc)
+                self.pc = (pc + size) & 0xFFFF
+                self.cycles += cycles
+                fn(self, operand)
+                steps += 1
+                if fn is brk:
+                    reason = 'brk'
+                    break
+                if stops[self.pc]:
+                    reason = 'pc' if self.pc == target else 'break'
+                    break
+        except Stop as e:
+            steps += 1
+            reason = e.args[0]
+        return steps, reason
+
+    # ---------------------------------------------
+    # loads
+    # ---------------------------------------------
+    @opcode(0xA9, 'LDA', 'imm', 2)
+    def _lda_imm(self, val):
+        self.a = self._nz = val
+
+    @opcode(0xA5, 'LDA', 'zpg', 3)
+    def _lda_zpg(self, addr):
+        self.a = self._nz = self.memory[addr]
+
+    @opcode(0xAD, 'LDA', 'abs', 4)
+    def _lda_abs(self, addr):
+        self.a = self._nz = self.memory[addr]
+
+    # a device may schedule() an event inside the slice run() is in, which
+    # then ends after this instr so the next slice stops in time
+
+    @io_opcode(0xAD)
+    def _lda_io(self, addr):
+        self.a = self._nz = self.devices[addr >> 8].read(addr)
+        if self.events and self.events[0][0] < self._horizon: raise Stop('event')
+
+    @opcode(0xA2, 'LDX', 'imm', 2)
+    def _ldx_imm(self, val):
+        self.x = self._nz = val
+
+    @opcode(0xA6, 'LDX', 'zpg', 3)
+    def _ldx_zpg(self, addr):
+        self.x = self._nz = self.memory[addr]
+
+    @opcode(0xB5, 'LDA', 'zpx', 4)
+    def _lda_zpx(self, zp):
+        self.a = self._nz = self.memory[(zp + self.x) & 0xFF]
+
+    @opcode(0xA0, 'LDY', 'imm', 2)
+    def _ldy_imm(self, val):
+        self.y = self._nz = val
+
+    @opcode(0xA4, 'LDY', 'zpg', 3)
+    def _ldy_zpg(self, addr):
+        self.y = self._nz = self.memory[addr]
+
+    # ---------------------------------------------
+    # sstores
+    # ---------------------------------------------
+    @opcode(0x85, 'STA', 'zpg', 3)
+    def _sta_zpg(self, addr):
+        self.memory[addr] = self.a
+        self.dirty_rows[addr >> 4] = 1
+        if self._code[addr]: self._smc(addr)
+
+    @opcode(0x8D, 'STA', 'abs', 4)
+    def _sta_abs(self, addr):
+        self.memory[addr] = self.a
+        self.dirty_rows[addr >> 4] = 1
+        if self._code[addr]: self._smc(addr)
+
+    @io_opcode(0x8D)
+    def _sta_io(self, addr):
+        self.devices[addr >> 8].write(addr, self.a)
+        if self.events and self.events[0][0] < self._horizon: raise Stop('event')
+
+    @opcode(0x86, 'STX', 'zpg', 3)
+    def _stx_zpg(self, addr):
+        self.memory[addr] = self.x
+        self.dirty_rows[addr >> 4] = 1
+        if self._code[addr]: self._smc(addr)
+
+    @opcode(0x95, 'STA', 'zpx', 4)
+    def _sta_zpx(self, zp):
+        addr = (zp + self.x) & 0xFF
+        self.memory[addr] = self.a
+        self.dirty_rows[addr >> 4] = 1
+        if self._code[addr]: self._smc(addr)
+
+    @opcode(0x84, 'STY', 'zpg', 3)
+    def _sty_zpg(self, addr):
+        self.memory[addr] = self.y
+        self.dirty_rows[addr >> 4] = 1
+        if self._code[addr]: self._smc(addr)
+
+    # ---------------------------------------------
+    # maths
+    # ---------------------------------------------
+    @opcode(0x69, 'ADC', 'imm', 2)
+    def _adc_imm(self, val):
+        result = self.a + val + self.flag_c
+        self.flag_v = 1 if ((self.a ^ result) & (val ^ result) & 0x80) else 0
+        self.flag_c = 1 if result > 0xFF else 0
+        self.a = self._nz = result & 0xFF
+
+    @opcode(0x65, 'ADC', 'zpg', 3)
+    def _adc_zpg(self, addr):
+        val = self.memory[addr]
+        result = self.a + val + self.flag_c
+        self.flag_v = 1 if ((self.a ^ result) & (val ^ result) & 0x80) else 0
+        self.flag_c = 1 if result > 0xFF else 0
+        self.a = self._nz = result & 0xFF
+
+    @opcode(0xE9, 'SBC', 'imm', 2)
+    def _sbc_imm(self, val):
+        result = self.a - val - (1 - self.flag_c)
+        self.flag_v = 1 if ((self.a ^ val) & (self.a ^ result) & 0x80) else 0
+        self.flag_c = 0 if result < 0 else 1
+        self.a = self._nz = result & 0xFF
+
+    # ---------------------------------------------
+    # logic
+    # ---------------------------------------------
+    @opcode(0x29, 'AND', 'imm', 2)
+    def _and_imm(self, val):
+        self.a = self._nz = self.a & val
+
+    @opcode(0x09, 'ORA', 'imm', 2)
+    def _ora_imm(self, val):
+        self.a = self._nz = self.a | val
+
+    @opcode(0x49, 'EOR', 'imm', 2)
+    def _eor_imm(self, val):
+        self.a = self._nz = self.a ^ val
+
+    # ---------------------------------------------
+    # compare
+    # ---------------------------------------------
+    @opcode(0xC9, 'CMP', 'imm', 2)
+    def _cmp_imm(self, val):
+        self.flag_c = 1 if self.a >= val else 0
+        self._nz = (self.a - val) & 0xFF
+
+    @opcode(0xC5, 'CMP', 'zpg', 3)
+    def _cmp_zpg(self, addr):
+        val = self.memory[addr]
+        self.flag_c = 1 if self.a >= val else 0
+        self._nz = (self.a - val) & 0xFF
+
+    @opcode(0xD5, 'CMP', 'zpx', 4)
+    def _cmp_zpx(self, zp):
+        val = self.memory[(zp + self.x) & 0xFF]
+        self.flag_c = 1 if self.a >= val else 0
+        self._nz = (self.a - val) & 0xFF
+
+    @opcode(0xE0, 'CPX', 'imm', 2)
+    def _cpx_imm(self, val):
+        self.flag_c = 1 if self.x >= val else 0
+        self._nz = (self.x - val) & 0xFF
+
+    @opcode(0xE4, 'CPX', 'zpg', 3)
+    def _cpx_zpg(self, addr):
+        val = self.memory[addr]
+        self.flag_c = 1 if self.x >= val else 0
+        self._nz = (self.x - val) & 0xFF
+
+    @opcode(0xC0, 'CPY', 'imm', 2)
+    def _cpy_imm(self, val):
+        self.flag_c = 1 if self.y >= val else 0
+        self._nz = (self.y - val) & 0xFF
+
+    @opcode(0xC4, 'CPY', 'zpg', 3)
+    def _cpy_zpg(self, addr):
+        val = self.memory[addr]
+        self.flag_c = 1 if self.y >= val else 0
+        self._nz = (self.y - val) & 0xFF
+
+    # ---------------------------------------------
+    # inc/ dec
+    # ---------------------------------------------
+    @opcode(0xE8, 'INX', 'imp', 2)
+    def _inx(self, _):
+        self.x = self._nz = (self.x + 1) & 0xFF
+
+    @opcode(0xC8, 'INY', 'imp', 2)
+    def _iny(self, _):
+        self.y = self._nz = (self.y + 1) & 0xFF
+
+    @opcode(0xCA, 'DEX', 'imp', 2)
+    def _dex(self, _):
+        self.x = self._nz = (self.x - 1) & 0xFF
+
+    @opcode(0x88, 'DEY', 'imp', 2)
+    def _dey(self, _):
+        self.y = self._nz = (self.y - 1) & 0xFF
+
+    # ---------------------------------------------
+    # flags
+    # ---------------------------------------------
+    @opcode(0x18, 'CLC', 'imp', 2)
+    def _clc(self, _): self.flag_c = 0
+
+    @opcode(0x38, 'SEC', 'imp', 2)
+    def _sec(self, _): self.flag_c = 1
+
+    @opcode(0x58, 'CLI', 'imp', 2)
+    def _cli(self, _):
+        self.flag_i = 0
+        self._poll_irq()
+
+    @opcode(0x78, 'SEI', 'imp', 2)
+    def _sei(self, _): self.flag_i = 1
+
+    # ---------------------------------------------
+    # transfer
+    # ---------------------------------------------
+    @opcode(0xAA, 'TAX', 'imp', 2)
+    def _tax(self, _): self.x = self._nz = self.a
+
+    @opcode(0xA8, 'TAY', 'imp', 2)
+    def _tay(self, _): self.y = self._nz = self.a
+
+    @opcode(0x8A, 'TXA', 'imp', 2)
+    def _txa(self, _): self.a = self._nz = self.x
+
+    @opcode(0x98, 'TYA', 'imp', 2)
+    def _tya(self, _): self.a = self._nz = self.y
+
+    # ---------------------------------------------
+    # stack
+    # ---------------------------------------------
+    @opcode(0x08, 'PHP', 'imp', 3)
+    def _php(self, _): self.push(self._status(1))
+
+    @opcode(0x28, 'PLP', 'imp', 4)
+    def _plp(self, _):
+        self._set_status(self.pop())
+        self._poll_irq()
+
+    # ---------------------------------------------
+    # jump/ branch
+    # ---------------------------------------------
+    @opcode(0x4C, 'JMP', 'abs', 3)
+    def _jmp_abs(self, addr): self.pc = addr
+
+    @opcode(0x20, 'JSR', 'abs', 6)
+    def _jsr(self, addr):
+        ret_addr = (self.pc - 1) & 0xFFFF
+        self.push(ret_addr >> 8)
+        self.push(ret_addr & 0xFF)
+        self.pc = addr
+
+    @opcode(0x60, 'RTS', 'imp', 6)
+    def _rts(self, _):
+        lo = self.pop()
+        hi = self.pop()
+        self.pc = (((hi << 8) | lo) + 1) & 0xFFFF
+
+    @opcode(0x40, 'RTI', 'imp', 6)
+    def _rti(self, _):
+        self._set_status(self.pop())
+        lo = self.pop()
+        hi = self.pop()
+        self.pc = (hi << 8) | lo
+        self._poll_irq()
+
+    # ---------------------------------------------
+    # branches
+    # ---------------------------------------------
+    # operand is (target, extra cycles when taken), see decode()
+    @opcode(0x90, 'BCC', 'rel', 2)
+    def _bcc(self, rel):
+        if not self.flag_c:
+            self.pc, extra = rel
+            self.cycles += extra
+
+    @opcode(0xB0, 'BCS', 'rel', 2)
+    def _bcs(self, rel):
+        if self.flag_c:
+            self.pc, extra = rel
+            self.cycles += extra
+
+    @opcode(0xF0, 'BEQ', 'rel', 2)
+    def _beq(self, rel):
+        if not self._nz & 0xFF:
+            self.pc, extra = rel
+            self.cycles += extra
+
+    @opcode(0xD0, 'BNE', 'rel', 2)
+    def _bne(self, rel):
+        if self._nz & 0xFF:
+            self.pc, extra = rel
+            self.cycles += extra
+
+    @opcode(0x30, 'BMI', 'rel', 2)
+    def _bmi(self, rel):
+        if self._nz & 0x180:
+            self.pc, extra = rel
+            self.cycles += extra
+
+    @opcode(0x10, 'BPL', 'rel', 2)
+    def _bpl(self, rel):
+        if not self._nz & 0x180:
+            self.pc, extra = rel
+            self.cycles += extra
+
+    # ---------------------------------------------
+
+    @opcode(0x00, 'BRK', 'imp', 0)
+    def _brk(self, _): self.running = False
+
+    @opcode(0xEA, 'NOP', 'imp', 2)
+    def _nop(self, _): pass
+
+    def _unknown(self, _): pass  # Unknown opcode -> NOP
+
+
+# one slot per opcode byte, unknown opcodes share the NOP fallback, then
+# slot 0x100 | op for the instr addressing a device page (same handler
+# where there's no I/O variant)
+CPU.OPS = tuple(_HANDLERS.get(op, CPU._unknown) for op in range(256))
+CPU.OPS += tuple(_IO_HANDLERS.get(op, CPU.OPS[op]) for op in range(256))
+
+
+def _idle_edge(fn, loop):
+    # fn checking for a repeated pass of loop (see CPU._idle_loop) each
+    # time it jumps back, the JIT finds the loop as .loop
+    lo = loop[0]
+
+    def edge(cpu, operand):
+        fn(cpu, operand)
+        if cpu.pc != lo: loop[4] = None
+        elif cpu.idle is not None and cpu._passed(loop): raise Stop('idle')
+    edge.loop = loop
+    return edge
+
+
+_BLANK = (None,) * 65536
+_ZERO_PAGES = (bytes(256),) * 256
+
+
+def _diff_pages(mem, image, lo, hi, out):
+    # append to out the pages in [lo, hi) where mem differs from image (a
+    # memoryview), bisecting so an unchanged half costs one memcmp. an
+    # mmap has no startswith, it compares copies
+    if type(mem) is bytearray:
+        if mem.startswith(image[lo:hi], lo): return out
+    elif mem[lo:hi] == image[lo:hi].tobytes(): return out
+    if hi - lo == 256:
+        out.append(lo >> 8)
+        return out
+    mid = (lo + hi) >> 1
+    _diff_pages(mem, image, lo, mid, out)
+    _diff_pages(mem, image, mid, hi, out)
+    return out
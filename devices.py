@@ -0,0 +1,143 @@
+"""
+6502 memory-mapped devices
+
+Devices hang off CPU.map(page, device) and see every abs load/store to
+that page as read(addr) / write(addr, val); the low byte of addr picks
+the register. standard() maps the reference set used by main.py and the
+runner:
+
+    $F000  CharOut  write: append a character     read: 0
+    $F100  Timer    read $F100..$F103: cycles since reset, little endian,
+                    latched when $F100 is read    write $F100: reset
+                    write $F104/$F105: IRQ period in cycles (lo/hi)
+                    write $F106: bit 0 enables the periodic IRQ
+                    read $F106: bit 7 = IRQ pending, reading acks it
+    $F200  Random   read: random byte
+
+state() returns whatever a device needs to be put back where it was
+and set_state() takes it back (CPU.device_state(), recorder.Trace); a
+device that schedules events re-schedules them itself.
+"""
+
+import random
+
+
+class Device:
+    # open bus: reads $FF, writes are dropped
+
+    def read(self, addr):
+        return 0xFF
+
+    def write(self, addr, val):
+        pass
+
+    def state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+
+class CharOut(Device):
+
+    def __init__(self, stream=None):
+        self.text = bytearray()     # everything written so far
+        self.stream = stream        # also echoed here when set
+
+    def read(self, addr):
+        return 0
+
+    def write(self, addr, val):
+        self.text.append(val)
+        if self.stream is not None: self.stream.write(chr(val))
+
+    def state(self):
+        return len(self.text)
+
+    def set_state(self, state):
+        # what was echoed to the stream stays there
+        del self.text[state:]
+
+
+class Timer(Device):
+    # 32-bit cycle counter, the low byte read latches all four, plus a
+    # periodic IRQ driven by cpu.schedule(): each deadline is the last
+    # one + period, so firing never drifts with instr boundaries
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.base = cpu.cycles
+        self.latch = 0
+        self.period = 0
+        self.event = None       # pending cpu.schedule() handle
+        self.pending = False
+        self.fired = 0          # IRQs raised
+        self.last = None        # deadline of the latest one
+
+    def read(self, addr):
+        reg = addr & 7
+        if reg < 4:
+            if reg == 0: self.latch = (self.cpu.cycles - self.base) & 0xFFFFFFFF
+            return (self.latch >> (8 * reg)) & 0xFF
+        if reg == 6:
+            status = 0x80 if self.pending else 0
+            self.pending = False
+            self.cpu.set_irq(self, False)
+            return status | (self.event is not None)
+        return 0
+
+    def write(self, addr, val):
+        reg = addr & 7
+        if   reg == 0: self.base = self.cpu.cycles
+        elif reg == 4: self.period = (self.period & 0xFF00) | val
+        elif reg == 5: self.period = (self.period & 0x00FF) | (val << 8)
+        elif reg == 6:
+            if self.event is not None: self.cpu.cancel(self.event)
+            self.event = None
+            if val & 1 and self.period:
+                self.event = self.cpu.schedule(self.cpu.cycles + self.period, self._fire)
+
+    def state(self):
+        deadline = self.event[0] if self.event is not None else None
+        return self.base, self.latch, self.period, self.pending, self.fired, self.last, deadline
+
+    def set_state(self, state):
+        # the IRQ line is the cpu's to restore, see CPU.set_device_state()
+        self.base, self.latch, self.period, self.pending, self.fired, self.last, deadline = state
+        if self.event is not None: self.cpu.cancel(self.event)
+        self.event = None if deadline is None else self.cpu.schedule(deadline, self._fire)
+
+    def _fire(self, cycle):
+        self.fired += 1
+        self.last = cycle
+        self.event = self.cpu.schedule(cycle + self.period, self._fire)
+        self.pending = True
+        self.cpu.set_irq(self, True)
+
+
+class Random(Device):
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def read(self, addr):
+        return self.rng.getrandbits(8)
+
+    def state(self):
+        return self.rng.getstate()
+
+    def set_state(self, state):
+        self.rng.setstate(state)
+
+
+CHAR_OUT = 0xF0
+TIMER    = 0xF1
+RANDOM   = 0xF2
+
+
+def standard(cpu, stream=None, seed=None):
+    # map the reference devices at their usual pages -> {page: device}
+    devs = {CHAR_OUT: CharOut(stream), TIMER: Timer(cpu), RANDOM: Random(seed)}
+    for page, dev in devs.items():
+        cpu.map(page, dev)
+    return devs
@@ -0,0 +1,363 @@
+"""
+6502 differential checker
+
+check() runs a candidate engine (CPU.run, the JIT, the AOT translation
+or a batch lane) and the reference, CPU.step one instruction at a time,
+side by side on the same program, and compares their full state
+(registers, P, cycles, steps, running and all 64K of memory) every
+`every` instructions. The skipped-idle counter is the one thing left
+out, since only the fast engines fast-forward.
+
+On a mismatch it bisects between the last matching checkpoint and the
+first mismatching one, down to the first instruction after which the
+two differ, and returns that as a Divergence: its step number, PC,
+disassembly and source line and a diff of the state right after it.
+Each probe replays both engines on fresh machines from the matching
+checkpoint's state; when the divergence doesn't reproduce from there
+(it depends on engine caches, device state or pending events, which a
+state blob doesn't carry) the probes replay from the start instead.
+
+fuzz() generates random valid programs from the implemented opcode set
+(see random_program) and checks every engine against the reference on
+each of them.
+
+With files or directories (searched for .asm like the runner; tests/ is
+the corpus) it checks every program found on every engine.
+
+Usage: python diffcheck.py <path>... [--engine run|jit|aot|batch]... [--every N] [--max-steps N]
+       python diffcheck.py --fuzz N [--length N] [--seed N] [--engine ...] [--save DIR]
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+from aot import AOT, load_source, translate
+from assembler import ORIGIN, Assembler
+from cpu import CPU, MODE_LEN, OPCODES, STATE
+from devices import standard
+from jit import JIT
+from runner import find_sources
+
+ENGINES = ('run', 'jit', 'aot', 'batch')
+EVERY = 1000
+
+# what check() found: the first instr (1-based step number) after which
+# the candidate's state differs from the reference, where it is, and
+# [(what, reference, candidate)] for everything that differs. block is
+# the (first, last) addr of the compiled block that instr ended, whose
+# instrs the JIT/AOT only run as a whole, so the cause may be earlier in it
+Divergence = namedtuple('Divergence', 'engine step pc instr line diff replay block')
+
+_REGS = ('a', 'x', 'y', 'sp', 'pc', 'p', 'cycles', 'steps', 'running')
+_MEM_SHOWN = 16     # differing bytes listed per diff
+
+
+class Machine:
+    # a fresh cpu loaded with the program, driven by one engine:
+    # advance(n) executes exactly n more instrs unless the cpu halts
+
+    def __init__(self, engine, code, origin, devices, module=None, state=None):
+        self.engine = engine
+        self.jit = None
+        if engine == 'batch':
+            # numpy lanes have no devices, and a lane can't be seeded from
+            # a state blob: always starts from the program
+            from batch import Batch
+            if state is not None: raise ValueError("batch machines start from the program")
+            self.batch = Batch(1)
+            self.batch.load(code, origin)
+            return
+        cpu = self.cpu = CPU()
+        if devices: standard(cpu, seed=0)
+        cpu.load(code, origin)
+        if state is not None: cpu.from_bytes(state)
+        if engine == 'jit':   self.jit = JIT(cpu)
+        elif engine == 'aot': self.jit = AOT(cpu, module)
+        if self.jit is not None: self._run = self.jit.run
+        elif engine == 'run': self._run = cpu.run
+        elif engine != 'step': raise ValueError(f"unknown engine {engine!r}")
+
+    def advance(self, n):
+        if n <= 0: return
+        if self.engine == 'batch':
+            self.batch.run(max_steps=n)
+            return
+        cpu = self.cpu
+        if self.engine == 'step':
+            step = cpu.step
+            for _ in range(n):
+                if not step(): break
+        else:
+            self._run(max_steps=n)
+        # an interrupt that came due on the last instr: run() takes it
+        # right away, step() only before the next one. take it either way
+        # so both stop at the same point
+        if cpu.events and cpu.cycles >= cpu.events[0][0]: cpu._service()
+
+    def state(self):
+        # (registers, memory) to compare
+        cpu = self.batch.lane(0) if self.engine == 'batch' else self.cpu
+        return tuple(getattr(cpu, r) for r in _REGS), bytes(cpu.memory)
+
+    def to_buffer(self, out):
+        self.cpu.to_buffer(out)
+
+    def block(self, pc):
+        # (first, last) addr of a compiled block ending with the instr at pc
+        if self.jit is None: return None
+        for blk in self.jit.blocks.values():
+            if pc == max(blk.inner, default=blk.start): return blk.start, blk.end
+        return None
+
+
+def diff(ref, cand):
+    # [(what, reference, candidate)] between two state() tuples
+    out = [(name, r, c) for name, r, c in zip(_REGS, ref[0], cand[0]) if r != c]
+    if ref[1] != cand[1]:
+        addrs = [a for a in range(65536) if ref[1][a] != cand[1][a]]
+        for a in addrs[:_MEM_SHOWN]:
+            out.append((f"${a:04X}", ref[1][a], cand[1][a]))
+        if len(addrs) > _MEM_SHOWN:
+            out.append((f"+{len(addrs) - _MEM_SHOWN} more bytes", None, None))
+    return out
+
+
+def check(code, engine='run', addr_line=None, origin=ORIGIN, every=EVERY, max_steps=100_000,
+          devices=True, module=None):
+    # -> Divergence, or None if the candidate matched the reference at
+    # every checkpoint up to max_steps instrs (or both halted)
+    if engine == 'aot' and module is None:
+        module = load_source(translate(code, addr_line, origin))
+    if engine == 'batch': devices = False
+    make = lambda eng, state=None: Machine(eng, code, origin, devices, module, state)
+    ref, cand = make('step'), make(engine)
+
+    done = 0
+    # the reference's state at the last matching checkpoint, rewritten in
+    # place each time rather than a fresh 64K copy
+    good = bytearray(STATE.size + 65536)
+    ref.to_buffer(good)
+    while done < max_steps:
+        n = min(every, max_steps - done)
+        ref.advance(n)
+        cand.advance(n)
+        ref_state, cand_state = ref.state(), cand.state()
+        if ref_state != cand_state:
+            return _bisect(make, engine, done, good, done + n, addr_line or {})
+        done += n
+        if not ref_state[0][_REGS.index('running')]: break
+        ref.to_buffer(good)
+    return None
+
+
+def _bisect(make, engine, lo, good, hi, addr_line):
+    # states match after lo instrs (ref state `good`) and differ after hi
+    base = lo
+
+    def probe(at, replay):
+        # (ref state, candidate state, ref machine) after `at` instrs
+        if replay == 'checkpoint':
+            ref, cand = make('step', good), make(engine, good)
+            ref.advance(at - base)
+            cand.advance(at - base)
+        else:
+            ref, cand = make('step'), make(engine)
+            ref.advance(at)
+            cand.advance(at)
+        return ref.state(), cand.state(), ref, cand
+
+    replay = 'start'
+    if engine != 'batch':
+        r, c, _, _ = probe(hi, 'checkpoint')
+        if r != c: replay = 'checkpoint'
+    if replay == 'start':
+        r, c, _, _ = probe(hi, 'start')
+        if r == c:
+            # not even from the start: the candidate isn't deterministic
+            return Divergence(engine, hi, None, None, None, diff(r, c), 'none', None)
+
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        r, c, _, _ = probe(mid, replay)
+        if r == c: lo = mid
+        else: hi = mid
+
+    # the instr that diverged: the reference's PC after lo steps
+    _, _, ref, _ = probe(lo, replay)
+    pc = ref.cpu.pc
+    instr = ref.cpu.disasm(pc)
+    r, c, _, cand = probe(hi, replay)
+    line = addr_line.get(pc)
+    return Divergence(engine, hi, pc, instr, None if line is None else line + 1, diff(r, c), replay,
+                      cand.block(pc))
+
+
+def report(div, source_lines=None):
+    # lines describing a Divergence
+    if div.pc is None:
+        out = [f"{div.engine}: differs after {div.step} instrs, but not when replayed (not deterministic)"]
+    else:
+        where = f"${div.pc:04X}  {div.instr}"
+        if div.line is not None:
+            text = source_lines[div.line - 1].strip() if source_lines else ""
+            where += f"   line {div.line}: {text}" if text else f"   line {div.line}"
+        out = [f"{div.engine}: first divergence at instr {div.step} (replayed from {div.replay})",
+               f"  {where}"]
+        if div.block is not None and div.block[0] != div.pc:
+            out.append(f"  which ends a block run as a whole (${div.block[0]:04X}..${div.block[1]:04X}), "
+                       f"the cause may be any instr in it")
+    for what, r, c in div.diff:
+        if r is None: out.append(f"  {what}")
+        elif isinstance(r, bool) or what in ('cycles', 'steps'): out.append(f"  {what:6s} ref {r}  {div.engine} {c}")
+        else: out.append(f"  {what:6s} ref ${r:02X}  {div.engine} ${c:02X}")
+    return out
+
+
+# ---------------------------------------------
+# fuzzing
+# ---------------------------------------------
+DATA = 0x0400       # abs loads/stores go to $0400..$04FF ...
+SMC_RATE = 0.25     # ... or, this often, rewrite an imm operand in the code
+
+_BY_MNEM = {}
+for _op, (_mnem, _mode, _) in OPCODES.items():
+    _BY_MNEM.setdefault(_mnem, []).append((_op, _mode))
+
+# left out: BRK (ends the program), RTS/RTI (only valid after a matching
+# JSR/interrupt, generated structurally), JSR/JMP (placed separately)
+_BODY = sorted(m for m in _BY_MNEM if m not in ('BRK', 'RTS', 'RTI', 'JSR', 'JMP'))
+# a subroutine has to leave the stack as it found it
+_SUB_BODY = [m for m in _BODY if m not in ('PHP', 'PLP') and OPCODES[_BY_MNEM[m][0][0]][1] != 'rel']
+
+
+def random_program(rng, length=200, subs=3, sub_length=8):
+    # -> assembly source: `length` random instrs ending in BRK, then
+    # `subs` subroutines. branches go to an instr of the main stream
+    # within range, JMPs only forward, JSRs to a subroutine, and stores
+    # either hit a data page or rewrite the operand of an imm instr
+    main = []
+    for _ in range(length):
+        r = rng.random()
+        if r < 0.03 and subs: main.append(('JSR', 'abs', None))
+        elif r < 0.05: main.append(('JMP', 'abs', None))
+        else:
+            mnem = rng.choice(_BODY)
+            main.append((mnem, rng.choice(_BY_MNEM[mnem])[1], None))
+    main.append(('BRK', 'imp', None))
+    bodies = [[(m, rng.choice(_BY_MNEM[m])[1], None) for m in rng.choices(_SUB_BODY, k=sub_length)]
+              + [('RTS', 'imp', None)] for _ in range(subs)]
+
+    # lay out addresses, then pick operands knowing where everything is
+    instrs = main + [i for body in bodies for i in body]
+    addrs, addr = [], ORIGIN
+    for mnem, mode, _ in instrs:
+        addrs.append(addr)
+        addr += 1 + MODE_LEN[mode]
+    sub_starts, k = [], len(main)
+    for body in bodies:
+        sub_starts.append(k)
+        k += len(body)
+    imm_operands = [addrs[i] + 1 for i, (m, mode, _) in enumerate(instrs) if mode == 'imm']
+
+    lines = []
+    for i, (mnem, mode, _) in enumerate(instrs):
+        label = f"L{i}:" if i < len(main) else ""
+        if i in sub_starts: label = f"S{sub_starts.index(i)}:"
+        if mode == 'imp':   operand = ""
+        elif mode == 'imm': operand = f"#${rng.randrange(256):02X}"
+        elif mode in ('zpg', 'zpx'):
+            operand = f"${rng.randrange(256):02X}" + (",X" if mode == 'zpx' else "")
+        elif mnem == 'JSR': operand = f"S{rng.randrange(len(bodies))}"
+        elif mnem == 'JMP': operand = f"L{rng.randrange(i + 1, len(main))}"
+        elif mode == 'rel':
+            # main stream only (subroutines have no branches)
+            near = [j for j in range(len(main)) if j != i and -128 <= addrs[j] - (addrs[i] + 2) <= 127]
+            operand = f"L{rng.choice(near)}" if near else None
+            # nothing in range: something else two bytes long
+            if operand is None: mnem, operand = 'CMP', "#$00"
+        else:
+            target = DATA + rng.randrange(256)
+            if mnem.startswith('ST') and imm_operands and rng.random() < SMC_RATE:
+                target = rng.choice(imm_operands)
+            operand = f"${target:04X}"
+        lines.append(f"{label:8s}{mnem} {operand}".rstrip())
+    return '\n'.join(lines) + '\n'
+
+
+def fuzz(programs, engines=ENGINES, length=200, seed=None, every=50, max_steps=20_000, save=None, log=print):
+    # check every engine on `programs` random programs -> failures as
+    # [(program index, source, Divergence)]
+    rng = random.Random(seed)
+    fails = []
+    for n in range(programs):
+        source = random_program(rng, length)
+        code, addr_line = Assembler.assemble(io.StringIO(source))
+        module = load_source(translate(code, addr_line)) if 'aot' in engines else None
+        for engine in engines:
+            div = check(code, engine, addr_line, every=every, max_steps=max_steps,
+                        devices=False, module=module)
+            if div is None: continue
+            fails.append((n, source, div))
+            for line in report(div, source.splitlines()): log(line)
+            if save:
+                os.makedirs(save, exist_ok=True)
+                path = os.path.join(save, f"fuzz_{seed}_{n}.asm")
+                with open(path, 'w') as f: f.write(source)
+                log(f"  program saved to {path}")
+    return fails
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="check fast 6502 engines against CPU.step")
+    ap.add_argument('paths', nargs='*', help=".asm files or directories")
+    ap.add_argument('--engine', action='append', choices=ENGINES, help="candidate (repeatable, default all)")
+    ap.add_argument('--every', type=int, default=None, help=f"instrs between state compares (default {EVERY}, 50 fuzzing)")
+    ap.add_argument('--max-steps', type=int, default=None)
+    ap.add_argument('--fuzz', type=int, metavar='N', help="check N random programs instead")
+    ap.add_argument('--length', type=int, default=200, help="instrs per random program")
+    ap.add_argument('--seed', type=int, default=None)
+    ap.add_argument('--save', help="write failing random programs here")
+    args = ap.parse_args(argv)
+    engines = args.engine or list(ENGINES)
+    if 'batch' in engines:
+        try: import numpy  # noqa: F401
+        except ImportError:
+            engines.remove('batch')
+            print("batch: skipped, needs numpy")
+
+    t0 = time.perf_counter()
+    if args.fuzz:
+        seed = random.randrange(1 << 32) if args.seed is None else args.seed
+        fails = fuzz(args.fuzz, engines, args.length, seed, args.every or 50, args.max_steps or 20_000, args.save)
+        print(f"fuzz seed {seed}: {args.fuzz} programs x {len(engines)} engines in "
+              f"{time.perf_counter() - t0:.2f} s, {len(fails)} divergences")
+        return 1 if fails else 0
+
+    if not args.paths: ap.error("programs to check, or --fuzz N")
+    files = list(find_sources(args.paths))
+    bad = 0
+    for path in files:
+        prog = Assembler.build(path)
+        with open(path) as f: source_lines = f.read().splitlines()
+        ok = 0
+        for engine in engines:
+            div = check(prog.code, engine, prog.addr_line, prog.origin, args.every or EVERY,
+                        args.max_steps or 100_000)
+            if div is None:
+                ok += 1
+                continue
+            print(f"{path}: {engine}")
+            for line in report(div, source_lines): print(line)
+        bad += ok < len(engines)
+        print(f"{path}: {ok}/{len(engines)} engines match CPU.step", flush=True)
+    print(f"{len(files)} programs x {len(engines)} engines in {time.perf_counter() - t0:.2f} s, "
+          f"{bad} with divergences")
+    return 1 if bad else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+"""
+Basic-block JIT for the 6502 CPU
+
+Straight-line runs of code are translated to Python source, compiled once
+and cached by start PC. A block ends at a branch, JMP, JSR, RTS or BRK
+(or after MAX_BLOCK instructions). Registers and flags live in locals
+inside a block and are written back once, cycles and steps are added
+once per exit.
+"""
+
+import re
+from collections import namedtuple
+
+from cpu import CPU, UNKNOWN, MODE_LEN, OPCODES, RunResult
+
+MAX_BLOCK = 64
+
+BLOCK_END = {'BCC', 'BCS', 'BEQ', 'BNE', 'BMI', 'BPL',
+             'JMP', 'JSR', 'RTS', 'BRK'}
+
+# never translated, a block stops in front of them and cpu.step() runs them
+INTERPRETED = {'RTI', 'CLI', 'SEI', 'PHP', 'PLP'}
+
+# fn(cpu), first/last byte covered, instr count, cycles of all but the
+# last instr (the budget check), PCs reached inside the block and the
+# cpu's idle loop record when the block is one whole busy-wait pass
+Block = namedtuple('Block', 'fn start end count head_cycles inner loop')
+
+
+def decode_block(cpu, pc):
+    # [(addr, op, mnem, mode, operand, cycles)] up to and incl. the block
+    # end or before an instr on a device page or in INTERPRETED, operands
+    # as resolved by cpu.decode()
+    out = []
+    while len(out) < MAX_BLOCK:
+        fn, operand, size, cycles, op = cpu.decode(pc)
+        if pc + size >= 0x10000: break         # nothing ending at $FFFF or wrapping
+        mnem, mode, _ = OPCODES.get(op, UNKNOWN)
+        if fn is not cpu.ops[op] and not hasattr(fn, 'loop'):
+            break                              # device access, interpreted
+        if mnem in INTERPRETED: break
+        out.append((pc, op, mnem, mode, operand, cycles))
+        pc += size
+        if mnem in BLOCK_END: break
+    return out
+
+
+class _Gen:
+    # emits the body of one block, tracking which locals are dirty and
+    # where the current N/Z result lives
+
+    def __init__(self):
+        self.lines = []
+        self.dirty = []     # written locals, in first-write order
+        self.nz = None      # local holding the last N/Z result
+        self.cycles = 0
+        self.count = 0
+
+    def emit(self, line, indent=2):
+        self.lines.append('    ' * indent + line)
+
+    def write(self, reg):
+        if reg not in self.dirty: self.dirty.append(reg)
+
+    def set_nz(self, src):
+        self.nz = src
+        self.write('nz')
+
+    def writeback(self, pc, cycles, indent=2):
+        # state back to cpu at an exit
+        for reg in self.dirty:
+            if reg == 'nz':
+                self.emit(f"cpu._nz = {self.nz}", indent)
+            elif reg in ('c', 'v'):
+                self.emit(f"cpu.flag_{reg} = {reg}", indent)
+            else:
+                self.emit(f"cpu.{reg} = {reg}", indent)
+        self.emit(f"cpu.pc = {pc}", indent)
+        self.emit(f"cpu.cycles += {cycles}", indent)
+        self.emit(f"cpu.steps += {self.count}", indent)
+
+    def store(self, addr, src, after):
+        # mem write; leave the block if it hit translated code
+        row = f"0x{int(addr, 16) >> 4:03X}" if addr != 't' else "t >> 4"
+        self.emit(f"mem[{addr}] = {src}")
+        self.emit(f"rows[{row}] = 1")
+        self.emit(f"if code[{addr}]:")
+        self.writeback(f"0x{after:04X}", self.cycles, 3)
+        self.emit(f"cpu._smc({addr})", 3)
+        self.emit("return", 3)
+
+    def cond(self, mnem):
+        # branch-taken test, N/Z read straight from the last result
+        nz = self.nz or 'cpu._nz'
+        return BRANCH_COND[mnem].format(nz=nz)
+
+
+# see CPU.flag_n for the _nz encoding
+BRANCH_COND = {
+    'BCC': "not c", 'BCS': "c",
+    'BEQ': "not {nz} & 0xFF", 'BNE': "{nz} & 0xFF",
+    'BMI': "{nz} & 0x180", 'BPL': "not {nz} & 0x180",
+}
+
+
+def block_source(instrs, name='block'):
+    # python source of `def make(mem, code, rows)` returning the block
+    # function
+    body = block_def(instrs, name)
+    return f"def make(mem, code, rows):\n{body}    return {name}\n"
+
+
+def block_def(instrs, name='block'):
+    # python source of `def name(cpu)` for the block, indented one level
+    # for a scope that has mem, code and rows
+    g = _Gen()
+    for pc, op, mnem, mode, operand, cycles in instrs:
+        after = (pc + 1 + MODE_LEN[mode]) & 0xFFFF     # past $FFFF is $0000
+        g.count += 1
+        g.cycles += cycles
+
+        addr = val = None
+        if   mode == 'imm': val = f"0x{operand:02X}"
+        elif mode == 'zpg': addr = f"0x{operand:02X}"
+        elif mode == 'abs': addr = f"0x{operand:04X}"
+        elif mode == 'zpx':
+            g.emit(f"t = (0x{operand:02X} + x) & 0xFF")
+            addr = "t"
+        if addr is not None: val = f"mem[{addr}]"
+
+        if mnem in ('LDA', 'LDX', 'LDY'):
+            reg = mnem[2].lower()
+            g.emit(f"{reg} = {val}")
+            g.write(reg); g.set_nz(reg)
+
+        elif mnem in ('STA', 'STX', 'STY'):
+            g.store(addr, mnem[2].lower(), after)
+
+        elif mnem == 'ADC':
+            g.emit(f"val = {val}")
+            g.emit("result = a + val + c")
+            g.emit("v = 1 if ((a ^ result) & (val ^ result) & 0x80) else 0")
+            g.emit("c = 1 if result > 0xFF else 0")
+            g.emit("a = result & 0xFF")
+            g.write('v'); g.write('c'); g.write('a'); g.set_nz('a')
+
+        elif mnem == 'SBC':
+            g.emit(f"val = {val}")
+            g.emit("result = a - val - (1 - c)")
+            g.emit("v = 1 if ((a ^ val) & (a ^ result) & 0x80) else 0")
+            g.emit("c = 0 if result < 0 else 1")
+            g.emit("a = result & 0xFF")
+            g.write('v'); g.write('c'); g.write('a'); g.set_nz('a')
+
+        elif mnem in ('AND', 'ORA', 'EOR'):
+            sym = {'AND': '&', 'ORA': '|', 'EOR': '^'}[mnem]
+            g.emit(f"a {sym}= {val}")
+            g.write('a'); g.set_nz('a')
+
+        elif mnem in ('CMP', 'CPX', 'CPY'):
+            reg = {'CMP': 'a', 'CPX': 'x', 'CPY': 'y'}[mnem]
+            g.emit(f"val = {val}")
+            g.emit(f"c = 1 if {reg} >= val else 0")
+            g.emit(f"nz = ({reg} - val) & 0xFF")
+            g.write('c'); g.set_nz('nz')
+
+        elif mnem in ('INX', 'INY', 'DEX', 'DEY'):
+            reg = mnem[2].lower()
+            sym = '+' if mnem[0] == 'I' else '-'
+            g.emit(f"{reg} = ({reg} {sym} 1) & 0xFF")
+            g.write(reg); g.set_nz(reg)
+
+        elif mnem in ('CLC', 'SEC'):
+            g.emit(f"c = {1 if mnem == 'SEC' else 0}")
+            g.write('c')
+
+        elif mnem in ('TAX', 'TAY', 'TXA', 'TYA'):
+            src, dst = mnem[1].lower(), mnem[2].lower()
+            g.emit(f"{dst} = {src}")
+            g.write(dst); g.set_nz(dst)
+
+        elif mnem in ('NOP', '???'):
+            pass
+
+        elif mnem == 'JMP':
+            g.writeback(f"0x{operand:04X}", g.cycles)
+
+        elif mnem == 'JSR':
+            ret = (pc + 2) & 0xFFFF
+            g.emit("sp = cpu.sp")
+            for byte in (ret >> 8, ret & 0xFF):
+                g.emit("t = 0x100 + sp")
+                g.emit(f"mem[t] = 0x{byte:02X}")
+                g.emit("rows[t >> 4] = 1")
+                g.emit("sp = (sp - 1) & 0xFF")
+                g.emit("if code[t]: cpu._smc(t)")
+            g.emit("cpu.sp = sp")
+            g.writeback(f"0x{operand:04X}", g.cycles)
+
+        elif mnem == 'RTS':
+            g.emit("sp = cpu.sp")
+            g.emit("lo = mem[0x100 + ((sp + 1) & 0xFF)]")
+            g.emit("hi = mem[0x100 + ((sp + 2) & 0xFF)]")
+            g.emit("cpu.sp = (sp + 2) & 0xFF")
+            g.writeback("(((hi << 8) | lo) + 1) & 0xFFFF", g.cycles)
+
+        elif mnem == 'BRK':
+            g.emit("cpu.running = False")
+            g.writeback(f"0x{after:04X}", g.cycles)
+
+        elif mnem in BRANCH_COND:
+            target, extra = operand
+            g.emit(f"if {g.cond(mnem)}:")
+            g.writeback(f"0x{target:04X}", g.cycles + extra, 3)
+            g.emit("else:")
+            g.writeback(f"0x{after:04X}", g.cycles, 3)
+
+        if mnem in BLOCK_END: break
+    else:
+        # ran out of room: fall through to the next block
+        g.writeback(f"0x{after:04X}", g.cycles)
+
+    body = '\n'.join(g.lines)
+    loads = [f"    {r} = cpu.{r}" for r in 'axy' if _uses(body, r)]
+    loads += [f"    {r} = cpu.flag_{r}" for r in 'cv' if _uses(body, r)]
+    src = [f"    def {name}(cpu):"]
+    src += ['    ' + l for l in loads]
+    src += [body]
+    return '\n'.join(src) + '\n'
+
+
+def _uses(body, reg):
+    # does the body mention reg as a bare local
+    return re.search(r'(?<![\w.])' + reg + r'(?!\w)', body) is not None
+
+
+class JIT:
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}
+        cpu.jit = self
+
+    def flush(self):
+        self.blocks.clear()
+
+    def invalidate(self, addr, end=None):
+        # drop every block overlapping [addr, end) (just addr by default),
+        # re-mark bytes other blocks still need
+        end = addr + 1 if end is None else end
+        dead = [b for b in self.blocks.values() if b.start < end and addr <= b.end]
+        code = self.cpu._code
+        for b in dead:
+            del self.blocks[b.start]
+        for b in self.blocks.values():
+            for d in dead:
+                lo, hi = max(b.start, d.start), min(b.end, d.end)
+                if lo <= hi: code[lo:hi + 1] = b'\x01' * (hi - lo + 1)
+
+    def compile(self, pc):
+        cpu = self.cpu
+        instrs = decode_block(cpu, pc)
+        if not instrs: return None
+        ns = {}
+        src = block_source(instrs, f"block_{pc:04X}")
+        exec(compile(src, f"<jit ${pc:04X}>", 'exec'), ns)
+        fn = ns['make'](cpu.memory, cpu._code, cpu.dirty_rows)
+
+        last = instrs[-1]
+        end = last[0] + MODE_LEN[last[3]]
+        head = sum(i[5] for i in instrs[:-1])
+        inner = frozenset(i[0] for i in instrs[1:])
+        loop = getattr(cpu.decode(last[0])[0], 'loop', None)
+        if loop is not None and loop[0] != pc: loop = None
+        blk = Block(fn, pc, end, len(instrs), head, inner, loop)
+        cpu._code[pc:end + 1] = b'\x01' * (end + 1 - pc)
+        self.blocks[pc] = blk
+        return blk
+
+    def run(self, max_steps=None, max_cycles=None, until_pc=None):
+        # same contract as CPU.run; falls back to cpu.step() wherever a
+        # whole block would overshoot a limit or the next scheduled event,
+        # or pass through until_pc or a breakpoint
+        cpu = self.cpu
+        if not cpu.running: return RunResult('halted', 0, 0)
+        if cpu.ops is not CPU.OPS:
+            # wrapped handlers (profiler, trace, watchpoints) only see
+            # interpreted instrs, blocks would bypass them
+            return cpu.run(max_steps, max_cycles, until_pc)
+
+        blocks = self.blocks
+        start_steps, start, skipped = cpu.steps, cpu.cycles, cpu.skipped
+        step_end = float('inf') if max_steps is None else start_steps + max_steps
+        cycle_limit = float('inf') if max_cycles is None else start + max_cycles
+        target = -1 if until_pc is None else until_pc & 0xFFFF
+        stops = cpu.breaks
+        events = cpu.events
+
+        while True:
+            if cpu.steps >= step_end:
+                reason = 'steps'
+                break
+            if cpu.cycles >= cycle_limit:
+                reason = 'cycles'
+                break
+            limit = cycle_limit
+            if events:
+                if cpu.cycles >= events[0][0]:
+                    cpu._service()
+                    if not cpu.running:
+                        reason = 'brk'
+                        break
+                    if cpu.pc == target:
+                        reason = 'pc'
+                        break
+                    if stops is not None and stops[cpu.pc]:
+                        reason = 'break'
+                        break
+                    continue
+                if events[0][0] < limit: limit = events[0][0]
+            blk = blocks.get(cpu.pc) or self.compile(cpu.pc)
+            if (blk is None or cpu.steps + blk.count > step_end
+                    or cpu.cycles + blk.head_cycles >= limit
+                    or target in blk.inner
+                    or stops is not None and any(stops[p] for p in blk.inner)):
+                cpu.step()
+                loop = None
+            else:
+                blk.fn(cpu)
+                # a busy-wait pass: the same check the back edge does
+                # when interpreted
+                loop = blk.loop
+                if loop is not None:
+                    if cpu.pc != loop[0]: loop[4] = loop = None
+                    elif cpu.idle is None or not cpu._passed(loop): loop = None
+            if not cpu.running:
+                reason = 'brk'
+                break
+            if cpu.pc == target:
+                reason = 'pc'
+                break
+            if stops is not None and stops[cpu.pc]:
+                reason = 'break'
+                break
+            if loop is not None:
+                n = cpu._fast_forward(limit, step_end - cpu.steps, target, stops)
+                if n is None:
+                    reason = 'idle'
+                    break
+                cpu.steps += n
+
+        return RunResult(reason, cpu.steps - start_steps, cpu.cycles - start,
+                         cpu.skipped - skipped)
@@ -4,11 +4,33 @@ import time
 
 from cpu import CPU
 from assembler import Assembler
+from profiler import Profile
+from recorder import Trace
+from breakpoints import Breakpoints, parse_range, resolve
+from devices import CHAR_OUT, standard
+from statefile import StateFile
 
 """
 6502 CPU Emulator
 """
 
+FPS = 30             # redraw cap
+CHUNK = 2000         # instrs per run() call when unthrottled
+RATE_WINDOW = 0.5    # seconds between MIPS readings
+MAX_CATCHUP = 0.25   # seconds of backlog a throttled speed may make up
+
+# (label, instrs/sec, cycles/sec), +/- walks this list. 'step' only
+# advances on SPACE, 'max' runs as fast as the frame budget allows
+SPEEDS = [
+    ('step',    None,  None),
+    ('10 ips',  10,    None),
+    ('100 ips', 100,   None),
+    ('1k ips',  1000,  None),
+    ('10k ips', 10000, None),
+    ('1 MHz',   None,  1000000),
+    ('max',     None,  None),
+]
+
 
 def _format_hex_line(base, data, width=16):
     # format $XXXX:  XX XX..  |ascii|"""
@@ -17,139 +39,353 @@ def _format_hex_line(base, data, width=16):
     return f"${base:04X}: {hex_part.ljust(width*3-1)}  {ascii_part}"
 
 
-def draw(screen, cpu, source_lines, addr_line, pause):
-    screen.clear()
+# reg_changes() bits feeding each register line
+_SREG_BITS  = 0b1111111000   # sp, pc, flags
+_AXY_BITS   = 0b000000111
+_FLAG_BITS  = 0b1111100000
+
+
+class View:
+    # what is on screen right now, so a frame only re-formats and
+    # re-addstr's the lines that changed instead of clearing everything
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.size = None
+        self.lines = {}      # y -> (text, attr, hilite) as last drawn
+        self.rows = {}       # memory row -> (bytes, formatted line)
+        self.regs = {}       # y -> register line text
+        self.src = (None, [])
+
+    def resize(self, size):
+        self.screen.clear()
+        self.size = size
+        self.lines.clear()
+
+    def put(self, y, text, attr=0, hilite=()):
+        # hilite: (x, width) spans drawn reversed on top of attr
+        h, w = self.size
+        if y >= h: return
+        text = text[:w-1]
+        if self.lines.get(y) == (text, attr, hilite): return
+        self.lines[y] = (text, attr, hilite)
+        self.screen.move(y, 0)
+        self.screen.clrtoeol()
+        self.screen.addstr(y, 0, text, attr)
+        for x, n in hilite:
+            if x + n < w: self.screen.chgat(y, x, n, attr | curses.A_REVERSE)
+
+    def mem_row(self, cpu, base):
+        # formatted row + spans of bytes changed since it was last drawn,
+        # re-formatted only when the cpu marked the row dirty
+        row = base >> 4
+        cached = self.rows.get(row)
+        if cached is not None and not cpu.dirty_rows[row]:
+            return cached[1], ()
+        cpu.dirty_rows[row] = 0
+        data = bytes(cpu.memory[base:base+16])
+        old = cached[0] if cached is not None else data
+        text = _format_hex_line(base, data)
+        self.rows[row] = (data, text)
+        hilite = []
+        for i in range(16):
+            if data[i] != old[i]:
+                hilite += [(7 + 3*i, 2), (56 + i, 1)]
+        return text, tuple(hilite)
+
+
+def draw(view, cpu, source_lines, addr_line, pause, info="", heat=None, marks=frozenset(), out=b"", state=None):
+    screen = view.screen
     h, w = screen.getmaxyx()
+    if view.size != (h, w): view.resize((h, w))
 
     current_src_line = addr_line.get(cpu.pc, -1)
     if 0 <= current_src_line < len(source_lines):
         instr_text = source_lines[current_src_line].split(';')[0].strip()
-    else: instr_text = "???"
+    else: instr_text = cpu.disasm(cpu.pc)
 
-    cur_op = cpu.memory[cpu.pc]
+    cur_op = cpu.decode(cpu.pc)[4]
     header = f"Step: {cpu.steps}  PC: ${cpu.pc:04X}  SP: ${cpu.sp:02X}  OP:{cur_op:02X}  {instr_text}, {cpu.cycles}"
-    screen.addstr(0, 0, header[:w-1], curses.A_BOLD)
+    view.put(0, header, curses.A_BOLD)
+
+    # heat: {line: glyph} from the profiler, shown as a leading column;
+    # marks: lines with a breakpoint
+    key = (current_src_line, heat, marks)
+    if view.src[0] != key:
+        view_start = max(0, current_src_line - 4) if current_src_line >= 0 else 0
+        view_end = min(len(source_lines), view_start + 12)
+        src = []
+        for i in range(view_start, view_end):
+            display = f"{i+1:4d}{'*' if i in marks else ':'} {source_lines[i].rstrip()}"
+            if heat is not None: display = heat.get(i, ' ') + display
+            src.append((display, curses.A_REVERSE if i == current_src_line else 0))
+        view.src = (key, src)
 
     y = 2
-    view_start = max(0, current_src_line - 4) if current_src_line >= 0 else 0
-    view_end = min(len(source_lines), view_start + 12)
-
-    for i in range(view_start, view_end):
-        if y >= h - 14: break 
-        display = f"{i+1:4d}: {source_lines[i].rstrip()}"
-        if i == current_src_line:
-            screen.addstr(y, 0, display[:w-1], curses.A_REVERSE)
-        else: screen.addstr(y, 0, display[:w-1])
+    for display, attr in view.src[1]:
+        if y >= h - 14: break
+        view.put(y, display, attr)
+        y += 1
+    while y < 14:
+        view.put(y, "")
         y += 1
 
-    y = 14
-
-    sreg = f"N:{cpu.flag_n} V:{cpu.flag_v} Z:{cpu.flag_z} C:{cpu.flag_c}"
-    screen.addstr(y+1, 0, f"SREG: {sreg}   PC:${cpu.pc:04X} SP:${cpu.sp:02X}",
-                  curses.A_BOLD)
-        
-    y += 1
-
-    
-    screen.addstr(y, 0, "Registers (all):", curses.A_BOLD); y += 1
-    r00_15 = f"{cpu.a:02X} {cpu.x:02X} {cpu.y:02X}" + " 00" * 13
-    r16_31 = " ".join("00" for _ in range(16))
-    screen.addstr(y, 2, f"R00-15:   {r00_15}"); y += 1
-    screen.addstr(y, 2, f"R16-31:   {r16_31}"); y += 1
-
-    reg_line = f"A: ${cpu.a:02X} ({cpu.a:3d})   X: ${cpu.x:02X} ({cpu.x:3d})   Y: ${cpu.y:02X} ({cpu.y:3d})"
-    screen.addstr(y, 0, reg_line[:w-1], curses.A_BOLD)
-
-    y += 1
-
-    flag_line = f"Flags:  N={cpu.flag_n}  V={cpu.flag_v}  Z={cpu.flag_z}  C={cpu.flag_c}"
-    screen.addstr(y, 0, flag_line[:w-1], curses.A_BOLD)
-
-    y += 2
-
-    screen.addstr(y, 0, "Zero Page Memory  $0000..$00FF", curses.A_BOLD)
-    y += 1
-    for row in range(8):
-        if y >= h - 1: break
-        base = row * 16
-        hex_part = _format_hex_line(base, cpu.memory[base:base+16])
-        screen.addstr(y, 0, hex_part[:w-1])
+    changed = cpu.reg_changes()
+    if changed & _SREG_BITS or 14 not in view.regs:
+        sreg = f"N:{cpu.flag_n} V:{cpu.flag_v} I:{cpu.flag_i} Z:{cpu.flag_z} C:{cpu.flag_c}"
+        view.regs[14] = f"SREG: {sreg}   PC:${cpu.pc:04X} SP:${cpu.sp:02X}"
+    if changed & _AXY_BITS or 16 not in view.regs:
+        view.regs[16] = "  R00-15:   " + f"{cpu.a:02X} {cpu.x:02X} {cpu.y:02X}" + " 00" * 13
+        view.regs[18] = f"A: ${cpu.a:02X} ({cpu.a:3d})   X: ${cpu.x:02X} ({cpu.x:3d})   Y: ${cpu.y:02X} ({cpu.y:3d})"
+    if changed & _FLAG_BITS or 19 not in view.regs:
+        view.regs[19] = f"Flags:  N={cpu.flag_n}  V={cpu.flag_v}  I={cpu.flag_i}  Z={cpu.flag_z}  C={cpu.flag_c}"
+
+    view.put(14, view.regs[14], curses.A_BOLD)
+    view.put(15, "Registers (all):", curses.A_BOLD)
+    view.put(16, view.regs[16])
+    view.put(17, "  R16-31:   " + " ".join("00" for _ in range(16)))
+    view.put(18, view.regs[18], curses.A_BOLD)
+    view.put(19, view.regs[19], curses.A_BOLD)
+    # tail of what the program wrote to the char-out port
+    text = bytes(out).decode('latin-1').replace('\r', '').split('\n')[-1]
+    view.put(20, "Out: " + "".join(c if ' ' <= c <= '~' else '.' for c in text[-(w - 6):]) if out else "")
+
+    y = 21
+    if state is not None:
+        # memory is in the state file, viewer.py shows it from outside
+        view.put(y, f"Memory: python viewer.py {state}", curses.A_BOLD)
+        y = h - 1
+    else:
+        view.put(y, "Zero Page Memory  $0000..$00FF", curses.A_BOLD)
+        y += 1
+        for row in range(8):
+            if y >= h - 1: break
+            text, hilite = view.mem_row(cpu, row * 16)
+            view.put(y, text, 0, hilite)
+            y += 1
         y += 1
 
-    y += 1
     if y < h - 1:
-        screen.addstr(y, 0, "Program Memory  $0200..$02FF", curses.A_BOLD)
+        view.put(y, "Program Memory  $0200..$02FF", curses.A_BOLD)
         y += 1
         for row in range(8):
             if y >= h - 1: break
-            base = 0x0200 + row * 16
-            hex_part = _format_hex_line(base, cpu.memory[base:base+16])
-            screen.addstr(y, 0, hex_part[:w-1])
+            text, hilite = view.mem_row(cpu, 0x0200 + row * 16)
+            view.put(y, text, 0, hilite)
             y += 1
 
     status = "[PAUSED] " if pause else "[RUNNING] "
     if not cpu.running: status = "[STOPPED] "
-    status += "SPACE=step  ENTER=run/pause  Q=quit"
-    screen.addstr(h - 1, 0, status[:w-1], curses.A_REVERSE)
+    status += f"{info}  SPACE=step  ENTER=run/pause  +/-=speed  K=break  W=watch  P=profile  R=record  B=back  G=goto  Q=quit"
+    view.put(h - 1, status, curses.A_REVERSE)
 
     screen.refresh()
     return
 
 
-def Emulate(screen, filename):
+def prompt(view, text):
+    # read a line of input on the status line
+    screen = view.screen
+    h, w = screen.getmaxyx()
+    view.put(h - 1, text, curses.A_REVERSE)
+    view.lines.pop(h - 1, None)
+    screen.timeout(-1)
+    curses.echo()
+    curses.curs_set(1)
+    try:
+        return screen.getstr(h - 1, len(text), 40).decode().strip()
+    finally:
+        curses.noecho()
+        curses.curs_set(0)
+
+
+def Emulate(screen, filename, state=None):
     curses.curs_set(0)
     screen.nodelay(True)
-    screen.timeout(50)
+    frame = 1.0 / FPS
+    screen.timeout(int(frame * 1000))
 
     with open(filename) as f: source_lines = f.readlines()
-    bytecode, addr_line = Assembler.parse(filename)
-
-    cpu = CPU()
-    def _load():
-        # clr, load@ $0200, reset PC && SP
-        cpu.memory[:] = b'\x00' * len(cpu.memory)
-        for i, b in enumerate(bytecode):
-            cpu.memory[0x0200 + i] = b
-        cpu.pc = 0x0200
-        cpu.sp = 0xFF
-
-    _load()
-
+    # cached object when the source hasn't changed (see Assembler.build)
+    prog = Assembler.build(filename)
+    bytecode, addr_line, labels = prog.code, prog.addr_line, prog.labels
+
+    # clr, load@ $0200, reset PC && SP; restarts restore this snapshot.
+    # with a state file memory is its mapping and each frame saves the
+    # registers there too
+    sf = None
+    if state:
+        sf = StateFile(state)
+        sf.memory[:] = bytes(len(sf.memory))
+    cpu = CPU(sf.memory) if sf else CPU()
+    cpu.load(bytecode)
+    out = standard(cpu)[CHAR_OUT].text
+    boot = cpu.snapshot()
+
+    view = View(screen)
+    prof = None         # Profile while P is on
+    trace = None        # Trace while R is on, for B/G
+    bps = Breakpoints(cpu)
+    stopped = ""        # why the last run stopped early (breakpoint/watch)
     pause = True
-    _step = time.time()
-    _delay = 0.1
-
-    while True:
-        draw(screen, cpu, source_lines, addr_line, pause)
+    speed = 1
+    owed = 0.0          # instrs/cycles the throttle still owes the cpu
+    _tick = time.perf_counter()
+    _draw = 0.0
+    dirty = True
 
-        if not pause and cpu.running:
-            now = time.time()
-            if now - _step >= _delay:
-                cpu.step()
-                _step = now
+    # achieved rate, re-measured every RATE_WINDOW seconds
+    rate = (0.0, 0.0)
+    _rate = (_tick, cpu.steps, cpu.cycles)
 
+    while True:
+        now = time.perf_counter()
+        label, ips, cps = SPEEDS[speed]
+        elapsed = min(now - _tick, MAX_CATCHUP)
+        _tick = now
+        running = not pause and cpu.running and label != 'step'
+
+        if running:
+            result = None
+            if ips:
+                owed += ips * elapsed
+                if owed >= 1:
+                    result = cpu.run(max_steps=int(owed))
+                    owed -= result.steps
+            elif cps:
+                owed += cps * elapsed
+                if owed >= 1:
+                    result = cpu.run(max_cycles=int(owed))
+                    owed -= result.cycles
+            else:
+                # unthrottled: fill the frame, checking the clock per chunk
+                deadline = now + frame
+                while cpu.running and time.perf_counter() < deadline:
+                    result = cpu.run(max_steps=CHUNK)
+                    if result.reason in ('break', 'watch', 'idle') or result.skipped: break
+            if result is not None and result.reason in ('break', 'watch'):
+                stopped = bps.describe(result)
+                pause = True
+                owed = 0.0
+            elif result is not None and (result.reason == 'idle' or result.skipped and not cpu.events):
+                # busy-waiting with nothing scheduled that could end it
+                stopped = f"IDLE at ${cpu.pc:04X}, {cpu.skipped} cycles skipped"
+                pause = True
+                owed = 0.0
+            dirty = True
+
+        t, steps, cycles = _rate
+        if now - t >= RATE_WINDOW:
+            rate = ((cpu.steps - steps) / (now - t), (cpu.cycles - cycles) / (now - t))
+            _rate = (now, cpu.steps, cpu.cycles)
+
+        if dirty and now - _draw >= frame:
+            info = f"{label}  {rate[0] / 1e6:.3f} MIPS  {rate[1] / 1e6:.3f} Mcyc/s" if running else label
+            heat = None
+            if prof is not None:
+                info += "  PROF"
+                heat = prof.heat(addr_line)
+            if trace is not None:
+                info += f"  REC {trace.oldest}..{trace.newest}"
+            if stopped: info += f"  {stopped}"
+            marks = frozenset(addr_line[a] for a in bps.addrs if a in addr_line)
+            draw(view, cpu, source_lines, addr_line, pause, info, heat, marks, out, state)
+            if sf is not None: sf.save(cpu)
+            _draw = now
+            dirty = False
+
+        # sleep out the rest of the frame unless running unthrottled
+        rest = _tick + frame - time.perf_counter()
+        screen.timeout(0 if running and label == 'max' else max(0, int(rest * 1000)))
         try:  key = screen.getch()
         except Exception: key = -1
-
-        if key in (ord('q'), ord('Q')): break
+        if key != -1:
+            dirty = True
+            stopped = ""
+
+        if key in (ord('q'), ord('Q')):
+            if sf is not None:
+                sf.save(cpu)
+                sf.close()
+            break
         elif key == ord(' '):
             if cpu.running:
                 cpu.step()
             pause = True
+        elif key in (ord('+'), ord('=')):
+            speed = min(speed + 1, len(SPEEDS) - 1)
+            owed = 0.0
+        elif key in (ord('-'), ord('_')):
+            speed = max(speed - 1, 0)
+            owed = 0.0
+        elif key in (ord('p'), ord('P')):
+            # profiling swaps the handler table, off costs nothing
+            if prof is None:
+                prof = Profile(cpu)
+                prof.start()
+            else:
+                prof.stop()
+                prof = None
+        elif key in (ord('r'), ord('R')):
+            if trace is None:
+                trace = Trace(cpu)
+                trace.start()
+            else:
+                trace.close()
+                trace = None
+        elif key in (ord('b'), ord('B')):
+            # one instruction back, replayed from the nearest checkpoint
+            if trace is not None and cpu.steps:
+                trace.back()
+            pause = True
+        elif key in (ord('g'), ord('G')):
+            if trace is not None:
+                raw = prompt(view, "goto step: ")
+                if raw.isdigit(): trace.seek(int(raw))
+            pause = True
+        elif key in (ord('k'), ord('K')):
+            # toggle a PC breakpoint by line, label or $addr (empty = here)
+            raw = prompt(view, "break at (line, label, $addr; empty = PC): ")
+            try:
+                bps.toggle(resolve(raw, addr_line, labels) if raw else cpu.pc)
+            except ValueError as e:
+                stopped = str(e)
+        elif key in (ord('w'), ord('W')):
+            # '$10..$17 [r|w|rw]' watches (default w), '-$10..$17' unwatches
+            raw = prompt(view, "watch $addr[..$addr] [r|w|rw], -$addr to remove: ").split()
+            try:
+                if raw and raw[0].startswith('-'):
+                    bps.unwatch(*parse_range(raw[0][1:]))
+                elif raw:
+                    mode = raw[1].lower() if len(raw) > 1 else 'w'
+                    bps.watch(*parse_range(raw[0]), read='r' in mode, write='w' in mode)
+            except ValueError as e:
+                stopped = str(e)
         elif key in (ord('\n'), ord('\r')):
             if not cpu.running:
                 # restart
-                cpu.reset()
-                _load()
+                cpu.restore(boot)
+                cpu.skipped = cpu.skipped_steps = 0
+                # fresh devices, nothing scheduled or holding the IRQ line
+                cpu.events.clear()
+                cpu.irqs.clear()
+                out = standard(cpu)[CHAR_OUT].text
+                if prof is not None: prof.clear()
+                if trace is not None:
+                    trace.stop()
+                    trace.start()
                 pause = True
             else:
                 pause = not pause
-            _step = time.time()
+            owed = 0.0
+            _tick = time.perf_counter()
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Missing args | argv[1]: <filename.asm>")
+        print("Missing args | argv[1]: <filename.asm> [--state file.state]")
         sys.exit(1)
 
-    curses.wrapper(Emulate, sys.argv[1])
+    state = None
+    if len(sys.argv) > 3 and sys.argv[2] == '--state': state = sys.argv[3]
+    curses.wrapper(Emulate, sys.argv[1], state)
@@ -0,0 +1,156 @@
+"""
+6502 execution profiler
+
+Profile(cpu).start() swaps every opcode handler for a counting wrapper,
+so step(), run() and anything built on them record executions and
+cycles per opcode and per PC into flat arrays. stop() puts the previous
+handler table back, a cpu that isn't being profiled runs exactly the
+uninstrumented code. The wrappers are a CPU.wrap_ops layer, above the
+recorder's and below watchpoints. JIT blocks don't go through the
+handlers and are not counted.
+
+Reports map PCs back to source lines through the addr_line dict from
+Assembler.parse/build.
+
+Usage: python profiler.py <filename.asm> [--max-steps N] [--top N] [--annotate]
+"""
+
+import argparse
+import sys
+from array import array
+
+from assembler import Assembler
+from cpu import CPU, MODE_LEN, OPCODES, UNKNOWN
+from devices import standard
+
+# heat column glyphs, coolest first
+HEAT = " .:-=+*#%@"
+
+
+class Profile:
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.op_count  = array('Q', bytes(8 * 256))
+        self.op_cycles = array('Q', bytes(8 * 256))
+        self.pc_count  = array('Q', bytes(8 * 65536))
+        self.pc_cycles = array('Q', bytes(8 * 65536))
+        self.active = False
+
+    def start(self):
+        self.cpu.wrap_ops('profile', self._counted, 1)
+        self.active = True
+
+    def stop(self):
+        self.cpu.wrap_ops('profile', None)
+        self.active = False
+
+    def clear(self):
+        for arr in (self.op_count, self.op_cycles, self.pc_count, self.pc_cycles):
+            arr[:] = array('Q', bytes(8 * len(arr)))
+
+    def _counted(self, op, fn):
+        # fn wrapped to count; step()/run() already advanced PC by the
+        # instr size and added the base cycles before calling it
+        mnem, mode, base = OPCODES.get(op, UNKNOWN)
+        size = 1 + MODE_LEN[mode]
+        op_count, op_cycles = self.op_count, self.op_cycles
+        pc_count, pc_cycles = self.pc_count, self.pc_cycles
+
+        def counted(cpu, operand):
+            pc = (cpu.pc - size) & 0xFFFF
+            before = cpu.cycles
+            fn(cpu, operand)
+            spent = base + cpu.cycles - before
+            op_count[op] += 1
+            op_cycles[op] += spent
+            pc_count[pc] += 1
+            pc_cycles[pc] += spent
+        return counted
+
+    @property
+    def total_cycles(self):
+        return sum(self.op_cycles)
+
+    def by_line(self, addr_line):
+        # {source line index: (count, cycles)}
+        out = {}
+        for addr, ln in addr_line.items():
+            count = self.pc_count[addr]
+            if not count: continue
+            c, cy = out.get(ln, (0, 0))
+            out[ln] = (c + count, cy + self.pc_cycles[addr])
+        return out
+
+    def heat(self, addr_line):
+        # {source line index: heat glyph} scaled to the hottest line
+        lines = self.by_line(addr_line)
+        if not lines: return {}
+        top = max(cy for _, cy in lines.values())
+        return {ln: HEAT[min(len(HEAT) - 1, 1 + cy * (len(HEAT) - 1) // top)]
+                for ln, (_, cy) in lines.items()}
+
+    def opcode_table(self):
+        # [(mnemonic/mode, count, cycles)] hottest first
+        rows = []
+        for op in range(256):
+            if not self.op_count[op]: continue
+            mnem, mode, _ = OPCODES.get(op, UNKNOWN)
+            rows.append((f"{mnem} {mode}", self.op_count[op], self.op_cycles[op]))
+        return sorted(rows, key=lambda r: -r[2])
+
+    def hot_lines(self, source_lines, addr_line, top=10):
+        # text table of the `top` source lines by cycles
+        total = self.total_cycles or 1
+        lines = sorted(self.by_line(addr_line).items(), key=lambda kv: -kv[1][1])
+        out = [f"{'line':>5} {'count':>10} {'cycles':>12} {'%':>6}  source"]
+        for ln, (count, cycles) in lines[:top]:
+            src = source_lines[ln].split(';')[0].strip() if ln < len(source_lines) else ''
+            out.append(f"{ln + 1:5d} {count:10d} {cycles:12d} {cycles * 100 / total:6.2f}  {src}")
+        return '\n'.join(out)
+
+    def annotate(self, source_lines, addr_line):
+        # whole listing with count/cycles/heat per line
+        lines = self.by_line(addr_line)
+        heat = self.heat(addr_line)
+        out = []
+        for ln, text in enumerate(source_lines):
+            count, cycles = lines.get(ln, (0, 0))
+            cols = f"{count:10d} {cycles:12d}" if count else ' ' * 23
+            out.append(f"{heat.get(ln, ' ')} {cols}  {ln + 1:4d}: {text.rstrip()}")
+        return '\n'.join(out)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="profile a 6502 program headless")
+    ap.add_argument('filename')
+    ap.add_argument('--max-steps', type=int, default=1_000_000)
+    ap.add_argument('--top', type=int, default=10)
+    ap.add_argument('--annotate', action='store_true', help="print the annotated listing")
+    args = ap.parse_args(argv)
+
+    with open(args.filename) as f: source_lines = f.readlines()
+    prog = Assembler.build(args.filename)
+    bytecode, addr_line = prog.code, prog.addr_line
+
+    cpu = CPU()
+    cpu.load(bytecode)
+    standard(cpu)
+    prof = Profile(cpu)
+    prof.start()
+    result = cpu.run(max_steps=args.max_steps)
+    prof.stop()
+
+    print(f"{args.filename}: {result.reason} after {result.steps} steps, {result.cycles} cycles\n")
+    print(prof.hot_lines(source_lines, addr_line, args.top))
+    print(f"\n{'opcode':10s} {'count':>10} {'cycles':>12}")
+    for name, count, cycles in prof.opcode_table():
+        print(f"{name:10s} {count:10d} {cycles:12d}")
+    if args.annotate:
+        print()
+        print(prof.annotate(source_lines, addr_line))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
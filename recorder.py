@@ -0,0 +1,258 @@
+"""
+6502 execution trace
+
+Trace(cpu).start() wraps the opcode handlers (like profiler.py) so every
+executed instruction appends one fixed-size record to a preallocated ring
+buffer, either a bytearray or an mmap'd file. A record holds the state
+*before* the instruction plus the byte it stored, if any:
+
+    pc:H op:B a:B x:B y:B sp:B p:B cycles:B addr:H val:B    (12 bytes)
+
+p is N V W - - I Z C, W set when addr/val hold a store. cycles is what
+the instruction took (base + branch extras).
+
+Every `interval` instructions the wrapper also takes a checkpoint, a
+CPU.snapshot() plus CPU.device_state() (device registers, scheduled
+timer deadlines, the IRQ line, char-out so far). seek(n) restores the
+last checkpoint at or before step n and re-executes the rest, so
+stepping back or jumping anywhere in the recorded range costs at most
+`interval` instructions. Seeking backwards drops the recorded future,
+running on records it again.
+
+Usage: python recorder.py <filename.asm> [--max-steps N] [--last N] [--out file.trace]
+"""
+
+import argparse
+import mmap
+import struct
+import sys
+from bisect import bisect_right
+from collections import namedtuple
+
+from cpu import MODE_LEN, OPCODES, UNKNOWN
+
+RECORD = struct.Struct('<HBBBBBBBHB')
+Record = namedtuple('Record', 'step pc op a x y sp p cycles addr val')
+Checkpoint = namedtuple('Checkpoint', 'steps snap devices')
+
+# file layout: header, then capacity records
+HEADER = struct.Struct('<4sHHIQQ')     # magic, version, record size, capacity, first step, count
+MAGIC = b'T652'
+
+P_N, P_V, P_W, P_I, P_Z, P_C = 0x80, 0x40, 0x20, 0x04, 0x02, 0x01
+
+_STORES = {'STA': 'a', 'STX': 'x', 'STY': 'y'}
+
+
+class Trace:
+
+    def __init__(self, cpu, capacity=1 << 20, interval=4096, path=None):
+        self.cpu = cpu
+        self.capacity = capacity
+        self.interval = interval
+        self.path = path
+        size = RECORD.size * capacity
+        if path is None:
+            self._file = None
+            self.buf = bytearray(size)
+            self._off = 0
+        else:
+            self._file = open(path, 'w+b')
+            self._file.truncate(HEADER.size + size)
+            self.buf = mmap.mmap(self._file.fileno(), HEADER.size + size)
+            self._off = HEADER.size
+        self.first = 0          # step number of record 0
+        self.count = 0          # records written, including overwritten ones
+        self.checkpoints = []   # Checkpoints, ascending steps
+        self.active = False
+
+    def start(self):
+        # a fresh trace unless resuming exactly where the last one stopped
+        cpu = self.cpu
+        if not self.count or cpu.steps != self.newest:
+            self.first = cpu.steps
+            self.count = 0
+            self.checkpoints = [self._here()]
+        cpu.wrap_ops('trace', self._traced, 0)
+        self.active = True
+
+    def stop(self):
+        self.cpu.wrap_ops('trace', None)
+        self.active = False
+
+    def close(self):
+        if self.active: self.stop()
+        if self._file is not None:
+            self.flush()
+            self.buf.close()
+            self._file.close()
+            self._file = None
+
+    def flush(self):
+        if self._file is None: return
+        HEADER.pack_into(self.buf, 0, MAGIC, 1, RECORD.size, self.capacity, self.first, self.count)
+        self.buf.flush()
+
+    def _traced(self, op, fn):
+        # fn wrapped to append a record; step()/run() already advanced PC
+        # and added the base cycles before calling it
+        mnem, mode, base = OPCODES.get(op, UNKNOWN)
+        size = 1 + MODE_LEN[mode]
+        reg = _STORES.get(mnem)
+        zpx = mode == 'zpx'
+        pack, buf, off = RECORD.pack_into, self.buf, self._off
+        cap, interval = self.capacity, self.interval
+        rsize = RECORD.size
+        trace = self
+
+        def traced(cpu, operand):
+            i = trace.count
+            pc = (cpu.pc - size) & 0xFFFF
+            before = cpu.cycles
+            if not i % interval and i:
+                trace._checkpoint(pc, before - base, trace.first + i)
+            a, x, y, sp, nz = cpu.a, cpu.x, cpu.y, cpu.sp, cpu._nz
+            p = (cpu.flag_v << 6) | (cpu.flag_i << 2) | cpu.flag_c
+            if nz & 0x180: p |= P_N
+            if not nz & 0xFF: p |= P_Z
+            fn(cpu, operand)
+            if reg is None:
+                addr = val = 0
+            else:
+                addr = (operand + x) & 0xFF if zpx else operand
+                val = cpu.memory[addr]
+                p |= P_W
+            pack(buf, off + (i % cap) * rsize, pc, op, a, x, y, sp, p,
+                 base + cpu.cycles - before, addr, val)
+            trace.count = i + 1
+        return traced
+
+    def _checkpoint(self, pc, cycles, steps):
+        # state before the instruction about to run at pc
+        cks = self.checkpoints
+        if cks[-1].steps == steps: return
+        snap = self.cpu.snapshot()._replace(pc=pc, cycles=cycles, steps=steps)
+        cks.append(Checkpoint(steps, snap, self.cpu.device_state()))
+        # keep one checkpoint at or before the oldest record still held
+        oldest = self.oldest
+        while len(cks) > 1 and cks[1].steps <= oldest:
+            del cks[0]
+
+    def _here(self):
+        cpu = self.cpu
+        return Checkpoint(cpu.steps, cpu.snapshot(), cpu.device_state())
+
+    @property
+    def oldest(self):
+        # first step still in the ring
+        return self.first + max(0, self.count - self.capacity)
+
+    @property
+    def newest(self):
+        # steps covered: records exist for oldest .. newest-1
+        return self.first + self.count
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def record(self, step):
+        # Record of the instruction executed as step+1 (state after `step`
+        # steps), step in [oldest, newest)
+        if not self.oldest <= step < self.newest:
+            raise IndexError(f"step {step} not in trace [{self.oldest}, {self.newest})")
+        i = (step - self.first) % self.capacity
+        return Record(step, *RECORD.unpack_from(self.buf, self._off + i * RECORD.size))
+
+    def records(self, lo=None, hi=None):
+        lo = self.oldest if lo is None else max(lo, self.oldest)
+        hi = self.newest if hi is None else min(hi, self.newest)
+        for step in range(lo, hi):
+            yield self.record(step)
+
+    def seek(self, step):
+        # put the cpu in its state after `step` steps. within the recorded
+        # range this restores a checkpoint and replays at most `interval`
+        # instructions uninstrumented; past the end it just runs forward.
+        # returns the step reached (less than asked if BRK came first)
+        cpu = self.cpu
+        step = max(step, self.checkpoints[0].steps)
+        if step >= self.newest and cpu.steps == self.newest:
+            cpu.run(max_steps=step - cpu.steps)
+            return cpu.steps
+
+        cks = self.checkpoints
+        ck = cks[bisect_right([c.steps for c in cks], step) - 1]
+        # replay on the plain handlers with no breakpoints, then put the
+        # wrap_ops layers back
+        breaks, cpu.breaks = cpu.breaks, None
+        cpu.set_ops(None)
+        cpu.restore(ck.snap)
+        cpu.set_device_state(ck.devices)
+        cpu.run(max_steps=step - ck.steps)
+        cpu.breaks = breaks
+        cpu.wrap_ops('trace', self._traced if self.active else None, 0)
+
+        # the recorded future is gone once we run on from here
+        self.count = min(self.count, cpu.steps - self.first)
+        del cks[bisect_right([c.steps for c in cks], cpu.steps):]
+        if not cks: cks.append(self._here())
+        return cpu.steps
+
+    def back(self, n=1):
+        return self.seek(self.cpu.steps - n)
+
+
+def load(path):
+    # (first step, [Records]) from a file written with Trace(path=...)
+    with open(path, 'rb') as f: data = f.read()
+    magic, version, rsize, capacity, first, count = HEADER.unpack_from(data)
+    if magic != MAGIC or rsize != RECORD.size:
+        raise ValueError(f"{path}: not a trace file")
+    oldest = max(0, count - capacity)
+    out = []
+    for n in range(oldest, count):
+        off = HEADER.size + (n % capacity) * rsize
+        out.append(Record(first + n, *RECORD.unpack_from(data, off)))
+    return first, out
+
+
+def format_record(r):
+    mnem, mode, _ = OPCODES.get(r.op, UNKNOWN)
+    flags = ''.join(ch if r.p & bit else '.' for ch, bit in
+                    (('N', P_N), ('V', P_V), ('I', P_I), ('Z', P_Z), ('C', P_C)))
+    line = (f"{r.step:10d}  ${r.pc:04X}  {r.op:02X} {mnem}  A:{r.a:02X} X:{r.x:02X} "
+            f"Y:{r.y:02X} SP:{r.sp:02X} {flags}  +{r.cycles}")
+    if r.p & P_W: line += f"  [${r.addr:04X}]={r.val:02X}"
+    return line
+
+
+def main(argv=None):
+    from assembler import Assembler
+    from cpu import CPU
+    from devices import standard
+
+    ap = argparse.ArgumentParser(description="run a 6502 program headless and dump its trace")
+    ap.add_argument('filename')
+    ap.add_argument('--max-steps', type=int, default=1_000_000)
+    ap.add_argument('--last', type=int, default=20, help="records to print from the end")
+    ap.add_argument('--out', help="record into this file (mmap) instead of memory")
+    args = ap.parse_args(argv)
+
+    cpu = CPU()
+    cpu.load(Assembler.build(args.filename).code)
+    standard(cpu)
+    trace = Trace(cpu, capacity=max(args.max_steps, 1), path=args.out)
+    trace.start()
+    result = cpu.run(max_steps=args.max_steps)
+    trace.stop()
+
+    print(f"{args.filename}: {result.reason} after {result.steps} steps, {result.cycles} cycles, "
+          f"{len(trace)} records ({len(trace) * RECORD.size} bytes), {len(trace.checkpoints)} checkpoints")
+    for r in trace.records(trace.newest - args.last):
+        print(format_record(r))
+    trace.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
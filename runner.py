@@ -0,0 +1,170 @@
+"""
+6502 headless test runner
+
+Assembles every .asm file given (directories are searched recursively),
+runs each one headless to BRK or a step/cycle limit and checks the
+expected state declared in the source:
+
+    ; EXPECT $10..$17 = 01 08 0C 15 2A 35 3F 4B    memory range
+    ; EXPECT $20 = 01                              single byte
+    ; EXPECT A = $3F                               A X Y SP PC
+    ; EXPECT C = 1                                 N V Z C
+    ; EXPECT CYCLES = 438                          STEPS CYCLES
+
+Values are hex, '$' optional. The reference devices (devices.standard)
+are mapped, output written to the char-out port is discarded. Busy-wait
+loops are fast-forwarded (see CPU.idle), the steps and cycles skipped
+that way are shown, and left out of the MIPS figure. Files are spread
+over a process pool, one result line is printed per program as it
+finishes, then a summary.
+
+Usage: python runner.py [-j N] [--max-steps N] [--max-cycles N] [--jit|--aot] <path>...
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from multiprocessing import Pool
+
+from assembler import Assembler
+from cpu import CPU
+from devices import standard
+
+_EXPECT = re.compile(r';\s*EXPECT\s+(.+?)\s*=\s*(.+?)\s*$', re.I)
+_RANGE  = re.compile(r'\$([0-9A-F]+)(?:\s*\.\.\s*\$([0-9A-F]+))?$', re.I)
+
+REGS  = {'A': 'a', 'X': 'x', 'Y': 'y', 'SP': 'sp', 'PC': 'pc'}
+FLAGS = {'N': 'flag_n', 'V': 'flag_v', 'Z': 'flag_z', 'C': 'flag_c'}
+COUNTERS = {'STEPS': 'steps', 'CYCLES': 'cycles'}
+
+
+def parse_expects(lines):
+    # [(label, kind, where, values)], kind 'mem' (where = start addr) or
+    # 'reg' (where = cpu attribute)
+    out = []
+    for ln, line in enumerate(lines, 1):
+        m = _EXPECT.search(line)
+        if not m: continue
+        lhs, rhs = m.group(1).strip(), m.group(2)
+        values = [int(v.lstrip('$'), 16) for v in rhs.split()]
+        name = lhs.upper()
+        if name in REGS or name in FLAGS or name in COUNTERS:
+            if len(values) != 1:
+                raise ValueError(f"line {ln}: {lhs} takes one value")
+            out.append((name, 'reg', REGS.get(name) or FLAGS.get(name) or COUNTERS[name], values))
+            continue
+        r = _RANGE.match(lhs)
+        if not r:
+            raise ValueError(f"line {ln}: can't parse EXPECT target {lhs!r}")
+        lo = int(r.group(1), 16)
+        hi = int(r.group(2), 16) if r.group(2) else lo
+        if hi - lo + 1 != len(values):
+            raise ValueError(f"line {ln}: {lhs} spans {hi - lo + 1} bytes, got {len(values)} values")
+        out.append((lhs, 'mem', lo, values))
+    return out
+
+
+def check(cpu, expects):
+    # mismatch messages, empty when everything holds
+    errors = []
+    for label, kind, where, values in expects:
+        if kind == 'reg':
+            got = getattr(cpu, where)
+            if got != values[0]:
+                errors.append(f"{label}: expected {values[0]:02X} got {got:02X}")
+            continue
+        got = cpu.memory[where:where + len(values)]
+        for i, (want, have) in enumerate(zip(values, got)):
+            if want != have:
+                errors.append(f"${where + i:04X}: expected {want:02X} got {have:02X}")
+    return errors
+
+
+def run_file(job):
+    # worker: (path, status, reason, steps, cycles, skipped, skipped steps,
+    # messages)
+    path, max_steps, max_cycles, engine = job
+    try:
+        with open(path) as f: expects = parse_expects(f)
+        if engine == 'aot':
+            from aot import build
+            prog, module = build(path)
+        else:
+            prog = Assembler.build(path)
+    except Exception as e:
+        return path, 'ERROR', '-', 0, 0, 0, 0, [f"{type(e).__name__}: {e}"]
+
+    cpu = CPU()
+    cpu.load(prog.code)
+    standard(cpu)
+    if engine == 'jit':
+        from jit import JIT
+        result = JIT(cpu).run(max_steps=max_steps, max_cycles=max_cycles)
+    elif engine == 'aot':
+        from aot import AOT
+        result = AOT(cpu, module).run(max_steps=max_steps, max_cycles=max_cycles)
+    else:
+        result = cpu.run(max_steps=max_steps, max_cycles=max_cycles)
+
+    errors = check(cpu, expects)
+    status = 'FAIL' if errors else ('PASS' if expects else 'RAN')
+    return (path, status, result.reason, result.steps, result.cycles, result.skipped,
+            cpu.skipped_steps, errors)
+
+
+def find_sources(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.asm'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="run .asm programs headless and check their EXPECT lines")
+    ap.add_argument('paths', nargs='+', help=".asm files or directories")
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    ap.add_argument('--max-steps', type=int, default=1_000_000)
+    ap.add_argument('--max-cycles', type=int, default=None)
+    ap.add_argument('--jit', action='store_const', const='jit', dest='engine', default='run',
+                    help="use the basic-block JIT")
+    ap.add_argument('--aot', action='store_const', const='aot', dest='engine',
+                    help="use the ahead-of-time translation (aot.py, cached next to the source)")
+    args = ap.parse_args(argv)
+
+    files = list(find_sources(args.paths))
+    jobs = [(path, args.max_steps, args.max_cycles, args.engine) for path in files]
+    # a few chunks per worker keeps the pool busy without one IPC per file
+    chunk = max(1, len(jobs) // (args.jobs * 8))
+
+    counts = {'PASS': 0, 'RAN': 0, 'FAIL': 0, 'ERROR': 0}
+    instrs = idle = 0
+    start = time.perf_counter()
+    with Pool(args.jobs) as pool:
+        for (path, status, reason, steps, cycles, skipped, skipped_steps,
+             msgs) in pool.imap_unordered(run_file, jobs, chunk):
+            counts[status] += 1
+            # only the steps actually executed count towards MIPS
+            instrs += steps - skipped_steps
+            idle += skipped_steps
+            note = f" ({skipped_steps} steps, {skipped} cycles skipped idle)" if skipped else ""
+            print(f"{status:5s} {path}  {reason}  {steps} steps  {cycles} cycles{note}", flush=True)
+            for msg in msgs:
+                print(f"      {msg}", flush=True)
+    wall = time.perf_counter() - start
+
+    print(f"{len(files)} programs: {counts['PASS']} passed, {counts['FAIL']} failed, "
+          f"{counts['ERROR']} errors, {counts['RAN']} without EXPECT")
+    print(f"{instrs} instructions executed, {idle} skipped idle, in {wall:.2f} s, "
+          f"{instrs / wall / 1e6 if wall else 0:.2f} MIPS")
+    return 1 if counts['FAIL'] or counts['ERROR'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+"""
+6502 debug server
+
+An asyncio server hosting any number of headless machines for remote
+debugger sessions, over TCP or a Unix socket. The protocol is one JSON
+object per line each way, replies matched to requests by id:
+
+    -> {"id": 1, "cmd": "run", "until": "done"}
+    <- {"id": 1, "ok": true, "reason": "pc", "steps": 506, ..., "regs": {...}}
+    <- {"id": 2, "ok": false, "error": "unknown label 'dnoe'"}
+
+A connection starts with no machine: new or load makes one and selects
+it, attach selects another by id, so sessions can share a machine. A
+machine goes away with drop or when the last session on it closes.
+Requests on one connection are served concurrently (stop can reach a
+run in progress), commands on one machine one at a time.
+
+    new                                         -> machine
+    attach    machine                           -> machine
+    machines                                    -> machines
+    drop      [machine]
+    load      source | code (hex) [addr] [seed] -> machine origin size labels regs
+    regs                                        -> regs
+    set       a x y sp pc p (any of them)       -> regs
+    read      addr [len=1]                      -> data (hex)
+    write     addr data (hex)
+    step      [count=1]                         -> steps regs
+    run       [until] [max_steps] [max_cycles]  -> reason steps cycles skipped regs
+                                                   ('idle' if parked in a busy-wait)
+    stop                                        the current run returns 'stopped'
+    break     at [remove]                       -> breaks
+    watch     range [mode=w|r|rw] [remove]      -> hit (of the last watch stop)
+    snapshot  [data]                            -> snap [state (base64 to_bytes)]
+    restore   snap | state                      -> regs
+    output                                      -> out (char-out text so far)
+
+Addresses are ints or breakpoint specs ('$0230', a source line, a label).
+run and step execute in slices of --slice instructions and yield to the
+event loop after each, so a long or endless run on one machine never
+holds up the others; a thread executor would not help the pure-Python
+CPU, which holds the GIL throughout.
+
+Usage: python server.py [--host H] [--port N | --unix PATH] [--slice N]
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import sys
+
+from assembler import ORIGIN, Assembler
+from breakpoints import Breakpoints, parse_range, resolve
+from cpu import CPU
+from devices import CHAR_OUT, standard
+
+PORT = 6502
+SLICE = 2_000          # instrs between yields to the event loop
+LINE_LIMIT = 1 << 24    # longest request line (a load with its source)
+
+REGS = ('a', 'x', 'y', 'sp', 'pc', 'p')
+
+
+def _int(req, name, default=None, min=None):
+    # an int field of a request, ValueError for anything else (1e999,
+    # "10", true) or for one below min
+    val = req.get(name, default)
+    if val is default: return val
+    if not isinstance(val, int) or isinstance(val, bool): raise ValueError(f"{name} must be an int, got {val!r}")
+    if min is not None and val < min: raise ValueError(f"{name} must be at least {min}, got {val}")
+    return val
+
+
+class Machine:
+    # one CPU with its devices, breakpoints, program info and snapshots
+
+    def __init__(self, mid):
+        self.id = mid
+        self.lock = asyncio.Lock()
+        self.sessions = set()
+        self.stopping = False
+        self.boot()
+
+    def boot(self, seed=None):
+        cpu = self.cpu = CPU()
+        self.out = standard(cpu, seed=seed)[CHAR_OUT].text
+        self.bps = Breakpoints(cpu)
+        self.addr_line, self.labels = {}, {}
+        self.snaps = []
+
+    def addr(self, spec):
+        if isinstance(spec, int) and not isinstance(spec, bool): return spec & 0xFFFF
+        if isinstance(spec, str): return resolve(spec, self.addr_line, self.labels) & 0xFFFF
+        raise ValueError(f"bad address {spec!r}")
+
+    def regs(self):
+        cpu = self.cpu
+        regs = {'a': cpu.a, 'x': cpu.x, 'y': cpu.y, 'sp': cpu.sp, 'pc': cpu.pc, 'p': cpu.p,
+                'cycles': cpu.cycles, 'steps': cpu.steps, 'running': cpu.running}
+        line = self.addr_line.get(cpu.pc)
+        if line is not None: regs['line'] = line + 1
+        return regs
+
+
+class Server:
+
+    def __init__(self, slice=SLICE):
+        self.slice = slice
+        self.machines = {}
+        self._ids = itertools.count(1)
+
+    # ---------------------------------------------
+    # connections
+    # ---------------------------------------------
+    async def handle(self, reader, writer):
+        session = {'machine': None, 'attached': set()}
+        wlock = asyncio.Lock()
+        tasks = set()
+
+        async def reply(msg):
+            async with wlock:
+                writer.write(json.dumps(msg, separators=(',', ':')).encode() + b'\n')
+                await writer.drain()
+
+        async def serve(req):
+            rid = req.get('id')
+            try:
+                msg = {'id': rid, 'ok': True, **await self.dispatch(session, req)}
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # whatever went wrong, the client gets its reply
+                error = f"missing {e.args[0]!r}" if type(e) is KeyError else str(e) or type(e).__name__
+                msg = {'id': rid, 'ok': False, 'error': error}
+            # the client may be gone by the time a long run returns
+            try: await reply(msg)
+            except ConnectionError: pass
+
+        try:
+            while True:
+                try: line = await reader.readline()
+                except ValueError:
+                    await reply({'id': None, 'ok': False, 'error': "line too long"})
+                    break
+                if not line: break
+                try:
+                    req = json.loads(line)
+                    if not isinstance(req, dict): raise ValueError("not an object")
+                except ValueError as e:
+                    await reply({'id': None, 'ok': False, 'error': f"bad request: {e}"})
+                    continue
+                task = asyncio.create_task(serve(req))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for task in tasks: task.cancel()
+            for mid in session['attached']: self._detach(mid, session)
+            writer.close()
+
+    def _detach(self, mid, session):
+        m = self.machines.get(mid)
+        if m is None: return
+        m.sessions.discard(id(session))
+        if not m.sessions:
+            m.stopping = True
+            del self.machines[mid]
+
+    def _select(self, session, m):
+        session['machine'] = m.id
+        session['attached'].add(m.id)
+        m.sessions.add(id(session))
+
+    # ---------------------------------------------
+    # commands
+    # ---------------------------------------------
+    async def dispatch(self, session, req):
+        cmd = req.get('cmd')
+        if cmd == 'new':
+            m = Machine(next(self._ids))
+            self.machines[m.id] = m
+            self._select(session, m)
+            return {'machine': m.id}
+        if cmd == 'attach':
+            m = self.machines.get(req['machine'])
+            if m is None: raise ValueError(f"no machine {req['machine']}")
+            self._select(session, m)
+            return {'machine': m.id}
+        if cmd == 'machines':
+            return {'machines': sorted(self.machines)}
+        fn = getattr(self, f"cmd_{cmd}", None) if isinstance(cmd, str) else None
+        if fn is None and cmd not in ('drop', 'stop'): raise ValueError(f"unknown command {cmd!r}")
+        if cmd == 'load' and session['machine'] not in self.machines:
+            await self.dispatch(session, {'cmd': 'new'})
+
+        mid = req.get('machine', session['machine'])
+        m = self.machines.get(mid)
+        if m is None: raise ValueError("no machine, send new or load first" if mid is None else f"no machine {mid}")
+        if cmd == 'drop':
+            m.stopping = True
+            self.machines.pop(m.id, None)
+            return {}
+        if cmd == 'stop':
+            # not under the lock: it has to get in while a run holds it
+            m.stopping = True
+            return {}
+        async with m.lock:
+            m.stopping = False
+            return await fn(m, req)
+
+    async def cmd_load(self, m, req):
+        # a bad request leaves the machine as it was
+        seed, labels, addr_line = _int(req, 'seed'), {}, {}
+        if 'source' in req:
+            code, addr_line = Assembler.assemble(io.StringIO(req['source']), labels)
+            addr = ORIGIN
+        else:
+            code, addr = bytes.fromhex(req['code']), m.addr(req.get('addr', ORIGIN))
+        m.boot(seed)
+        m.addr_line, m.labels = addr_line, labels
+        m.cpu.load(code, addr)
+        m.cpu.pc = addr
+        return {'machine': m.id, 'origin': addr, 'size': len(code), 'labels': labels, 'regs': m.regs()}
+
+    async def cmd_regs(self, m, req):
+        return {'regs': m.regs()}
+
+    async def cmd_set(self, m, req):
+        cpu = m.cpu
+        for name in REGS:
+            if name not in req: continue
+            val = m.addr(req[name]) if name == 'pc' else _int(req, name) & 0xFF
+            setattr(cpu, name, val)
+        return {'regs': m.regs()}
+
+    async def cmd_read(self, m, req):
+        lo = m.addr(req['addr'])
+        n = _int(req, 'len', 1)
+        if not 0 <= n <= 65536 - lo: raise ValueError(f"bad length {n}")
+        return {'data': bytes(m.cpu.memory[lo:lo + n]).hex()}
+
+    async def cmd_write(self, m, req):
+        lo = m.addr(req['addr'])
+        data = bytes.fromhex(req['data'])
+        if lo + len(data) > 65536: raise ValueError("write past $FFFF")
+        # load() drops any decoded or compiled code over the range, but
+        # also points PC/SP at it
+        cpu = m.cpu
+        pc, sp = cpu.pc, cpu.sp
+        cpu.load(data, lo)
+        cpu.pc, cpu.sp = pc, sp
+        return {}
+
+    async def cmd_step(self, m, req):
+        count = _int(req, 'count', 1, min=0)
+        cpu = m.cpu
+        step = cpu.step
+        done = 0
+        while done < count and cpu.running and not m.stopping:
+            n = min(self.slice, count - done)
+            for _ in range(n): step()
+            done += n
+            if done < count: await asyncio.sleep(0)
+        return {'steps': done, 'regs': m.regs()}
+
+    async def cmd_run(self, m, req):
+        cpu = m.cpu
+        target = m.addr(req['until']) if req.get('until') is not None else None
+        # cpu.run() takes a negative limit for none at all, which would
+        # never hand the event loop back
+        left_steps, left_cycles = _int(req, 'max_steps', min=0), _int(req, 'max_cycles', min=0)
+        steps = cycles = skipped = 0
+        while True:
+            n = self.slice if left_steps is None else max(0, min(self.slice, left_steps))
+            result = cpu.run(max_steps=n, max_cycles=left_cycles, until_pc=target)
+            steps += result.steps
+            cycles += result.cycles
+            skipped += result.skipped
+            reason = result.reason
+            if left_steps is not None: left_steps -= result.steps
+            if left_cycles is not None: left_cycles -= result.cycles
+            if reason != 'steps' or left_steps == 0: break
+            # with no step limit of the caller's, a slice that ended in an
+            # idle fast-forward with nothing scheduled never wakes up
+            if left_steps is None and result.skipped and not cpu.events:
+                reason = 'idle'
+                break
+            # between slices: let the other sessions in
+            await asyncio.sleep(0)
+            if m.stopping:
+                reason = 'stopped'
+                break
+        out = {'reason': reason, 'steps': steps, 'cycles': cycles, 'skipped': skipped, 'regs': m.regs()}
+        if reason in ('break', 'watch'): out['stop'] = m.bps.describe(result)
+        return out
+
+    async def cmd_break(self, m, req):
+        addr = m.addr(req['at'])
+        if req.get('remove'): m.bps.remove(addr)
+        else: m.bps.add(addr)
+        return {'breaks': sorted(m.bps.addrs)}
+
+    async def cmd_watch(self, m, req):
+        lo, hi = parse_range(req['range'])
+        if req.get('remove'): m.bps.unwatch(lo, hi)
+        else:
+            mode = req.get('mode', 'w')
+            m.bps.watch(lo, hi, read='r' in mode, write='w' in mode)
+        return {'watched': m.bps.watched, 'hit': m.bps.hit}
+
+    async def cmd_snapshot(self, m, req):
+        m.snaps.append(m.cpu.snapshot())
+        out = {'snap': len(m.snaps) - 1}
+        if req.get('data'): out['state'] = base64.b64encode(m.cpu.to_bytes()).decode()
+        return out
+
+    async def cmd_restore(self, m, req):
+        if 'state' in req: m.cpu.from_bytes(base64.b64decode(req['state']))
+        else:
+            n = _int(req, 'snap')
+            if n is None: raise KeyError('snap')
+            # no counting from the end: -1 is no snapshot, not the last
+            if not 0 <= n < len(m.snaps): raise ValueError(f"no snapshot {n}")
+            m.cpu.restore(m.snaps[n])
+        return {'regs': m.regs()}
+
+    async def cmd_output(self, m, req):
+        return {'out': bytes(m.out).decode('latin-1')}
+
+
+async def serve(server, host='127.0.0.1', port=PORT, unix=None):
+    # -> the listening asyncio.Server (start_server / start_unix_server)
+    if unix:
+        if os.path.exists(unix): os.unlink(unix)
+        return await asyncio.start_unix_server(server.handle, unix, limit=LINE_LIMIT)
+    return await asyncio.start_server(server.handle, host, port, limit=LINE_LIMIT)
+
+
+async def _main(args):
+    listener = await serve(Server(args.slice), args.host, args.port, args.unix)
+    where = args.unix or ', '.join(f"{s.getsockname()[0]}:{s.getsockname()[1]}" for s in listener.sockets)
+    print(f"6502 debug server on {where}", flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="serve headless 6502 machines to remote debugger sessions")
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=PORT)
+    ap.add_argument('--unix', help="listen on this Unix socket instead of TCP")
+    ap.add_argument('--slice', type=int, default=SLICE, help="instrs per run slice")
+    args = ap.parse_args(argv)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+6502 machine state in a memory-mapped file
+
+StateFile(path) maps a file laid out as
+
+    $00000..$0FFFF  memory
+    $10000          registers and counters, the cpu.STATE header
+
+and CPU(sf.memory) runs straight on that mapping: loads and stores are
+mmap indexing (no slower than the bytearray), nothing is copied and the
+OS writes dirty pages back by itself. Registers stay in the CPU's slots
+while it runs; save(cpu) packs them into the header, load(cpu) brings
+them back after a restart. registers=False maps a plain 64 KiB memory
+file instead.
+
+Other processes open the same file with readonly=True and see memory
+change as it is written (see viewer.py), with the registers as of the
+last save().
+
+Usage: python statefile.py <file.state> <filename.asm> [--max-steps N] [--slice N] [--fresh]
+       runs the program on the state file, resuming where the last run
+       left off when the file holds one
+"""
+
+import argparse
+import mmap
+import os
+import sys
+import time
+
+from assembler import Assembler
+from cpu import CPU, STATE, STATE_MAGIC
+from devices import standard
+
+MEMORY = 65536
+
+
+class StateFile:
+
+    def __init__(self, path, registers=True, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            self._file = open(path, 'rb')
+            size = os.fstat(self._file.fileno()).st_size
+            if size < MEMORY: raise ValueError(f"{path}: {size} bytes, not a memory image")
+            registers = registers and size >= MEMORY + STATE.size
+            access = mmap.ACCESS_READ
+        else:
+            self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            size = MEMORY + (STATE.size if registers else 0)
+            if os.fstat(self._file.fileno()).st_size < size: self._file.truncate(size)
+            access = mmap.ACCESS_WRITE
+        fd = self._file.fileno()
+        self.memory = mmap.mmap(fd, MEMORY, access=access)
+        # the header is its own mapping at $10000, page aligned
+        self._regs = mmap.mmap(fd, STATE.size, offset=MEMORY, access=access) if registers else None
+
+    @property
+    def saved(self):
+        # does the header hold a save()
+        return self._regs is not None and self._regs[:len(STATE_MAGIC)] == STATE_MAGIC
+
+    def cpu(self):
+        # a CPU running on the mapped memory, registers loaded if saved
+        cpu = CPU(self.memory)
+        if self.saved: self.load(cpu)
+        return cpu
+
+    def save(self, cpu):
+        if self._regs is not None: self._regs[:] = cpu._header()
+
+    def load(self, cpu):
+        # ValueError if nothing was saved
+        if self._regs is None: raise ValueError(f"{self.path}: no registers")
+        cpu._set_header(self._regs)
+
+    def registers(self):
+        # {name: value} from the header as last saved, None if never
+        if not self.saved: return None
+        _, _, a, x, y, sp, p, pc, running, cycles, steps, skipped = STATE.unpack_from(self._regs)
+        return {'a': a, 'x': x, 'y': y, 'sp': sp, 'p': p, 'pc': pc, 'running': running,
+                'cycles': cycles, 'steps': steps, 'skipped': skipped}
+
+    def flush(self):
+        # on disk now rather than when the OS gets to it
+        if self.readonly: return
+        self.memory.flush()
+        if self._regs is not None: self._regs.flush()
+
+    def close(self):
+        # a cpu on this memory can't run afterwards
+        if self._file is None: return
+        self.flush()
+        self.memory.close()
+        if self._regs is not None: self._regs.close()
+        self._file.close()
+        self._file = None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="run a 6502 program on a memory-mapped state file")
+    ap.add_argument('state')
+    ap.add_argument('filename')
+    ap.add_argument('--max-steps', type=int, default=None, help="stop after this many steps in total")
+    ap.add_argument('--slice', type=int, default=100_000, help="steps between register saves")
+    ap.add_argument('--fresh', action='store_true', help="load the program even if the file holds a run")
+    args = ap.parse_args(argv)
+
+    sf = StateFile(args.state)
+    cpu = sf.cpu()
+    standard(cpu)
+    if args.fresh or not sf.saved:
+        cpu.reset()
+        cpu.load(Assembler.build(args.filename).code)
+        how = "started"
+    else:
+        how = f"resumed at step {cpu.steps}, PC ${cpu.pc:04X}"
+    print(f"{args.state}: {how}", flush=True)
+
+    t0, steps0 = time.perf_counter(), cpu.steps
+    reason = 'steps' if cpu.running else 'halted'
+    try:
+        while cpu.running:
+            left = args.slice if args.max_steps is None else min(args.slice, args.max_steps - cpu.steps)
+            if left <= 0: break
+            result = cpu.run(max_steps=left)
+            reason = result.reason
+            sf.save(cpu)
+            if reason not in ('steps', 'cycles'): break
+    except KeyboardInterrupt:
+        reason = 'interrupted'
+    sf.save(cpu)
+    sf.close()
+    wall = time.perf_counter() - t0
+    print(f"{args.state}: {reason} at step {cpu.steps}, PC ${cpu.pc:04X}, {cpu.cycles} cycles "
+          f"({(cpu.steps - steps0) / wall / 1e6 if wall else 0:.2f} MIPS)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+6502 input sweeps over a process pool
+
+sweep(code, inputs, extract) runs one assembled program once per input
+and yields (input, extract(cpu, result)) in input order. An input is a
+dict of {addr: bytes} to poke and/or {'a'|'x'|'y': value} registers to
+set before the run starts at `start`. extract must be picklable (a
+module-level function or a functools.partial of one, see registers and
+peek).
+
+The pristine memory image is put in multiprocessing.shared_memory once;
+each worker attaches to it by name and between runs copies back only the
+16-byte rows the previous run wrote (CPU.dirty_rows), so no task carries
+a memory image. Inputs go out and results come back in chunks, with a
+few chunks per worker in flight so a huge generator is consumed as the
+results are.
+
+The machine is a bare CPU: nothing mapped, no events. Busy-wait loops
+are fast-forwarded as usual (see CPU.idle).
+
+Usage: python sweep.py <filename.asm> [--start SPEC] [--byte $10]... [--perm $10..$17[=01 02 ..]]
+                       [--result $20..$22] [-j N] [--chunk N] [--max-steps N] [-v]
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter, deque
+from functools import partial
+from itertools import islice, permutations, product
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+from assembler import Assembler
+from breakpoints import parse_range, resolve
+from cpu import CPU
+
+# this process's machine, set up by _attach()
+_worker = None
+
+
+def registers(cpu, result):
+    # default extract: why it stopped and the registers
+    return (result.reason, cpu.a, cpu.x, cpu.y, result.steps, result.cycles)
+
+
+def peek(lo, hi, cpu, result):
+    # memory [lo, hi] as bytes; use partial(peek, lo, hi)
+    return bytes(cpu.memory[lo:hi + 1])
+
+
+def _attach(name, start, max_steps, max_cycles, extract):
+    # pool initializer: one CPU per worker over the shared image
+    global _worker
+    # attaching registers the name with the resource tracker the pool
+    # shares with the parent again, the parent's unlink() clears it
+    shm = SharedMemory(name)
+    cpu = CPU()
+    cpu.load(shm.buf, 0)
+    cpu.dirty_rows[:] = bytes(len(cpu.dirty_rows))
+    _worker = (cpu, shm, start, max_steps, max_cycles, extract)
+
+
+def _run_chunk(inputs):
+    # [(input, extracted result)] for one chunk, on this worker's cpu
+    cpu, shm, start, max_steps, max_cycles, extract = _worker
+    rows = cpu.dirty_rows
+    out = []
+    for spec in inputs:
+        # back to the image: only the rows the last run (or input) wrote
+        cpu.reset()
+        row = rows.find(1)
+        while row >= 0:
+            end = rows.find(0, row)
+            if end < 0: end = len(rows)
+            cpu.load(shm.buf[row << 4:end << 4], row << 4)
+            row = rows.find(1, end)
+        rows[:] = bytes(len(rows))
+
+        for key, val in spec.items():
+            if isinstance(key, str): setattr(cpu, key, val)
+            else: cpu.load(val, key)
+        cpu.pc, cpu.sp = start, 0xFF
+
+        result = cpu.run(max_steps=max_steps, max_cycles=max_cycles)
+        out.append((spec, extract(cpu, result)))
+    return out
+
+
+def sweep(code, inputs, extract=registers, jobs=None, chunk=256, addr=0x0200,
+          start=None, max_steps=1_000_000, max_cycles=None):
+    # -> iterator of (input, result) in input order. jobs=0 runs in this
+    # process (same code path, no pool)
+    cpu = CPU()
+    cpu.load(code, addr)
+    start = addr if start is None else start
+    shm = SharedMemory(create=True, size=len(cpu.memory))
+    try:
+        shm.buf[:] = cpu.memory
+        args = (shm.name, start, max_steps, max_cycles, extract)
+        inputs = iter(inputs)
+        chunks = iter(lambda: list(islice(inputs, chunk)), [])
+
+        if jobs == 0:
+            _attach(*args)
+            try:
+                for part in chunks: yield from _run_chunk(part)
+            finally:
+                _worker[1].close()
+            return
+
+        jobs = jobs or os.cpu_count() or 1
+        with Pool(jobs, _attach, args) as pool:
+            pending = deque()
+            for part in chunks:
+                pending.append(pool.apply_async(_run_chunk, (part,)))
+                if len(pending) >= 4 * jobs: yield from pending.popleft().get()
+            while pending: yield from pending.popleft().get()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _grid(byte_addrs, perm):
+    # CLI inputs: every value at each --byte addr x every --perm ordering
+    orders = [None]
+    if perm:
+        span, _, vals = perm.partition('=')
+        lo, hi = parse_range(span)
+        vals = [int(v, 16) for v in vals.split()] or list(range(1, hi - lo + 2))
+        if len(vals) != hi - lo + 1:
+            raise ValueError(f"--perm {span} takes {hi - lo + 1} values, got {len(vals)}")
+        orders = permutations(vals)
+    for order in orders:
+        for values in product(range(256), repeat=len(byte_addrs)):
+            spec = {}
+            if order is not None: spec[lo] = bytes(order)
+            for a, v in zip(byte_addrs, values): spec[a] = bytes([v])
+            yield spec
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="run a 6502 program over a grid of inputs on all cores")
+    ap.add_argument('filename')
+    ap.add_argument('--start', help="start here instead of the load addr: $addr, source line or label")
+    ap.add_argument('--byte', action='append', default=[], help="try every value at this addr (repeatable)")
+    ap.add_argument('--perm', help="every ordering of values at $lo..$hi (default 01 02 ..)")
+    ap.add_argument('--result', help="report memory $lo..$hi instead of the registers")
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="workers, 0 = in process")
+    ap.add_argument('--chunk', type=int, default=256, help="inputs per task")
+    ap.add_argument('--max-steps', type=int, default=1_000_000)
+    ap.add_argument('-v', '--verbose', action='store_true', help="print every input and result")
+    args = ap.parse_args(argv)
+
+    prog = Assembler.build(args.filename)
+    code = prog.code
+    start = resolve(args.start, prog.addr_line, prog.labels) if args.start else None
+    extract = registers
+    if args.result: extract = partial(peek, *parse_range(args.result))
+    byte_addrs = [parse_range(b)[0] for b in args.byte]
+
+    results = Counter()
+    runs = 0
+    t0 = time.perf_counter()
+    for spec, result in sweep(code, _grid(byte_addrs, args.perm), extract, args.jobs,
+                              args.chunk, start=start, max_steps=args.max_steps):
+        runs += 1
+        results[result] += 1
+        if args.verbose:
+            shown = ' '.join(f"${k:02X}={v.hex(' ').upper()}" for k, v in spec.items())
+            print(f"{shown}  ->  {_show(result)}")
+    wall = time.perf_counter() - t0
+
+    print(f"{args.filename}: {runs} runs on {args.jobs or 1} worker(s) in {wall:.2f} s, "
+          f"{runs / wall if wall else 0:.0f} runs/s, {len(results)} distinct results")
+    for result, n in results.most_common(10):
+        print(f"{n:8d}  {_show(result)}")
+    return 0
+
+
+def _show(result):
+    return result.hex(' ').upper() if isinstance(result, bytes) else str(result)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
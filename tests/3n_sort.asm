@@ -1,4 +1,5 @@
 ; Simple test - sort 3 numbers
+; EXPECT $10..$12 = 10 20 30
     LDA #$30         ; 48
     STA $10
     LDA #$10         ; 16
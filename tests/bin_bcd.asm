@@ -1,6 +1,8 @@
 ; Convert binary number in A to BCD (Binary Coded Decimal)
 ; Input: Binary value at $10
 ; Output: BCD hundreds at $20, tens at $21, ones at $22
+; EXPECT $20..$22 = 01 05 06
+; EXPECT X = 06
 
     LDA #$9C        ; Test with 156 decimal
     STA $10
@@ -1,6 +1,9 @@
 ; 6502 Bubble Sort
 ; Sorts 8 numbers in ascending order
 ; Array starts at $10, count at $00
+; EXPECT $10..$17 = 01 08 0C 15 2A 35 3F 4B
+; EXPECT X = 07
+; EXPECT Y = 00
 
     LDA #$08         ; array size = 8
     STA $00
@@ -0,0 +1,15 @@
+; 6502 memory-mapped devices (see devices.py)
+; Prints "HI" on the char-out port, then times two NOPs
+; with the cycle timer and stores the count at $10
+; EXPECT $10 = 08
+
+    LDA #$48         ; 'H'
+    STA $F000        ; char out
+    LDA #$49         ; 'I'
+    STA $F000
+    STA $F100        ; timer reset
+    NOP
+    NOP
+    LDA $F100        ; latch: NOP + NOP + this LDA = 8 cycles
+    STA $10
+    BRK
@@ -1,5 +1,7 @@
 ; 6502 Fibonacci Calculator
 ; Calculates fibonacci sequence
+; EXPECT $00..$01 = 22 37
+; EXPECT X = 00
 
     CLC              ; clr carry
     LDA #$01         ; F(0) = 1
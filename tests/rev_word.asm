@@ -1,5 +1,6 @@
 ; Reverse the string "HELLO" in place
 ; String stored at $10-$14, result at same location
+; EXPECT $10..$14 = 4F 4C 4C 45 48
 
 START:
     ; Initialize string "HELLO" at $10-$14
@@ -0,0 +1,32 @@
+; 6502 busy-wait loop patched while it is cached
+; spin runs once as CMP #$05 and falls through, is patched to CMP $05
+; and re-entered, now spinning until the timer IRQ lands on a BRK. an
+; idle loop fast-forward has to charge the patched body's cycles
+; EXPECT $0206 = C5
+; EXPECT A = 05
+; EXPECT STEPS = 168
+; EXPECT CYCLES = 438
+
+    LDA #$05
+    STA $20
+spin:
+    LDA $20
+    CMP #$05         ; patched to CMP $05 (opcode $C5) below
+    BNE spin
+    LDA #$C5
+    STA $0206
+    LDA #$2C         ; IRQ vector -> stop ($022C)
+    STA $FFFE
+    LDA #$02
+    STA $FFFF
+    LDA #$00         ; period = $0400 cycles
+    STA $F104
+    LDA #$04
+    STA $F105
+    LDA #$01         ; enable the timer IRQ
+    STA $F106
+    CLI
+    JMP spin
+
+stop:
+    BRK
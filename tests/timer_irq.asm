@@ -0,0 +1,32 @@
+; 6502 periodic timer interrupt (see devices.py)
+; Points the IRQ vector at isr, starts a 100 cycle timer
+; and spins until the handler has counted 5 interrupts
+; EXPECT $20 = 05
+; EXPECT $21 = 2A
+
+    LDA #$22         ; IRQ vector -> isr ($0222)
+    STA $FFFE
+    LDA #$02
+    STA $FFFF
+    LDA #$64         ; period = 100 cycles
+    STA $F104
+    LDA #$00
+    STA $F105
+    LDA #$01         ; enable the timer IRQ
+    STA $F106
+    CLI
+wait:
+    LDA $20
+    CMP #$05
+    BNE wait
+    SEI
+    BRK
+
+isr:
+    LDA $F106        ; ack
+    LDX $20
+    INX
+    STX $20
+    LDA #$2A         ; A is clobbered, wait reloads it
+    STA $21
+    RTI
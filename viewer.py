@@ -0,0 +1,100 @@
+"""
+6502 memory viewer for a state file
+
+Maps a state file (see statefile.py) read-only and redraws its registers
+and a hex dump of memory FPS times a second, reversing the bytes that
+changed since the last frame. It only reads the file, so it can watch a
+machine running in another process (main.py --state, statefile.py) at
+no cost to it; registers are as of that process's last save.
+
+Keys: UP/DOWN/PGUP/PGDN scroll, G goto $addr, Z zero page, Q quit
+
+Usage: python viewer.py <file.state> [--addr $0200]
+"""
+
+import argparse
+import curses
+import sys
+
+from breakpoints import parse_range
+from main import FPS, View, _format_hex_line, prompt
+from statefile import StateFile
+
+
+def draw(view, sf, top, old):
+    # one frame from row `top` down; old is memory as of the last frame
+    screen = view.screen
+    h, w = screen.getmaxyx()
+    if view.size != (h, w): view.resize((h, w))
+    mem = sf.memory
+
+    regs = sf.registers()
+    if regs is None:
+        view.put(0, f"{sf.path}: no registers saved", curses.A_BOLD)
+    else:
+        p = regs['p']
+        flags = "".join(f if p & bit else '-' for f, bit in zip("NV-BDIZC", (128, 64, 32, 16, 8, 4, 2, 1)))
+        view.put(0, f"PC: ${regs['pc']:04X}  A: ${regs['a']:02X}  X: ${regs['x']:02X}  Y: ${regs['y']:02X}  "
+                    f"SP: ${regs['sp']:02X}  P: {flags}  {'' if regs['running'] else '[STOPPED]'}", curses.A_BOLD)
+        view.put(1, f"Step: {regs['steps']}  Cycles: {regs['cycles']}  ({regs['skipped']} skipped idle)")
+
+    y = 3
+    rows = max(0, h - 1 - y)
+    for row in range(top, min(top + rows, 4096)):
+        base = row << 4
+        data = mem[base:base + 16]
+        hilite = ()
+        if old is not None and data != old[base:base + 16]:
+            hilite = tuple(span for i in range(16) if data[i] != old[base + i]
+                           for span in ((7 + 3*i, 2), (56 + i, 1)))
+        view.put(y, _format_hex_line(base, data), 0, hilite)
+        y += 1
+    while y < h - 1:
+        view.put(y, "")
+        y += 1
+
+    view.put(h - 1, f"{sf.path}  UP/DOWN/PGUP/PGDN=scroll  G=goto  Z=zero page  Q=quit", curses.A_REVERSE)
+    screen.refresh()
+    return rows
+
+
+def Watch(screen, path, addr):
+    curses.curs_set(0)
+    screen.timeout(int(1000 / FPS))
+    sf = StateFile(path, readonly=True)
+    view = View(screen)
+    top = addr >> 4
+    old = None
+    try:
+        while True:
+            rows = draw(view, sf, top, old)
+            old = bytes(sf.memory)
+            try:  key = screen.getch()
+            except Exception: key = -1
+
+            if key in (ord('q'), ord('Q')): break
+            elif key == curses.KEY_UP:    top -= 1
+            elif key == curses.KEY_DOWN:  top += 1
+            elif key == curses.KEY_PPAGE: top -= rows
+            elif key == curses.KEY_NPAGE: top += rows
+            elif key in (ord('z'), ord('Z')): top = 0
+            elif key in (ord('g'), ord('G')):
+                try: top = parse_range(prompt(view, "goto $addr: "))[0] >> 4
+                except ValueError: pass
+                screen.timeout(int(1000 / FPS))
+            top = max(0, min(top, 4096 - max(rows, 1)))
+    finally:
+        sf.close()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="watch the memory of a 6502 state file")
+    ap.add_argument('state')
+    ap.add_argument('--addr', default='$0200', help="first address shown (default $0200)")
+    args = ap.parse_args(argv)
+    curses.wrapper(Watch, args.state, parse_range(args.addr)[0])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())